@@ -0,0 +1,163 @@
+import asyncio
+import os
+import resource
+import shutil
+
+from jobs import current_job
+from utils import TMP_DIR
+
+# Disk space always kept free in TMP_DIR
+MIN_FREE_DISK_MB = int(os.environ.get("MIN_FREE_DISK_MB", 512))
+# Upper bound for the space reserved by running downloads (0 = only free disk)
+MAX_RESERVED_DISK_MB = int(os.environ.get("MAX_RESERVED_DISK_MB", 0))
+# New downloads wait while the process uses more memory than this (0 = no limit)
+MAX_RSS_MB = int(os.environ.get("MAX_RSS_MB", 0))
+# How long a download may wait for room before being rejected
+ADMISSION_TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", 300))
+print(f"Min free disk: {MIN_FREE_DISK_MB} MB")
+
+MB = 1024 * 1024
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+def get_rss_bytes() -> int:
+    """Current resident set size of the process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak RSS, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Reservation:
+    def __init__(self, controller, nbytes: int, downgraded: bool):
+        self._controller = controller
+        self.nbytes = nbytes
+        self.downgraded = downgraded
+
+    def release(self):
+        if self._controller is not None:
+            self._controller._release(self.nbytes)
+            self._controller = None
+
+
+class AdmissionController:
+    """
+    Reserve temporary disk space for downloads before they start.
+
+    A download fitting in the free disk (minus what running downloads already
+    reserved) and the memory budget starts right away. Otherwise it is
+    downgraded when a cheaper format fits, waits for running downloads to
+    release their space when it could fit once they are done, and is rejected
+    when it never could or waited longer than `timeout`.
+    """
+
+    def __init__(
+        self, path, min_free: int, max_reserved: int, max_rss: int, timeout: float
+    ):
+        self.path = path
+        self.min_free = min_free
+        self.max_reserved = max_reserved
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.reserved = 0
+        self._released = None  # Lazily initialized asyncio.Event
+
+    def _free_disk(self) -> int:
+        try:
+            return shutil.disk_usage(self.path).free - self.min_free
+        except OSError:
+            return 0
+
+    def _capacity(self) -> int:
+        """Space downloads could use once the running ones are done."""
+        capacity = self._free_disk() + self.reserved
+        if self.max_reserved:
+            capacity = min(capacity, self.max_reserved)
+        return capacity
+
+    def _fits(self, nbytes: int) -> bool:
+        if self.max_rss and get_rss_bytes() > self.max_rss:
+            return False
+        if self.max_reserved and self.reserved + nbytes > self.max_reserved:
+            return False
+        # Free disk already excludes what running downloads wrote so far, so
+        # this counts it twice: safe, and exact again once they are done
+        return self.reserved + nbytes <= self._free_disk()
+
+    def _release(self, nbytes: int):
+        self.reserved -= nbytes
+        if self._released is not None:
+            self._released.set()
+
+    def _reserve(self, nbytes: int, downgraded: bool) -> Reservation:
+        self.reserved += nbytes
+        reservation = Reservation(self, nbytes, downgraded)
+        # Released with the job, once its temporary files are cleaned up
+        job = current_job()
+        if job is not None:
+            job.finalizers.append(reservation.release)
+        return reservation
+
+    async def admit(
+        self, nbytes: int, fallback_nbytes: int | None = None, label: str = ""
+    ) -> Reservation:
+        """
+        Reserve `nbytes`, or `fallback_nbytes` (a cheaper format) when only
+        that fits. The reservation is released when the current job ends,
+        or by calling its release() method outside of a job.
+        """
+        if self._released is None:
+            self._released = asyncio.Event()
+        if fallback_nbytes is not None and fallback_nbytes >= nbytes:
+            fallback_nbytes = None
+
+        if self._fits(nbytes):
+            return self._reserve(nbytes, False)
+        if fallback_nbytes is not None and self._fits(fallback_nbytes):
+            print(
+                f"Admission: downgrading {label} "
+                f"({nbytes / MB:.1f} MB -> {fallback_nbytes / MB:.1f} MB)"
+            )
+            return self._reserve(fallback_nbytes, True)
+
+        # Wait for running downloads if they are what's in the way
+        wanted, downgraded = nbytes, False
+        if nbytes > self._capacity():
+            if fallback_nbytes is None or fallback_nbytes > self._capacity():
+                raise AdmissionRejected(
+                    f"Not enough disk space for {label} ({nbytes / MB:.1f} MB)"
+                )
+            wanted, downgraded = fallback_nbytes, True
+        print(
+            f"Admission: {label} waits for {wanted / MB:.1f} MB "
+            f"({self.reserved / MB:.1f} MB reserved)"
+        )
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while not self._fits(wanted):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise AdmissionRejected(
+                    f"Timed out waiting for disk space for {label} ({wanted / MB:.1f} MB)"
+                )
+            # Memory and free disk also change without any release, poll them
+            self._released.clear()
+            try:
+                await asyncio.wait_for(self._released.wait(), timeout=min(remaining, 5))
+            except asyncio.TimeoutError:
+                pass
+        return self._reserve(wanted, downgraded)
+
+
+admission = AdmissionController(
+    TMP_DIR,
+    MIN_FREE_DISK_MB * MB,
+    MAX_RESERVED_DISK_MB * MB,
+    MAX_RSS_MB * MB,
+    ADMISSION_TIMEOUT,
+)
@@ -1,10 +1,144 @@
+import asyncio
+import contextlib
 import os
+from pathlib import Path
 
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import FSInputFile, InputFile
+
+from flood_control import FloodControl
 
 telegram_token = os.environ.get("TELEGRAM_TOKEN")
 if telegram_token is None:
     raise ValueError("TELEGRAM_TOKEN environment variable is not set")
 
-bot = Bot(token=telegram_token)
+# Self-hosted telegram-bot-api server (started with --local), e.g. http://localhost:8081.
+# It must see the bot's files at the same paths, they are uploaded by path.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+LOCAL_BOT_API = bool(TELEGRAM_API_URL)
+# Upload limit of the Bot API server
+MAX_UPLOAD_MB = 2000 if LOCAL_BOT_API else 50
+print(f"Bot API server: {TELEGRAM_API_URL or 'api.telegram.org'}")
+# Seconds a request to a local server may take: it answers an upload once
+# the file reached Telegram, up to 2000MB
+TELEGRAM_REQUEST_TIMEOUT = float(os.environ.get("TELEGRAM_REQUEST_TIMEOUT", 1800))
+# Memory held by the file chunks being uploaded, all uploads together
+MAX_UPLOAD_BUFFER_MB = float(os.environ.get("MAX_UPLOAD_BUFFER_MB", 8))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_SLOTS = max(1, int(MAX_UPLOAD_BUFFER_MB * 1024 * 1024) // UPLOAD_CHUNK_SIZE)
+# Chunks a file made while uploaded may prepare ahead of the one being sent
+STREAM_READ_AHEAD = 4
+_upload_slots = None  # Lazily initialized asyncio.Semaphore, one slot per chunk
+_reserve_lock = None  # Lazily initialized asyncio.Lock
+
+session = None
+if LOCAL_BOT_API:
+    session = AiohttpSession(
+        api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=True),
+        timeout=TELEGRAM_REQUEST_TIMEOUT,
+    )
+
+bot = Bot(token=telegram_token, session=session)
+# Every request sent to a chat is paced by the flood control
+bot.session.middleware(FloodControl())
 dp = Dispatcher()
+
+
+def _get_upload_slots():
+    global _upload_slots
+    if _upload_slots is None:
+        _upload_slots = asyncio.Semaphore(UPLOAD_SLOTS)
+    return _upload_slots
+
+
+@contextlib.asynccontextmanager
+async def _reserved_slots(count: int):
+    """
+    Hold `count` upload slots (at most all of them) for the whole block.
+    Reservations are taken one at a time, so two of them can't each wait
+    for slots the other holds.
+    """
+    global _reserve_lock
+    if _reserve_lock is None:
+        _reserve_lock = asyncio.Lock()
+    slots = _get_upload_slots()
+    count = min(count, UPLOAD_SLOTS)
+    acquired = 0
+    try:
+        async with _reserve_lock:
+            while acquired < count:
+                await slots.acquire()
+                acquired += 1
+        yield
+    finally:
+        for _ in range(acquired):
+            slots.release()
+
+
+async def _bounded(chunks):
+    """
+    Yield from `chunks`, each chunk taking one of the slots shared by all
+    uploads until the next one is asked for, so uploads wait rather than
+    go over MAX_UPLOAD_BUFFER_MB, whatever the file sizes.
+    """
+    slots = _get_upload_slots()
+    try:
+        while True:
+            async with slots:
+                try:
+                    chunk = await anext(chunks)
+                except StopAsyncIteration:
+                    return
+                yield chunk
+    finally:
+        await chunks.aclose()
+
+
+class BoundedFSInputFile(FSInputFile):
+    """File streamed from disk chunk by chunk, within MAX_UPLOAD_BUFFER_MB."""
+
+    def __init__(self, path, filename=None):
+        super().__init__(path, filename=filename, chunk_size=UPLOAD_CHUNK_SIZE)
+
+    async def read(self, bot):
+        async for chunk in _bounded(super().read(bot)):
+            yield chunk
+
+
+class StreamInputFile(InputFile):
+    """
+    File made while it is uploaded, within MAX_UPLOAD_BUFFER_MB:
+    `open_stream(chunk_size=..., read_ahead=...)` returns a new async
+    iterator of its bytes for every upload attempt, in chunks of at most
+    `chunk_size`, holding at most `read_ahead` chunks besides the one it
+    yielded. The slots of all of them are reserved for the whole upload.
+    """
+
+    def __init__(self, open_stream, filename: str):
+        super().__init__(filename=filename)
+        self.open_stream = open_stream
+
+    async def read(self, bot):
+        async with _reserved_slots(STREAM_READ_AHEAD + 1):
+            chunks = self.open_stream(
+                chunk_size=UPLOAD_CHUNK_SIZE, read_ahead=STREAM_READ_AHEAD
+            )
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            finally:
+                await chunks.aclose()
+
+
+def input_file(path, filename=None):
+    """
+    File to send to Telegram. A local Bot API server reads it from disk
+    itself, but then names it after the file, so files sent under another
+    name are still uploaded.
+    """
+    path = Path(path)
+    if LOCAL_BOT_API and (filename is None or filename == path.name):
+        return path.resolve().as_uri()
+    return BoundedFSInputFile(path, filename=filename)
@@ -0,0 +1,122 @@
+import asyncio
+import shutil
+import time
+from pathlib import Path
+
+# Audio formats Telegram plays in its audio player: ffmpeg encoder, extension
+AUDIO_CODECS = {
+    "mp3": ("libmp3lame", ".mp3"),
+    "m4a": ("aac", ".m4a"),
+}
+
+
+class TranscodeError(Exception):
+    pass
+
+
+async def transcode_audio(
+    source: Path, codec: str, bitrate: int, command_prefix=()
+) -> Path:
+    """
+    Encode the audio of `source` to `codec` ("mp3" or "m4a") at `bitrate`
+    kbps with a single-threaded ffmpeg, next to it, run through
+    `command_prefix` (nice...). Returns the new file, named like `source`
+    with the extension of `codec` (replacing `source` if it had it). The
+    ffmpeg process is killed if the caller is cancelled.
+    """
+    encoder, extension = AUDIO_CODECS[codec]
+    # Written under a temporary name, as the source may have the same one
+    target = source.with_name(source.stem + ".part" + extension)
+    process = await asyncio.create_subprocess_exec(
+        *command_prefix,
+        "ffmpeg",
+        "-nostdin",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-y",
+        "-i",
+        str(source),
+        "-vn",
+        "-threads",
+        "1",
+        "-c:a",
+        encoder,
+        "-b:a",
+        f"{bitrate}k",
+        str(target),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await process.communicate()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        target.unlink(missing_ok=True)
+        raise
+    if process.returncode != 0:
+        target.unlink(missing_ok=True)
+        raise TranscodeError(
+            f"ffmpeg failed on {source.name}: {stderr.decode(errors='replace').strip()[-500:]}"
+        )
+    return target.replace(source.with_suffix(extension))
+
+
+class TranscodeScheduler:
+    """
+    Runs transcode_audio with at most `max_processes` ffmpeg at once, one
+    core each, the others waiting their turn in arrival order. ffmpeg gets
+    a lower CPU priority (nice) and, with `idle_io`, only idle disk time
+    (ionice), when those commands exist. Queue times are recorded.
+    """
+
+    def __init__(self, max_processes: int, nice: int = 0, idle_io: bool = False):
+        self.max_processes = max(1, max_processes)
+        self.command_prefix = []
+        if nice and shutil.which("nice"):
+            self.command_prefix += ["nice", "-n", str(nice)]
+        if idle_io and shutil.which("ionice"):
+            self.command_prefix += ["ionice", "-c", "3"]
+        self._slots = None  # Lazily initialized asyncio.Semaphore
+        self.waiting = 0
+        self.running = 0
+        self.started = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+
+    async def transcode(self, source: Path, codec: str, bitrate: int) -> Path:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_processes)
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        queue_time = time.monotonic() - queued_at
+        self.started += 1
+        self.total_queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        print(
+            f"ffmpeg: {source.name} waited {queue_time:.1f}s in queue "
+            f"({self.running + 1}/{self.max_processes} running, {self.waiting} waiting, "
+            f"average wait {self.total_queue_time / self.started:.1f}s)"
+        )
+        self.running += 1
+        try:
+            return await transcode_audio(source, codec, bitrate, self.command_prefix)
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    def metrics(self) -> dict:
+        """Current load and queue times (seconds) since startup."""
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "started": self.started,
+            "queue_time_avg": self.total_queue_time / max(1, self.started),
+            "queue_time_max": self.max_queue_time,
+        }
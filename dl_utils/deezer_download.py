@@ -3,6 +3,7 @@
 
 from __future__ import annotations
 
+import functools
 import html.parser
 import json
 import os
@@ -66,8 +67,9 @@ def set_default_song_quality(quality_config: str, web_sound_quality: dict):
         sound_format = "MP3_128"
 
 
-def get_file_format(s: dict) -> tuple[str, str]:
-    if sound_format == "FLAC":
+def get_file_format(s: dict, quality: str | None = None) -> tuple[str, str]:
+    # quality: Deezer format to use instead of the default one (e.g. "MP3_320" to downgrade FLAC)
+    if (quality or sound_format) == "FLAC":
         if int(s.get("FILESIZE_FLAC", 0)) > 0:
             return ".flac", "FLAC"
         elif int(s.get("FILESIZE_MP3_320", 0)) > 0:
@@ -77,7 +79,7 @@ def get_file_format(s: dict) -> tuple[str, str]:
             print("Debug: FLAC and MP3_320 not available, falling back to MP3_128")
             return ".mp3", "MP3_128"
 
-    if sound_format == "MP3_320":
+    if (quality or sound_format) == "MP3_320":
         if int(s.get("FILESIZE_MP3_320", 0)) > 0:
             return ".mp3", "MP3_320"
         else:
@@ -88,6 +90,19 @@ def get_file_format(s: dict) -> tuple[str, str]:
     return ".mp3", "MP3_128"
 
 
+# Rough sizes used when Deezer doesn't give one (FLAC is about 60% of CD bitrate)
+BYTES_PER_SECOND = {"FLAC": 110_000, "MP3_320": 40_000, "MP3_128": 16_000}
+
+
+def get_song_size(s: dict, quality: str | None = None) -> int:
+    """Expected size in bytes of a song in the format get_file_format picks."""
+    _, deezer_format = get_file_format(s, quality)
+    size = int(s.get(f"FILESIZE_{deezer_format}", 0) or 0)
+    if size <= 0:
+        size = int(s.get("DURATION", 0) or 300) * BYTES_PER_SECOND[deezer_format]
+    return size
+
+
 # quality is mp3 or flac
 def init_deezer_session(proxy_server: str, quality: str) -> None:
     global session, license_token
@@ -136,6 +151,10 @@ class DeezerApiException(Exception):
     pass
 
 
+class DownloadCancelled(Exception):
+    pass
+
+
 class ScriptExtractor(html.parser.HTMLParser):
     """extract <script> tag contents from a html page"""
 
@@ -182,11 +201,12 @@ def blowfishDecrypt(data, key):
     return c.decrypt(data)
 
 
-def decryptfile(fh, key, fo):
+def decryptfile(fh, key, fo, cancel_event=None):
     """
     Decrypt data from file <fh>, and write to file <fo>.
     decrypt using blowfish with <key>.
     Only every third 2048 byte block is encrypted.
+    Stops with DownloadCancelled once <cancel_event> is set.
     """
     blockSize = 2048
     i = 0
@@ -194,6 +214,8 @@ def decryptfile(fh, key, fo):
     for data in fh.iter_content(blockSize):
         if not data:
             break
+        if cancel_event is not None and cancel_event.is_set():
+            raise DownloadCancelled("Download cancelled")
 
         isEncrypted = (i % 3) == 0
         isWholeBlock = len(data) == blockSize
@@ -275,8 +297,8 @@ def write_song_metadata(output_file: str, song: dict, is_flac: bool) -> None:
     set_metadata(audio, "album", song.get("ALB_TITLE"))
     set_metadata(audio, "tracknumber", song.get("TRACK_NUMBER"))
     set_metadata(audio, "discnumber", song.get("DISK_NUMBER"))
-    if "album_Data" in globals() and album_Data and "PHYSICAL_RELEASE_DATE" in album_Data:
-        set_metadata(audio, "date", album_Data.get("PHYSICAL_RELEASE_DATE", "")[:4])
+    # Album songs get the album's date when scraped (get_deezer_page_data)
+    set_metadata(audio, "date", (song.get("PHYSICAL_RELEASE_DATE") or "")[:4])
     try:
         set_metadata(audio, "picture", downloadpicture(song["ALB_PICTURE"]))
     except Exception as e:
@@ -287,7 +309,9 @@ def write_song_metadata(output_file: str, song: dict, is_flac: bool) -> None:
     audio.save()
 
 
+@functools.lru_cache(maxsize=32)
 def downloadpicture(pic_idid):
+    # Every track of an album embeds the same cover, so keep recent ones around
     if not session:
         raise DeezerApiException("Error: Deezer session not initialized")
 
@@ -302,7 +326,8 @@ def get_picture_link(pic_idid):
     return url
 
 
-def get_song_url(track_token: str, format: str) -> str:
+def _get_media(track_tokens: list, format: str) -> list:
+    # One entry per track token, in the same order
     try:
         response = requests.post(
             "https://media.deezer.com/v1/get_url",
@@ -314,9 +339,7 @@ def get_song_url(track_token: str, format: str) -> str:
                         "formats": [{"cipher": "BF_CBC_STRIPE", "format": format}],
                     }
                 ],
-                "track_tokens": [
-                    track_token,
-                ],
+                "track_tokens": list(track_tokens),
             },
             headers={"User-Agent": USER_AGENT},
         )
@@ -328,34 +351,63 @@ def get_song_url(track_token: str, format: str) -> str:
         raise RuntimeError(f"Could not retrieve song URL: {e}")
     except requests.exceptions.RequestException as e:
         raise RuntimeError(f"Could not retrieve song URL: {e}")
+    return data.get("data") or []
+
 
-    if not data.get("data") or "errors" in data["data"][0]:
+def get_song_url(track_token: str, format: str) -> str:
+    data = _get_media([track_token], format)
+
+    if not data or "errors" in data[0]:
         raise RuntimeError(
-            f"Could not get download url from API: {data['data'][0]['errors'][0]['message']}"
+            f"Could not get download url from API: {data[0]['errors'][0]['message'] if data else 'no data'}"
         )
 
-    if not data["data"][0].get("media"):
+    if not data[0].get("media"):
         raise RuntimeError(
             "Could not get download url: API returned no media sources (track may not be available in your region)"
         )
 
-    url = data["data"][0]["media"][0]["sources"][0]["url"]
+    url = data[0]["media"][0]["sources"][0]["url"]
     return url
 
 
-def download_song(song: dict, deezer_format: str, output_file: str) -> None:
+def get_song_urls(track_tokens: list, format: str) -> dict:
+    """
+    Get the download urls of several songs with a single request.
+    Songs without one are left out, get_song_url tells why.
+    """
+    if not track_tokens:
+        return {}
+    urls = {}
+    for track_token, item in zip(track_tokens, _get_media(track_tokens, format)):
+        try:
+            urls[track_token] = item["media"][0]["sources"][0]["url"]
+        except (KeyError, IndexError, TypeError):
+            pass
+    return urls
+
+
+def download_song(
+    song: dict,
+    deezer_format: str,
+    output_file: str,
+    url: str | None = None,
+    cancel_event=None,
+) -> None:
     # downloads and decrypts the song from Deezer. Adds ID3 and art cover
     # song: dict with information of the song (grabbed from Deezer.com)
     # output_file: absolute file name of the output file
+    # url: media URL already resolved for this song/format (e.g. prefetched), skips get_url
+    # cancel_event: threading.Event aborting the download (and removing the file) once set
     assert type(song) is dict, "song must be a dict"
     assert type(output_file) is str, "output_file must be a str"
 
     if not session:
         raise DeezerApiException("Error: Deezer session not initialized")
 
-    url = None
     try:
-        url = get_song_url(song["TRACK_TOKEN"], deezer_format)
+        if url is None:
+            url = get_song_url(song["TRACK_TOKEN"], deezer_format)
     except DeezerApiException:
         raise  # Session-level error (e.g. expired token), don't try fallback
     except Exception as e:
@@ -385,8 +437,15 @@ def download_song(song: dict, deezer_format: str, output_file: str) -> None:
         with session.get(url, stream=True) as response:
             response.raise_for_status()
             with open(output_file, "w+b") as fo:
-                decryptfile(response, key, fo)
+                decryptfile(response, key, fo, cancel_event)
         write_song_metadata(output_file, song, is_flac)
+    except DownloadCancelled:
+        print("Download cancelled: {}".format(output_file))
+        try:
+            os.remove(output_file)
+        except OSError:
+            pass
+        raise
     except MutagenError as e:
         print(f"Warning: Could not write metadata to file: {e}")
     except Exception as e:
@@ -400,6 +459,13 @@ def get_song_infos_from_deezer_website(search_type, id):
     # id: deezer_id of the song/album/playlist (like https://www.deezer.com/de/track/823267272)
     # return: if TYPE_TRACK => song (dict grabbed from the website with information about a song)
     # return: if TYPE_ALBUM|TYPE_PLAYLIST => list of songs
+    _, songs = get_deezer_page_data(search_type, id)
+    return songs[0] if search_type == TYPE_TRACK else songs
+
+
+def get_deezer_page_data(search_type, id) -> tuple[dict, list]:
+    # Same as get_song_infos_from_deezer_website, but also returns the DATA of the page
+    # (the song itself, or the album/playlist infos)
     # raises
     # Deezer404Exception if
     # 1. open playlist https://www.deezer.com/de/playlist/1180748301 and click on song Honey from Moby in a new tab:
@@ -423,19 +489,26 @@ def get_song_infos_from_deezer_website(search_type, id):
     parser.feed(resp.text)
     parser.close()
 
+    page_data = {}
     songs = []
     for script in parser.scripts:
         regex = re.search(r'{"DATA":.*', script)
         if regex:
             DZR_APP_STATE = json.loads(regex.group())
-            global album_Data
-            album_Data = DZR_APP_STATE.get("DATA")
+            page_data = DZR_APP_STATE.get("DATA")
             if (
                 DZR_APP_STATE["DATA"]["__TYPE__"] == "playlist"
                 or DZR_APP_STATE["DATA"]["__TYPE__"] == "album"
             ):
                 # songs if you searched for album/playlist
                 for song in DZR_APP_STATE["SONGS"]["data"]:
+                    if DZR_APP_STATE["DATA"]["__TYPE__"] == "album":
+                        # Album songs may lack the album's own date and artist
+                        song.setdefault(
+                            "PHYSICAL_RELEASE_DATE",
+                            page_data.get("PHYSICAL_RELEASE_DATE"),
+                        )
+                        song.setdefault("ALB_ART_NAME", page_data.get("ART_NAME"))
                     songs.append(song)
             elif DZR_APP_STATE["DATA"]["__TYPE__"] == "song":
                 # just one song on that page
@@ -461,7 +534,7 @@ def get_song_infos_from_deezer_website(search_type, id):
                     except Exception:
                         pass  # Non-critical, fall back to track artist
                 songs.append(song)
-    return songs[0] if search_type == TYPE_TRACK else songs
+    return page_data, songs
 
 
 def deezer_search(search, search_type):
@@ -22,6 +22,19 @@ def clean_filename(filename: str) -> str:
     return cleaned
 
 
+def truncate_filename(stem: str, extension: str, max_bytes: int = 240) -> str:
+    """
+    Joins `stem` and `extension`, the stem cut so the name fits in
+    `max_bytes` UTF-8 bytes (filesystems allow 255 bytes per name).
+    """
+    budget = max_bytes - len(extension.encode())
+    encoded = stem.encode()
+    if len(encoded) > budget:
+        # Cut on a byte boundary, dropping a partial multibyte character
+        stem = encoded[:budget].decode(errors="ignore").rstrip(" .") or "_"
+    return stem + extension
+
+
 def get_audio_duration(file_path: str) -> int:
     """Get the duration of the audio file."""
     try:
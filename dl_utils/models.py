@@ -0,0 +1,124 @@
+import asyncio
+
+from dl_utils.deezer_download import TYPE_ALBUM, TYPE_TRACK, get_artists
+from dl_utils.deezer_utils import (
+    clean_filename,
+    get_audio_duration,
+    truncate_filename,
+)
+
+DEEZER_URL = "https://www.deezer.com"
+
+
+class Track:
+    """
+    A Deezer track, from download to upload.
+
+    Built once from the song data of the Deezer website, which downloading
+    and tagging read as is; the fields shown to the user are extracted from
+    it here. The download sets `path` and `file_extension`. The duration
+    comes from Deezer, or from the downloaded file when Deezer lacks it.
+    """
+
+    __slots__ = (
+        "data",
+        "id",
+        "title",
+        "artist",
+        "track_number",
+        "duration",
+        "path",
+        "file_extension",
+    )
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.id = str(data.get("SNG_ID", ""))
+        self.title = data.get("SNG_TITLE") or f"Track {self.id}"
+        # "(Live)", "(Remastered 2011)"... which the API title includes
+        version = (data.get("VERSION") or "").strip()
+        if version and version not in self.title:
+            self.title = f"{self.title} {version}"
+        # Main and featured artists, ART_NAME only has the first one
+        self.artist = get_artists(data) or "Unknown Artist"
+        track_number = str(data.get("TRACK_NUMBER", ""))
+        self.track_number = int(track_number) if track_number.isdigit() else None
+        duration = str(data.get("DURATION", ""))
+        self.duration = int(duration) if duration.isdigit() else None
+        self.path = None
+        self.file_extension = None
+
+    @property
+    def link(self) -> str:
+        return f"{DEEZER_URL}/{TYPE_TRACK}/{self.id}"
+
+    async def resolve_duration(self) -> int:
+        """Duration in seconds, read from the file headers (in a thread) once at most."""
+        if not self.duration:
+            self.duration = await asyncio.to_thread(get_audio_duration, self.path)
+        return self.duration
+
+    @property
+    def filename(self) -> str:
+        """Name of the downloaded file as sent to the user, short enough to be saved."""
+        return truncate_filename(
+            f"{clean_filename(self.artist)} - {clean_filename(self.title)}",
+            self.file_extension or "",
+        )
+
+
+class Album:
+    """
+    A Deezer album with its tracks, or the release of a single track.
+
+    Holds what captions, covers and zips need, from the same website data
+    as the tracks. `cover` is downloaded the first time it's needed.
+    """
+
+    __slots__ = (
+        "id",
+        "title",
+        "artist",
+        "release_date",
+        "picture_id",
+        "cover",
+        "tracks",
+        "is_album",
+    )
+
+    def __init__(self, data: dict, tracks: list, is_album: bool = True):
+        self.id = str(data.get("ALB_ID", ""))
+        self.title = data.get("ALB_TITLE") or f"Album {self.id}"
+        self.artist = (
+            data.get("ALB_ART_NAME") or data.get("ART_NAME") or "Unknown Artist"
+        )
+        self.release_date = data.get("PHYSICAL_RELEASE_DATE") or ""  # YYYY-MM-DD
+        self.picture_id = data.get("ALB_PICTURE")
+        self.cover = None
+        self.tracks = tracks
+        self.is_album = is_album
+
+    @classmethod
+    def from_song(cls, song: dict) -> "Album":
+        """Release of a single track, from its song data."""
+        return cls(song, [Track(song)], is_album=False)
+
+    @classmethod
+    def from_page(cls, data: dict, songs: list) -> "Album":
+        """Album from the data and songs of its page."""
+        return cls(data, [Track(song) for song in songs])
+
+    @property
+    def year(self) -> str:
+        return self.release_date[:4] or "0000"
+
+    @property
+    def release_date_text(self) -> str:
+        """Release date as DD/MM/YYYY."""
+        if not self.release_date:
+            return "00/00/0000"
+        return "/".join(reversed(self.release_date.split("-")))
+
+    @property
+    def link(self) -> str:
+        return f"{DEEZER_URL}/{TYPE_ALBUM}/{self.id}"
@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import hmac
+import re
+import ssl
+import time
+from urllib.parse import quote, urlsplit
+from xml.sax.saxutils import escape
+
+import aiohttp
+import certifi
+from yarl import URL
+
+# Parts of a multipart upload are at least 5MB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Presigned URLs are valid for at most a week
+MAX_PRESIGN_SECONDS = 7 * 24 * 3600
+PART_UPLOAD_ATTEMPTS = 3
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+
+class S3Exception(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"S3 error {status}: {message}")
+        self.status = status
+
+
+def _quote(value: str, safe: str = "-_.~") -> str:
+    return quote(value, safe=safe)
+
+
+def _hmac(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+class S3Client:
+    """
+    Minimal client of an S3-compatible object storage (AWS, MinIO, R2...),
+    signing its requests with AWS Signature Version 4. Objects are addressed
+    path-style (endpoint/bucket/key), which every implementation supports.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        bucket: str,
+        region: str,
+        access_key_id: str,
+        secret_access_key: str,
+    ):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.region = region
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        parts = urlsplit(self.endpoint)
+        host = parts.hostname
+        if parts.port and (parts.scheme, parts.port) not in (
+            ("http", 80),
+            ("https", 443),
+        ):
+            host = f"{host}:{parts.port}"
+        self.host = host
+        self.base_path = parts.path
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            ssl_context = ssl.create_default_context(cafile=certifi.where())
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ssl=ssl_context)
+            )
+        return self._session
+
+    def _path(self, key: str) -> str:
+        return _quote(f"{self.base_path}/{self.bucket}/{key}", safe="/-_.~")
+
+    def _scope(self, date: str) -> str:
+        return f"{date}/{self.region}/s3/aws4_request"
+
+    def _signature(self, amz_date: str, canonical_request: str) -> str:
+        date = amz_date[:8]
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                self._scope(date),
+                hashlib.sha256(canonical_request.encode()).hexdigest(),
+            ]
+        )
+        key = _hmac(("AWS4" + self.secret_access_key).encode(), date)
+        for part in (self.region, "s3", "aws4_request"):
+            key = _hmac(key, part)
+        return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def _canonical_query(params: dict) -> str:
+        return "&".join(
+            f"{_quote(k)}={_quote(str(v))}" for k, v in sorted(params.items())
+        )
+
+    def presign_get(self, key: str, expires_in: int, params: dict = None) -> str:
+        """URL downloading an object without credentials for `expires_in` seconds."""
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        query = dict(params or {})
+        query.update(
+            {
+                "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+                "X-Amz-Credential": f"{self.access_key_id}/{self._scope(amz_date[:8])}",
+                "X-Amz-Date": amz_date,
+                "X-Amz-Expires": min(int(expires_in), MAX_PRESIGN_SECONDS),
+                "X-Amz-SignedHeaders": "host",
+            }
+        )
+        path = self._path(key)
+        canonical_query = self._canonical_query(query)
+        canonical_request = "\n".join(
+            [
+                "GET",
+                path,
+                canonical_query,
+                f"host:{self.host}\n",
+                "host",
+                "UNSIGNED-PAYLOAD",
+            ]
+        )
+        signature = self._signature(amz_date, canonical_request)
+        scheme = urlsplit(self.endpoint).scheme
+        return f"{scheme}://{self.host}{path}?{canonical_query}&X-Amz-Signature={signature}"
+
+    async def _request(
+        self,
+        method: str,
+        key: str,
+        params: dict = None,
+        headers: dict = None,
+        data: bytes = b"",
+    ):
+        """Signed request, returns (status, headers, body). Raises S3Exception on errors."""
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        payload_hash = (
+            await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+            if data
+            else EMPTY_SHA256
+        )
+        headers = {k.lower(): str(v).strip() for k, v in (headers or {}).items()}
+        headers.update(
+            {
+                "host": self.host,
+                "x-amz-content-sha256": payload_hash,
+                "x-amz-date": amz_date,
+            }
+        )
+        signed_headers = ";".join(sorted(headers))
+        path = self._path(key)
+        canonical_query = self._canonical_query(params or {})
+        canonical_request = "\n".join(
+            [
+                method,
+                path,
+                canonical_query,
+                "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+                signed_headers,
+                payload_hash,
+            ]
+        )
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key_id}/{self._scope(amz_date[:8])}, "
+            f"SignedHeaders={signed_headers}, "
+            f"Signature={self._signature(amz_date, canonical_request)}"
+        )
+        del headers["host"]  # Set by aiohttp, to the same value
+
+        url = f"{self.endpoint.split('://')[0]}://{self.host}{path}"
+        if canonical_query:
+            url += "?" + canonical_query
+        async with self._get_session().request(
+            method, URL(url, encoded=True), headers=headers, data=data or None
+        ) as response:
+            body = await response.read()
+            # CompleteMultipartUpload reports errors in a 200 response
+            failed = response.status >= 300 or b"<Error>" in body[:512]
+            if failed:
+                message = _xml_value(body, "Message") or body[:200].decode(
+                    errors="replace"
+                )
+                raise S3Exception(response.status, message)
+            return response.status, response.headers, body
+
+    async def head_object(self, key: str) -> dict | None:
+        """Headers of an object, None if it doesn't exist."""
+        try:
+            _, headers, _ = await self._request("HEAD", key)
+        except S3Exception as e:
+            if e.status == 404:
+                return None
+            raise
+        return {k.lower(): v for k, v in headers.items()}
+
+    async def _upload_part(self, key, upload_id, number, data) -> str:
+        for attempt in range(PART_UPLOAD_ATTEMPTS):
+            try:
+                _, headers, _ = await self._request(
+                    "PUT",
+                    key,
+                    {"partNumber": number, "uploadId": upload_id},
+                    data=data,
+                )
+                return headers["ETag"]
+            except (S3Exception, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt + 1 >= PART_UPLOAD_ATTEMPTS:
+                    raise
+                print(f"Upload of part {number} of {key} failed ({e}), retrying...")
+                await asyncio.sleep(2**attempt)
+
+    async def upload_stream(
+        self,
+        key: str,
+        chunks,
+        part_size: int,
+        concurrency: int,
+        content_type: str = "application/octet-stream",
+        metadata: dict = None,
+    ):
+        """
+        Multipart upload of the bytes of the async iterator `chunks`, up to
+        `concurrency` parts of `part_size` bytes being sent at once, so at
+        most that many parts are held in memory. Aborted on failure.
+        """
+        part_size = max(part_size, MIN_PART_SIZE)
+        headers = {"content-type": content_type}
+        for name, value in (metadata or {}).items():
+            headers[f"x-amz-meta-{name}"] = value
+        _, _, body = await self._request("POST", key, {"uploads": ""}, headers)
+        upload_id = _xml_value(body, "UploadId")
+        if not upload_id:
+            raise S3Exception(0, "No UploadId in CreateMultipartUpload response")
+
+        slots = asyncio.Semaphore(concurrency)
+        uploads = []
+
+        async def send(number, data):
+            try:
+                return await self._upload_part(key, upload_id, number, data)
+            finally:
+                slots.release()
+
+        try:
+            buffer = bytearray()
+            async for chunk in chunks:
+                buffer += chunk
+                while len(buffer) >= part_size:
+                    data = bytes(buffer[:part_size])
+                    del buffer[:part_size]
+                    await slots.acquire()
+                    uploads.append(asyncio.create_task(send(len(uploads) + 1, data)))
+                    # Stop reading early when a part failed
+                    for task in uploads:
+                        if task.done() and task.exception() is not None:
+                            raise task.exception()
+            if buffer or not uploads:
+                await slots.acquire()
+                uploads.append(
+                    asyncio.create_task(send(len(uploads) + 1, bytes(buffer)))
+                )
+            etags = await asyncio.gather(*uploads)
+
+            parts = "".join(
+                f"<Part><PartNumber>{number}</PartNumber><ETag>{escape(etag)}</ETag></Part>"
+                for number, etag in enumerate(etags, 1)
+            )
+            await self._request(
+                "POST",
+                key,
+                {"uploadId": upload_id},
+                {"content-type": "application/xml"},
+                f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode(),
+            )
+        except BaseException:
+            for task in uploads:
+                task.cancel()
+            await asyncio.gather(*uploads, return_exceptions=True)
+            try:
+                await self._request("DELETE", key, {"uploadId": upload_id})
+            except Exception as e:
+                print(f"Could not abort upload of {key}: {e}")
+            raise
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+def _xml_value(body: bytes, tag: str) -> str | None:
+    match = re.search(rf"<{tag}>(.*?)</{tag}>".encode(), body, re.S)
+    return match.group(1).decode() if match else None
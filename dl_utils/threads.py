@@ -0,0 +1,33 @@
+import asyncio
+import contextvars
+import functools
+
+
+async def wait_through_cancel(future):
+    """Wait for `future` to be done, even when cancelled meanwhile."""
+    while not future.done():
+        try:
+            await asyncio.wait([future])
+        except asyncio.CancelledError:
+            pass
+
+
+async def run_in_thread(func, *args, executor=None, **kwargs):
+    """
+    asyncio.to_thread on `executor` (the default one if None), except that
+    a cancelled caller only gets CancelledError once the thread returned.
+
+    A thread can't be interrupted, it stops at its next check of its cancel
+    event. Cleaning up after it before that (removing its directory) would
+    race with the files it still writes.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    future = loop.run_in_executor(
+        executor, functools.partial(context.run, func, *args, **kwargs)
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await wait_through_cancel(future)
+        raise
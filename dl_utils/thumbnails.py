@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+# Thumbnails kept, a few kB each
+THUMBNAIL_CACHE_SIZE = 256
+
+_thumbnails = OrderedDict()  # (image digest, kind) -> thumbnail bytes or None
+
+
+def _cached(key):
+    if key in _thumbnails:
+        _thumbnails.move_to_end(key)
+        return True, _thumbnails[key]
+    return False, None
+
+
+def _store(key, thumbnail):
+    _thumbnails[key] = thumbnail
+    _thumbnails.move_to_end(key)
+    while len(_thumbnails) > THUMBNAIL_CACHE_SIZE:
+        _thumbnails.popitem(last=False)
+
+
+def _to_jpeg(img) -> bytes:
+    buf = BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def make_audio_thumbnail(cover_data: bytes) -> bytes | None:
+    """Build a Telegram-compliant audio thumbnail from cover bytes.
+
+    Telegram's server-side extraction of embedded album art is unreliable
+    (it intermittently shows no cover for some tracks), so we pass an explicit
+    thumbnail. Telegram requires it to be JPEG, <= 320x320 and < 200 kB."""
+    if not cover_data:
+        return None
+    try:
+        img = Image.open(BytesIO(cover_data))
+        # JPEG covers are decoded straight at a fraction of their size
+        img.draft("RGB", (320, 320))
+        img.thumbnail((320, 320))
+        return _to_jpeg(img)
+    except Exception as e:
+        print(f"Warning: could not build audio thumbnail: {e}")
+        return None
+
+
+def crop_center(pil_img, crop_width, crop_height):
+    img_width, img_height = pil_img.size
+    return pil_img.crop(
+        (
+            (img_width - crop_width) // 2,
+            (img_height - crop_height) // 2,
+            (img_width + crop_width) // 2,
+            (img_height + crop_height) // 2,
+        )
+    )
+
+
+def make_cropped_thumbnail(image_data: bytes, width: int, height: int) -> bytes | None:
+    """JPEG of the `width` x `height` center of an image, at full resolution."""
+    if not image_data:
+        return None
+    try:
+        return _to_jpeg(crop_center(Image.open(BytesIO(image_data)), width, height))
+    except Exception as e:
+        print(f"Warning: could not build cropped thumbnail: {e}")
+        return None
+
+
+async def _thumbnail(kind, func, image_data: bytes, *args) -> bytes | None:
+    """Run `func` in a thread, once per image and arguments."""
+    if not image_data:
+        return None
+    key = (hashlib.sha1(image_data).digest(), kind, args)
+    found, thumbnail = _cached(key)
+    if not found:
+        thumbnail = await asyncio.to_thread(func, image_data, *args)
+        _store(key, thumbnail)
+    return thumbnail
+
+
+async def audio_thumbnail(cover_data: bytes) -> bytes | None:
+    """make_audio_thumbnail, off the event loop and memoized per cover."""
+    return await _thumbnail("audio", make_audio_thumbnail, cover_data)
+
+
+async def cropped_thumbnail(image_data: bytes, width: int, height: int) -> bytes | None:
+    """make_cropped_thumbnail, off the event loop and memoized per image."""
+    return await _thumbnail("crop", make_cropped_thumbnail, image_data, width, height)
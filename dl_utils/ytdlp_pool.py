@@ -0,0 +1,125 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yt_dlp
+from yt_dlp import YoutubeDL
+
+from dl_utils.threads import run_in_thread
+
+
+class _PooledYoutubeDL:
+    """A YoutubeDL kept between downloads, with the cancel event of its current one."""
+
+    def __init__(self, options: dict, cookie_stamp):
+        self.cancel_event = None
+        self.cookie_stamp = cookie_stamp
+        self.ydl = YoutubeDL(
+            {
+                **options,
+                "progress_hooks": [self._check_cancel],
+                "postprocessor_hooks": [self._check_cancel],
+            }
+        )
+
+    def _check_cancel(self, _):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Download cancelled")
+
+
+class YoutubeDLPool:
+    """
+    YoutubeDL instances reused across downloads, one profile (options) each,
+    run on a dedicated executor of `workers` threads.
+
+    Building a YoutubeDL sets up its extractors, postprocessors and cookie
+    jar; a pooled one only gets the download directory of each request.
+    Instances are built on first use, at most one per thread and profile,
+    and rebuilt when the cookie file changes.
+    """
+
+    def __init__(self, workers: int, cookies_path: str = None):
+        self.cookies_path = cookies_path
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="yt-dlp"
+        )
+        self._lock = threading.Lock()
+        self._idle = {}  # profile name -> [_PooledYoutubeDL]
+
+    def _cookie_stamp(self):
+        """Identifies the cookie file content, None when there is none."""
+        try:
+            stat = os.stat(self.cookies_path)
+        except (TypeError, OSError):
+            return None
+        return (stat.st_mtime_ns, stat.st_size) if stat.st_size > 0 else None
+
+    def _acquire(self, name: str, options: dict, use_cookies: bool):
+        stamp = self._cookie_stamp() if use_cookies else None
+        with self._lock:
+            idle = self._idle.setdefault(name, [])
+            while idle:
+                pooled = idle.pop()
+                if pooled.cookie_stamp == stamp:
+                    return pooled
+                print(f"Cookie file changed, reloading yt-dlp for {name}")
+        if stamp is not None:
+            print(f"Using cookies for {name}")
+            options = {**options, "cookiefile": self.cookies_path}
+        return _PooledYoutubeDL(options, stamp)
+
+    def _release(self, name: str, pooled: _PooledYoutubeDL):
+        pooled.cancel_event = None
+        with self._lock:
+            self._idle[name].append(pooled)
+
+    def _extract(self, name, options, use_cookies, url, download_dir, cancel_event):
+        pooled = self._acquire(name, options, use_cookies)
+        pooled.cancel_event = cancel_event
+        # Output templates are relative to the "home" path
+        pooled.ydl.params["paths"] = {"home": str(download_dir)}
+        try:
+            return pooled.ydl.extract_info(url, download=True)
+        finally:
+            self._release(name, pooled)
+
+    async def extract_info(
+        self,
+        name: str,
+        options: dict,
+        url: str,
+        download_dir,
+        cancel_event=None,
+        use_cookies: bool = False,
+    ):
+        """
+        Download `url` to `download_dir` with the instance of profile `name`
+        (built from `options` when none is idle), and return its info dict.
+        The download stops once `cancel_event` is set, a cancelled caller
+        waits for it to stop.
+        """
+        return await run_in_thread(
+            self._extract,
+            name,
+            options,
+            use_cookies,
+            url,
+            download_dir,
+            cancel_event,
+            executor=self._executor,
+        )
+
+    async def warm_up(self, profiles):
+        """Build an instance of each (name, options, use_cookies) profile ahead of time."""
+
+        def build(name, options, use_cookies):
+            self._release(name, self._acquire(name, options, use_cookies))
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, build, *profile)
+                for profile in profiles
+            )
+        )
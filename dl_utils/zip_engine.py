@@ -0,0 +1,259 @@
+import asyncio
+import os
+import threading
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+# Already compressed formats, deflating them costs CPU for nothing
+STORED_EXTENSIONS = {
+    ".mp3",
+    ".flac",
+    ".m4a",
+    ".ogg",
+    ".opus",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".webp",
+}
+# Other files (lyrics, playlists...) are deflated when smaller than this
+DEFLATE_MAX_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+# Chunks a streamed zip may hold besides the one its consumer has
+STREAM_READ_AHEAD = 6
+
+
+class ZipCancelled(Exception):
+    pass
+
+
+def compress_type_for(path, size: int) -> int:
+    if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        return ZIP_STORED
+    return ZIP_DEFLATED if size <= DEFLATE_MAX_SIZE else ZIP_STORED
+
+
+def write_zip(
+    output, files, progress=None, cancel_event=None, chunk_size: int = COPY_CHUNK_SIZE
+) -> int:
+    """
+    Write the (source path, path in the zip) pairs of `files` to `output`
+    (a path or a file object, which needn't be seekable), copying each file
+    in chunks of `chunk_size`. Audio and images are stored as is.
+    `progress(done, total)` gets the bytes copied so far. Missing files are
+    skipped. Returns the number of files written.
+    """
+    sizes = {}
+    for src, _ in files:
+        try:
+            sizes[src] = os.path.getsize(src)
+        except OSError:
+            print(f"  Warning: Source file not found, skipping: {src}")
+    total = sum(sizes.values())
+    done = 0
+    written = 0
+
+    with ZipFile(output, "w") as zipf:
+        for src, dest in files:
+            if src not in sizes:
+                continue
+            info = ZipInfo.from_file(src, dest)
+            info.compress_type = compress_type_for(src, sizes[src])
+            with open(src, "rb") as fi, zipf.open(info, "w", force_zip64=True) as fo:
+                while chunk := fi.read(chunk_size):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise ZipCancelled(f"Cancelled while zipping {output}")
+                    fo.write(chunk)
+                    done += len(chunk)
+                    if progress is not None:
+                        progress(done, total)
+            written += 1
+    return written
+
+
+async def build_zip(
+    zip_path, files, on_progress=None, cancel_event=None, interval: float = 2.0
+) -> int:
+    """
+    write_zip in a thread. The `on_progress(done, total)` coroutine function
+    is awaited every `interval` seconds while the zip is being written, so
+    quick zips don't report anything.
+    """
+    state = {"done": 0, "total": 0}
+
+    def progress(done, total):
+        # Read from the event loop, a plain dict update is enough
+        state["done"], state["total"] = done, total
+
+    task = asyncio.create_task(
+        asyncio.to_thread(write_zip, zip_path, files, progress, cancel_event)
+    )
+    try:
+        while True:
+            finished, _ = await asyncio.wait({task}, timeout=interval)
+            if finished:
+                return task.result()
+            if on_progress is not None and state["total"]:
+                try:
+                    await on_progress(state["done"], state["total"])
+                except Exception as e:
+                    print(f"Could not report zip progress: {e}")
+    finally:
+        # The thread itself stops on cancel_event
+        task.cancel()
+
+
+class _ZipPipe:
+    """
+    File object a zip is written to in a thread, handing each write over
+    to the event loop in pieces of at most `chunk_size`, and blocking while
+    the consumer is behind.
+    """
+
+    def __init__(
+        self, loop, queue: asyncio.Queue, closed: threading.Event, chunk_size: int
+    ):
+        self.loop = loop
+        self.queue = queue
+        self.closed = closed
+        self.chunk_size = chunk_size
+
+    def write(self, data) -> int:
+        data = memoryview(data)
+        for start in range(0, len(data), self.chunk_size):
+            if self.closed.is_set():
+                raise ZipCancelled("Zip stream closed")
+            asyncio.run_coroutine_threadsafe(
+                self.queue.put(bytes(data[start : start + self.chunk_size])),
+                self.loop,
+            ).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+_END = object()
+
+
+async def stream_zip(
+    files,
+    on_progress=None,
+    cancel_event=None,
+    interval: float = 2.0,
+    chunk_size: int = COPY_CHUNK_SIZE,
+    read_ahead: int = STREAM_READ_AHEAD,
+):
+    """
+    Async generator of the bytes of a zip of `files`, written by write_zip
+    in a thread as they are consumed, so the archive is never stored.
+    Stored entries need no seeking back: their CRC goes in a data
+    descriptor. `on_progress(done, total)` is awaited every `interval`
+    seconds.
+
+    Yields chunks of at most `chunk_size`, and holds at most `read_ahead`
+    more: the file chunk the thread read, the piece of it waiting for room
+    in the queue, and the queue.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(max(1, read_ahead - 2))
+    closed = threading.Event()
+    state = {"done": 0, "total": 0}
+
+    def progress(done, total):
+        state["done"], state["total"] = done, total
+
+    def write():
+        result = _END
+        try:
+            write_zip(
+                _ZipPipe(loop, queue, closed, chunk_size),
+                files,
+                progress,
+                cancel_event,
+                chunk_size,
+            )
+        except BaseException as e:
+            result = e
+        if not closed.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(result), loop).result()
+
+    writer = asyncio.create_task(asyncio.to_thread(write))
+    last_report = loop.time()
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+            if on_progress is not None and loop.time() - last_report >= interval:
+                last_report = loop.time()
+                try:
+                    await on_progress(state["done"], state["total"])
+                except Exception as e:
+                    print(f"Could not report zip progress: {e}")
+    finally:
+        # Unblock the writer, which then stops at its next write
+        closed.set()
+        while not writer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.wait({writer}, timeout=0.05)
+
+
+def zip_entry_size(dest: str, size: int) -> int:
+    """
+    Upper bound of the bytes a stored file takes in a zip: its content, local
+    header, zip64 extra field and data descriptor, and central directory entry.
+    """
+    name_size = len(dest.encode())
+    return size + 30 + 20 + 24 + name_size + 46 + 28 + name_size
+
+
+# End of central directory records (zip64 included)
+ZIP_END_SIZE = 22 + 56 + 20
+
+
+def plan_zip_parts(files, max_size: int):
+    """
+    Lay out the (source path, path in the zip) pairs of `files` in as few
+    zips of at most `max_size` bytes as possible, headers included.
+
+    First-fit decreasing: the biggest files are placed first, each in the
+    first part with room left. Each part then lists its files in their
+    original order, and the parts are ordered by their first file.
+    Returns the parts and the files left out: missing, or too big to fit
+    in a part on their own.
+    """
+    capacity = max_size - ZIP_END_SIZE
+    left_out = []
+    entries = []  # (entry size, index, src, dest)
+    for index, (src, dest) in enumerate(files):
+        try:
+            size = zip_entry_size(dest, os.path.getsize(src))
+        except OSError:
+            print(f"  Skipping non-existent file: {src}")
+            left_out.append((src, dest))
+            continue
+        if size > capacity:
+            print(
+                f"Error: File {src} ({size / (1024 * 1024):.2f} MB) exceeds max part size {max_size / (1024 * 1024):.2f} MB. Skipping."
+            )
+            left_out.append((src, dest))
+            continue
+        entries.append((size, index, src, dest))
+
+    parts = []  # [room left, [(index, src, dest)]]
+    for size, index, src, dest in sorted(entries, key=lambda e: (-e[0], e[1])):
+        for part in parts:
+            if part[0] >= size:
+                break
+        else:
+            part = [capacity, []]
+            parts.append(part)
+        part[0] -= size
+        part[1].append((index, src, dest))
+
+    ordered = sorted(sorted(part[1]) for part in parts)
+    return [[(src, dest) for _, src, dest in part] for part in ordered], left_out
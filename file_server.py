@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import time
+from pathlib import Path
+from urllib.parse import quote, urlencode, urlsplit
+
+from aiohttp import web
+
+from zip_cache import (
+    COPY_FILES_PATH,
+    FILE_LINK_TEMPLATE,
+    FILE_SERVER_URL,
+    get_zip_cache,
+)
+
+# Built-in server for the zips of copy mode, enabled by FILE_SERVER_URL
+FILE_SERVER_HOST = os.environ.get("FILE_SERVER_HOST", "0.0.0.0")
+FILE_SERVER_PORT = int(os.environ.get("FILE_SERVER_PORT", 8082))
+# Links stop working after this long
+FILE_LINK_TTL_HOURS = float(os.environ.get("FILE_LINK_TTL_HOURS", 72))
+# Signs the links, derived from the bot token unless set
+FILE_SERVER_SECRET = (
+    os.environ.get("FILE_SERVER_SECRET")
+    or hashlib.sha256(
+        ("file-server:" + os.environ.get("TELEGRAM_TOKEN", "")).encode()
+    ).hexdigest()
+)
+# Path the links are under, when served behind a reverse proxy
+FILE_SERVER_PREFIX = urlsplit(FILE_SERVER_URL).path.rstrip("/")
+
+if FILE_SERVER_URL and COPY_FILES_PATH:
+    print(
+        f"File server: {FILE_SERVER_URL} on {FILE_SERVER_HOST}:{FILE_SERVER_PORT} "
+        f"(links valid {FILE_LINK_TTL_HOURS} h)"
+    )
+
+_runner = None
+
+
+def sign(name: str, expires_at: int) -> str:
+    message = f"{name}\n{expires_at}".encode()
+    digest = hmac.new(FILE_SERVER_SECRET.encode(), message, hashlib.sha256)
+    return digest.hexdigest()[:32]
+
+
+def zip_link(name: str) -> str:
+    """Link to a zip of COPY_FILES_PATH: signed by the file server, or from the template."""
+    if not FILE_SERVER_URL:
+        return FILE_LINK_TEMPLATE.format(quote(name))
+    expires_at = int(time.time() + FILE_LINK_TTL_HOURS * 3600)
+    query = urlencode({"expires": expires_at, "sig": sign(name, expires_at)})
+    return f"{FILE_SERVER_URL}/{quote(name)}?{query}"
+
+
+async def handle_file(request: web.Request) -> web.StreamResponse:
+    """
+    Serve a zip of COPY_FILES_PATH to a signed link that hasn't expired.
+    FileResponse answers Range requests (resumed downloads) and sends the
+    file with sendfile. Downloads starting from the first byte are counted.
+    """
+    name = request.match_info["name"]
+    signature = request.query.get("sig", "")
+    try:
+        expires_at = int(request.query.get("expires", ""))
+    except ValueError:
+        raise web.HTTPForbidden()
+    if not hmac.compare_digest(signature, sign(name, expires_at)):
+        raise web.HTTPForbidden()
+    if expires_at < time.time():
+        raise web.HTTPGone(text="This link has expired.")
+
+    # Zips being written are hidden
+    path = Path(COPY_FILES_PATH) / name
+    if name.startswith(".") or not path.is_file():
+        raise web.HTTPNotFound()
+
+    if request.method == "GET":
+        try:
+            start = request.http_range.start
+        except ValueError:
+            start = None  # Answered by FileResponse
+        if not start:
+            try:
+                downloads = await asyncio.to_thread(
+                    get_zip_cache().record_download, signature, name, expires_at
+                )
+                print(f"File server: download #{downloads} of {name}")
+            except Exception as e:
+                print(f"Could not count download of {name}: {e}")
+
+    return web.FileResponse(
+        path,
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(name)}"},
+    )
+
+
+async def start_file_server():
+    """Serve COPY_FILES_PATH at FILE_SERVER_URL, in copy mode."""
+    global _runner
+    if not (FILE_SERVER_URL and COPY_FILES_PATH) or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get(FILE_SERVER_PREFIX + "/{name}", handle_file)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, FILE_SERVER_HOST, FILE_SERVER_PORT).start()
+    print(f"File server listening on {FILE_SERVER_HOST}:{FILE_SERVER_PORT}")
@@ -0,0 +1,289 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    EditMessageCaption,
+    EditMessageReplyMarkup,
+    EditMessageText,
+    SendAudio,
+    SendDocument,
+    SendMediaGroup,
+    SendPhoto,
+    SendVideo,
+)
+
+from job_queue import RUN_MODE, WORKER_PROCESSES
+
+# Messages per second sent to all chats, and to a single chat (Telegram allows
+# about 30/s overall, 1/s per chat with short bursts, 20/min in groups)
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = float(os.environ.get("TELEGRAM_CHAT_BURST", 5))
+GROUP_CHAT_RATE = 20 / 60
+# The front process and the workers send with the same token, each gets a
+# share of the limits. A user's jobs run one at a time across the workers,
+# so a private chat only hears from the front process and one worker.
+SENDING_PROCESSES = 1 if RUN_MODE == "standalone" else WORKER_PROCESSES + 1
+CHAT_SENDING_PROCESSES = min(2, SENDING_PROCESSES)
+# How many times a request hitting flood control is retried
+FLOOD_MAX_RETRIES = int(os.environ.get("FLOOD_MAX_RETRIES", 5))
+print(
+    f"Telegram rate: {TELEGRAM_GLOBAL_RATE}/s global, {TELEGRAM_CHAT_RATE}/s per chat"
+    + (f", split between {SENDING_PROCESSES} processes" if SENDING_PROCESSES > 1 else "")
+)
+
+# Status messages and replies go before uploads
+PRIORITY_MESSAGE = 0
+PRIORITY_MEDIA = 1
+
+# Only sending counts against the budgets (not deleting, answering callbacks...)
+LIMITED_METHOD_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+MEDIA_METHODS = (SendAudio, SendDocument, SendMediaGroup, SendPhoto, SendVideo)
+EDIT_METHODS = (EditMessageText, EditMessageCaption, EditMessageReplyMarkup)
+
+
+class Superseded(Exception):
+    """An edit replaced by a newer edit of the same message before being sent."""
+
+
+class TokenBucket:
+    """
+    `rate` tokens per second, up to `burst`. A request costing more than the
+    burst goes once the bucket is full, and leaves it in debt.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # Set from retry_after
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float, cost: float) -> float:
+        """Seconds to wait before `cost` tokens can be taken."""
+        self._refill(now)
+        wanted = min(cost, self.burst)
+        wait = max(0.0, (wanted - self.tokens) / self.rate)
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now: float, cost: float):
+        self._refill(now)
+        self.tokens -= cost
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.blocked_until
+
+    def penalize(self, now: float, retry_after: float):
+        """Flood control hit: pause, then go on at half the rate."""
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def reward(self):
+        """Accepted request: get back to the full rate step by step."""
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class _Request:
+    def __init__(self, priority: int, seq: int, cost: float):
+        self.priority = priority
+        self.seq = seq
+        self.cost = cost
+        self.granted = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Chat:
+    def __init__(self, chat_id):
+        rate, burst = TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST
+        if isinstance(chat_id, int) and chat_id < 0:
+            # The jobs of several members of a group can run at once
+            rate = min(rate, GROUP_CHAT_RATE) / SENDING_PROCESSES
+            burst /= SENDING_PROCESSES
+        else:
+            rate /= CHAT_SENDING_PROCESSES
+            burst /= CHAT_SENDING_PROCESSES
+        self.bucket = TokenBucket(rate, burst)
+        self.waiting = []  # Heap of _Request
+
+
+class FloodControl(BaseRequestMiddleware):
+    """
+    Outbound scheduler for every Bot API request sent to a chat.
+
+    Requests wait for the budget of their chat and the global budget, the
+    ones with the best priority first (then in arrival order). A request
+    answered with retry_after pauses its chat for that long and halves its
+    rate, which comes back as requests go through, then is retried. An edit
+    still waiting when a newer edit of the same message comes in is dropped,
+    and returns the result of the newer one. Requests not sending to a chat
+    (polling, inline answers, deletions) are not delayed.
+    """
+
+    def __init__(self):
+        global_rate = TELEGRAM_GLOBAL_RATE / SENDING_PROCESSES
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> _Chat
+        self._seq = itertools.count()
+        self._pending_edits = {}  # (chat_id, message_id, method) -> (_Request, result future)
+        self._wakeup = None  # Lazily initialized asyncio.Event
+        self._dispatcher = None
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(
+            LIMITED_METHOD_PREFIXES
+        ):
+            return await make_request(bot, method)
+
+        priority = (
+            PRIORITY_MEDIA if isinstance(method, MEDIA_METHODS) else PRIORITY_MESSAGE
+        )
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        edit_key = None
+        if isinstance(method, EDIT_METHODS) and method.message_id is not None:
+            edit_key = (chat_id, method.message_id, type(method))
+
+        result = None
+        try:
+            for attempt in range(FLOOD_MAX_RETRIES + 1):
+                request = self._submit(chat_id, priority, cost)
+                if edit_key is not None:
+                    previous = self._pending_edits.get(edit_key)
+                    if result is None:
+                        result = asyncio.get_running_loop().create_future()
+                    self._pending_edits[edit_key] = (request, result)
+                    if previous is not None and not previous[0].granted.done():
+                        previous[0].granted.set_exception(Superseded())
+                        # The superseded caller returns what this request returns
+                        if previous[1] is not result:
+                            _chain(result, previous[1])
+                try:
+                    await request.granted
+                except Superseded:
+                    return await asyncio.shield(result)
+                except asyncio.CancelledError:
+                    if not request.granted.done():
+                        request.granted.cancel()
+                    raise
+                finally:
+                    if (
+                        edit_key is not None
+                        and self._pending_edits.get(edit_key, (None,))[0] is request
+                    ):
+                        del self._pending_edits[edit_key]
+
+                try:
+                    response = await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    print(
+                        f"Flood control in chat {chat_id}, retrying in {e.retry_after}s "
+                        f"(attempt {attempt + 1}/{FLOOD_MAX_RETRIES})"
+                    )
+                    self._chat(chat_id).bucket.penalize(time.monotonic(), e.retry_after)
+                    if attempt >= FLOOD_MAX_RETRIES:
+                        raise
+                    continue
+                self._chat(chat_id).bucket.reward()
+                if result is not None and not result.done():
+                    result.set_result(response)
+                return response
+        except BaseException as e:
+            if result is not None and not result.done():
+                if isinstance(e, asyncio.CancelledError):
+                    result.cancel()
+                else:
+                    result.set_exception(e)
+                    result.exception()  # Only superseded edits wait for it
+            raise
+
+    def _chat(self, chat_id) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(chat_id)
+        return chat
+
+    def _submit(self, chat_id, priority: int, cost: float) -> _Request:
+        request = _Request(priority, next(self._seq), cost)
+        heapq.heappush(self._chat(chat_id).waiting, request)
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        return request
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._grant(time.monotonic())
+            if timeout == 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _grant(self, now: float) -> float | None:
+        """
+        Let through the requests whose budgets allow it. Returns how long to
+        wait before one more could go (None: nothing waits, 0: try again now).
+        """
+        ready = []
+        timeout = None
+        for chat_id, chat in list(self._chats.items()):
+            # Cancelled or superseded requests are dropped
+            while chat.waiting and chat.waiting[0].granted.done():
+                heapq.heappop(chat.waiting)
+            if not chat.waiting:
+                if chat.bucket.is_idle(now):
+                    del self._chats[chat_id]
+                continue
+            wait = chat.bucket.delay(now, chat.waiting[0].cost)
+            if wait > 0:
+                timeout = wait if timeout is None else min(timeout, wait)
+            else:
+                ready.append((chat.waiting[0], chat))
+
+        granted = False
+        for request, chat in sorted(ready, key=lambda item: item[0]):
+            wait = self._global.delay(now, request.cost)
+            if wait > 0:
+                timeout = wait if timeout is None else min(timeout, wait)
+                break
+            heapq.heappop(chat.waiting)
+            chat.bucket.take(now, request.cost)
+            self._global.take(now, request.cost)
+            request.granted.set_result(None)
+            granted = True
+        # A chat may have budget for its next request already
+        return 0 if granted else timeout
+
+
+def _chain(source: asyncio.Future, target: asyncio.Future):
+    """Resolve `target` like `source` once it is done."""
+
+    def copy(_):
+        if target.done():
+            return
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+    source.add_done_callback(copy)
@@ -1,25 +1,19 @@
 import asyncio
 import functools
 import hashlib
-import math
 import os
 import re
 import ssl
 import traceback
-from io import BytesIO
 from pathlib import Path
 from urllib.parse import quote
-from zipfile import ZIP_DEFLATED, ZipFile
 
 import aiohttp
 import aioshutil
 import certifi  # SSL certificates
-import requests
-from PIL import Image
 from aiogram import F, Router, types
 from aiogram.types import (
     BufferedInputFile,
-    FSInputFile,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InlineQuery,
@@ -29,7 +23,8 @@ from aiogram.types import (
 )
 from unidecode import unidecode
 
-from bot import bot
+from admission import AdmissionRejected, admission
+from bot import MAX_UPLOAD_MB, StreamInputFile, bot, input_file
 from dl_utils.deezer_download import (
     TYPE_ALBUM,
     TYPE_TRACK,
@@ -37,19 +32,35 @@ from dl_utils.deezer_download import (
     DeezerApiException,
     deezer_search,
     download_song,
-    get_artists,
+    downloadpicture,
+    get_deezer_page_data,
     get_file_format,
-    get_song_infos_from_deezer_website,
+    get_song_size,
+    get_song_url,
+    get_song_urls,
     init_deezer_session,
 )
-from dl_utils.deezer_utils import clean_filename, get_audio_duration
+from dl_utils.deezer_utils import clean_filename
+from dl_utils.models import Album, Track
+from dl_utils.thumbnails import audio_thumbnail
+from dl_utils.threads import run_in_thread, wait_through_cancel
+from dl_utils.zip_engine import plan_zip_parts, stream_zip
+from jobs import (
+    PRIORITY_BULK,
+    RUN_MODE,
+    cancel_keyboard,
+    current_cancel_event,
+    enqueue_download,
+    job_kind,
+    job_tmp_dir,
+    run_unit,
+)
 from utils import (
     TMP_DIR,
+    TTLCache,
     __,
-    add_downloading,
-    is_downloading,
-    remove_downloading,
 )
+from zip_storage import get_zip_storage
 
 deezer_router = Router()
 
@@ -83,22 +94,51 @@ print("Max retries: " + str(MAX_RETRIES))
 SEND_ALBUM_COVER = False if os.environ.get("SEND_ALBUM_COVER") == "false" else True
 print("Send album cover: " + str(SEND_ALBUM_COVER))
 
+# Send album tracks as soon as they and the previous ones are downloaded
+STREAM_ALBUMS = os.environ.get("STREAM_ALBUMS") == "1"
+# How many tracks the downloads may get ahead of the next track to send
+ALBUM_REORDER_BUFFER = max(1, int(os.environ.get("ALBUM_REORDER_BUFFER", 4)))
+print("Stream albums: " + str(STREAM_ALBUMS))
+
+# Speculative prefetch of the top inline search results (0 = disabled)
+PREFETCH_TOP_N = int(os.environ.get("PREFETCH_TOP_N", 0))
+if RUN_MODE == "front":
+    # Downloads run in the worker processes, which wouldn't see the caches
+    PREFETCH_TOP_N = 0
+PREFETCH_TIMEOUT = float(os.environ.get("PREFETCH_TIMEOUT", 15))
+PREFETCH_CACHE_TTL = int(os.environ.get("PREFETCH_CACHE_TTL", 300))
+PREFETCH_MAX_CONCURRENT = int(os.environ.get("PREFETCH_MAX_CONCURRENT", 2))
+# Telegram sends an inline query on almost every keystroke, only the results
+# of a query the user didn't follow up within this delay are prefetched
+PREFETCH_DEBOUNCE = float(os.environ.get("PREFETCH_DEBOUNCE", 1))
+print(
+    "Prefetch top results: "
+    + (str(PREFETCH_TOP_N) if PREFETCH_TOP_N > 0 else "disabled")
+)
+
+# Media URLs resolved per request when downloading an album
+SONG_URL_BATCH_SIZE = 50
+# Telegram media groups hold 2 to 10 items
+MEDIA_GROUP_MAX_SIZE = 10
+
 # Constants
 DEEZER_URL = "https://deezer.com"
-API_URL = "https://api.deezer.com"
-API_TRACK = API_URL + "/track/%s"
-API_ALBUM = API_URL + "/album/%s"
-
 TRACK_REGEX = r"https?://(?:www\.)?deezer\.com/([a-z]*/)?track/(\d+)/?$"
 ALBUM_REGEX = r"https?://(?:www\.)?deezer\.com/([a-z]*/)?album/(\d+)/?$"
 PLAYLIST_REGEX = r"https?://(?:www\.)?deezer\.com/([a-z]*/)?playlist/(\d+)/?$"  # Note: Playlist handling not fully implemented
 
-COPY_FILES_PATH = os.environ.get("COPY_FILES_PATH")
-FILE_LINK_TEMPLATE = os.environ.get("FILE_LINK_TEMPLATE")
-
 _session_refresh_lock = None  # Lazily initialized asyncio.Lock
 _bot_username = None
 
+# Filled by the inline prefetch, consumed by the deep-link download.
+# Keys are (TYPE_TRACK|TYPE_ALBUM, id) for page data and songs,
+# (TRACK_TOKEN, format) for media URLs (those are signed and expire).
+SONG_INFO_CACHE = TTLCache(PREFETCH_CACHE_TTL)
+SONG_URL_CACHE = TTLCache(PREFETCH_CACHE_TTL)
+_prefetch_semaphore = None  # Lazily initialized asyncio.Semaphore
+_prefetch_inflight = set()
+_user_prefetches = {}  # user_id -> prefetch task of their latest search
+
 
 async def _get_bot_username() -> str:
     global _bot_username
@@ -147,470 +187,362 @@ async def maybe_refresh_deezer_session(
     )
 
 
-async def download_track(track_id, retries=MAX_RETRIES):
-    """Downloads a single track from Deezer using imported functions."""
-    tmp_track_base_dir = (
-        None  # Define outside the try/except to avoid "possibly unbound" errors
+def _get_prefetch_semaphore():
+    global _prefetch_semaphore
+    if _prefetch_semaphore is None:
+        _prefetch_semaphore = asyncio.Semaphore(max(1, PREFETCH_MAX_CONCURRENT))
+    return _prefetch_semaphore
+
+
+async def _prefetch_item(id_type, item_id):
+    """Warm the song-info, media URL and cover caches for one search result.
+
+    Every step is stored as soon as it completes, so a prefetch cut short by
+    the time budget still saves the round trips it already made."""
+    key = (id_type, str(item_id))
+    if id_type == TYPE_TRACK:
+        page = SONG_INFO_CACHE.get(key)
+        if page is None:
+            page = await asyncio.to_thread(get_deezer_page_data, TYPE_TRACK, item_id)
+            SONG_INFO_CACHE.set(key, page)
+        _, songs = page
+        if not songs:
+            return
+        track_infos = songs[0]
+        _, deezer_format = get_file_format(track_infos)
+        url_key = (track_infos.get("TRACK_TOKEN"), deezer_format)
+        if url_key[0] and url_key not in SONG_URL_CACHE:
+            SONG_URL_CACHE.set(url_key, await asyncio.to_thread(get_song_url, *url_key))
+        if track_infos.get("ALB_PICTURE"):
+            await asyncio.to_thread(downloadpicture, track_infos["ALB_PICTURE"])
+    elif id_type == TYPE_ALBUM:
+        # Resolving media URLs for a whole album would blow the budget,
+        # only warm the page scrape and the cover.
+        page = SONG_INFO_CACHE.get(key)
+        if page is None:
+            page = await asyncio.to_thread(get_deezer_page_data, TYPE_ALBUM, item_id)
+            SONG_INFO_CACHE.set(key, page)
+        data, _ = page
+        if data.get("ALB_PICTURE"):
+            await asyncio.to_thread(downloadpicture, data["ALB_PICTURE"])
+
+
+async def _prefetch_result(item_data):
+    """Prefetch one search result if a prefetch slot is free, under the time budget."""
+    id_type = item_data.get("id_type", TYPE_TRACK)
+    item_id = item_data.get("id")
+    if not item_id or (id_type, item_id) in _prefetch_inflight:
+        return
+    semaphore = _get_prefetch_semaphore()
+    if semaphore.locked():
+        print(f"Prefetch budget exhausted, skipping {id_type} {item_id}")
+        return
+    async with semaphore:
+        _prefetch_inflight.add((id_type, item_id))
+        try:
+            await asyncio.wait_for(
+                _prefetch_item(id_type, item_id), timeout=PREFETCH_TIMEOUT
+            )
+            print(f"Prefetched {id_type} {item_id}")
+        except asyncio.TimeoutError:
+            print(f"Prefetch of {id_type} {item_id} timed out")
+        except Exception as e:
+            print(f"Prefetch of {id_type} {item_id} failed: {e}")
+        finally:
+            _prefetch_inflight.discard((id_type, item_id))
+
+
+async def prefetch_search_results(search_results):
+    """Speculatively prefetch the top inline results under a strict budget.
+
+    Starts after PREFETCH_DEBOUNCE seconds, unless cancelled by a newer
+    search of the user meanwhile. The results are then prefetched at the
+    same time, each taking one of the PREFETCH_MAX_CONCURRENT slots shared
+    by all searches. A result is skipped when it is already being
+    prefetched or when all prefetch slots are busy, rather than queueing
+    behind them."""
+    await asyncio.sleep(PREFETCH_DEBOUNCE)
+    await asyncio.gather(
+        *(_prefetch_result(item_data) for item_data in search_results[:PREFETCH_TOP_N])
     )
 
-    for attempt in range(retries):
-        try:
-            # Fetch track metadata from Deezer website (may include download details)
-            track_infos = get_song_infos_from_deezer_website("track", track_id)
-            if not track_infos:
-                print(f"Attempt {attempt + 1}: Could not get track info for {track_id}")
-                if attempt < retries - 1:
-                    await asyncio.sleep(1 * (attempt + 1))
-                    continue
-                else:
-                    raise ValueError(
-                        f"Failed to get track info for {track_id} after {retries} attempts."
-                    )
 
-            # Make sure track_infos is a dictionary, not a list
-            if isinstance(track_infos, list):
-                if len(track_infos) > 0:
-                    track_infos = track_infos[0]  # Take the first item if it's a list
-                else:
-                    raise ValueError(
-                        f"Empty track info list received for track {track_id}"
-                    )
+def cancel_user_prefetch(user_id):
+    """Stop prefetching the results of the previous search of a user."""
+    task = _user_prefetches.pop(user_id, None)
+    if task is not None:
+        task.cancel()
 
-            file_extension, deezer_format = get_file_format(track_infos)
 
-            # Create a temporary directory for this track
-            tmp_track_base_dir = Path(TMP_DIR) / "deezer" / "track" / str(track_id)
-            tmp_track_base_dir.mkdir(parents=True, exist_ok=True)
+def schedule_prefetch(user_id, search_results):
+    """Prefetch the results of the latest search of a user, in the background."""
+    cancel_user_prefetch(user_id)
+    task = asyncio.create_task(prefetch_search_results(search_results))
+    _user_prefetches[user_id] = task
 
-            # Determine the expected final file path within our base dir
-            song_path = tmp_track_base_dir / f"{track_id}{file_extension}"
+    def forget(done_task):
+        if _user_prefetches.get(user_id) is done_task:
+            del _user_prefetches[user_id]
 
-            # Perform the actual download
-            download_song(
-                track_infos, deezer_format, str(song_path)
-            )  # download_song expects string path
+    task.add_done_callback(forget)
 
-            # Check if download was successful (e.g., file exists and has size)
-            if not song_path.exists() or song_path.stat().st_size == 0:
-                # Clean up potentially empty file before retrying
-                if song_path.exists():
-                    try:
-                        song_path.unlink()
-                    except OSError:
-                        pass
-                raise IOError(f"Downloaded file {song_path} is missing or empty.")
 
-            # Add download-specific details to the track_infos dictionary
-            # Create a deep copy to avoid modifying the original if it's not a dict
-            track_info_dict = {}
-            if isinstance(track_infos, dict):
-                track_info_dict = track_infos.copy()
-
-            track_info_dict["song_path"] = str(song_path)  # Store as string
-            track_info_dict["song_name"] = (
-                track_infos.get("SNG_TITLE", f"Track {track_id}")
-                if isinstance(track_infos, dict)
-                else f"Track {track_id}"
-            )
-            track_info_dict["artist_name"] = (
-                track_infos.get("ART_NAME", "Unknown Artist")
-                if isinstance(track_infos, dict)
-                else "Unknown Artist"
-            )
-            track_info_dict["file_extension"] = file_extension
-            track_info_dict["download_dir"] = str(
-                tmp_track_base_dir
-            )  # Store base dir path
-            # Carry over track number if present in original info
-            if isinstance(track_infos, dict) and "TRACK_NUMBER" in track_infos:
-                track_info_dict["TRACK_NUMBER"] = track_infos["TRACK_NUMBER"]
+def estimate_download_footprint(songs, quality=None) -> int:
+    """Disk space needed in TMP_DIR to download the given songs."""
+    # Zips are streamed to Telegram, or published by the copy mode storage
+    return sum(get_song_size(song, quality) for song in songs)
 
-            print(f"Successfully downloaded track {track_id} to {song_path}")
-            return track_info_dict  # Success, return details
 
-        except Exception as e:
-            print(
-                f"Error downloading track {track_id} on attempt {attempt + 1}/{retries}: {e}"
-            )
-            # No specific directory per attempt to clean here, as we use a consistent base dir.
-            # The failed/empty file is handled above before raising IOError.
+async def reserve_download_space(songs, label) -> str | None:
+    """
+    Reserve disk space for downloading songs (released when the job ends).
+    Returns the Deezer format to use instead of the default one, if the
+    admission controller downgraded the download (FLAC -> MP3_320).
+    """
+    reservation = await admission.admit(
+        estimate_download_footprint(songs),
+        estimate_download_footprint(songs, "MP3_320"),
+        label,
+    )
+    return "MP3_320" if reservation.downgraded else None
 
-            if attempt < retries - 1:
-                await maybe_refresh_deezer_session(
-                    attempt + 1, retries, f"track {track_id}", e
+
+async def resolve_song_urls(songs, quality=None):
+    """
+    Resolve the media URLs of `songs` in a few batched requests instead of
+    one per song, into SONG_URL_CACHE. Songs left out resolve their own.
+    """
+    tokens_by_format = {}
+    for song in songs:
+        _, deezer_format = get_file_format(song, quality)
+        url_key = (song.get("TRACK_TOKEN"), deezer_format)
+        if url_key[0] and url_key not in SONG_URL_CACHE:
+            tokens_by_format.setdefault(deezer_format, []).append(url_key[0])
+
+    for deezer_format, tokens in tokens_by_format.items():
+        for i in range(0, len(tokens), SONG_URL_BATCH_SIZE):
+            try:
+                urls = await asyncio.to_thread(
+                    get_song_urls, tokens[i : i + SONG_URL_BATCH_SIZE], deezer_format
                 )
-                sleep_time = 1 * (attempt + 1)
-                print(f"Retrying in {sleep_time} seconds...")
-                await asyncio.sleep(sleep_time)
-            else:
-                print(f"Failed to download track {track_id} after {retries} attempts.")
-                # Clean up the base directory if the track ultimately failed
-                if tmp_track_base_dir and tmp_track_base_dir.exists():
-                    await aioshutil.rmtree(tmp_track_base_dir, ignore_errors=True)
-                raise  # Re-raise the last exception
-
-    # This part should ideally not be reached if retries are exhausted (exception raised)
-    # Clean up the base directory if we somehow exit the loop without success
-    if tmp_track_base_dir and tmp_track_base_dir.exists():
-        await aioshutil.rmtree(tmp_track_base_dir, ignore_errors=True)
-    return None
-
-
-async def download_album(album_id, retries=MAX_RETRIES):
-    """Downloads all tracks from a Deezer album using imported functions, with per-track retries."""
-    album_info_attempt = 0
-    album_tracks_infos = None
-    tmp_download_dir = None  # Define outside the loop for cleanup
-
-    # --- Retry fetching album metadata ---
-    while album_info_attempt < retries:
+            except Exception as e:
+                print(f"Could not resolve media URLs in batch: {e}")
+                continue
+            for token, url in urls.items():
+                SONG_URL_CACHE.set((token, deezer_format), url)
+
+
+async def fetch_deezer_item(item_type, item_id, retries=MAX_RETRIES) -> Album:
+    """
+    Gets a track (as a single track release) or an album with its tracks
+    from the Deezer website, with retries. The first attempt may use what
+    the inline prefetch already scraped.
+    """
+    for attempt in range(retries):
         try:
-            album_tracks_infos = get_song_infos_from_deezer_website("album", album_id)
-            if not album_tracks_infos:
+            page = (
+                SONG_INFO_CACHE.get((item_type, str(item_id))) if attempt == 0 else None
+            )
+            if page is None:
+                page = await asyncio.to_thread(get_deezer_page_data, item_type, item_id)
+            data, songs = page
+            if not songs:
                 raise ValueError(
-                    f"Could not get album info for {album_id} (empty list received)"
+                    f"Could not get {item_type} info for {item_id} (empty list received)"
                 )
-
-            # Create a temporary directory for this album download ONCE after successful metadata fetch
-            tmp_download_dir = Path(TMP_DIR) / "deezer" / "album" / str(album_id)
-            tmp_download_dir.mkdir(parents=True, exist_ok=True)
-            print(
-                f"Album metadata fetched successfully. Download dir: {tmp_download_dir}"
-            )
-            break  # Exit metadata retry loop on success
+            if item_type == TYPE_TRACK:
+                return Album.from_song(songs[0])
+            return Album.from_page(data, songs)
 
         except Exception as e:
-            album_info_attempt += 1
             print(
-                f"Attempt {album_info_attempt}/{retries}: Error fetching album info for {album_id}: {e}"
+                f"Attempt {attempt + 1}/{retries}: Error fetching {item_type} info for {item_id}: {e}"
             )
-            if album_info_attempt < retries:
+            if attempt < retries - 1:
                 await maybe_refresh_deezer_session(
-                    album_info_attempt, retries, f"album metadata {album_id}", e
+                    attempt + 1, retries, f"{item_type} metadata {item_id}", e
                 )
-                sleep_time = 1 * album_info_attempt
-                print(f"Retrying album info fetch in {sleep_time} seconds...")
+                sleep_time = 1 * (attempt + 1)
+                print(f"Retrying {item_type} info fetch in {sleep_time} seconds...")
                 await asyncio.sleep(sleep_time)
             else:
                 print(
-                    f"Failed to get album info for {album_id} after {retries} attempts."
+                    f"Failed to get {item_type} info for {item_id} after {retries} attempts."
                 )
-                # Clean up dir if it was created in a previous failed attempt (unlikely here, but safe)
-                if tmp_download_dir and tmp_download_dir.exists():
-                    await aioshutil.rmtree(tmp_download_dir, ignore_errors=True)
-                raise  # Re-raise the last exception related to fetching album info
-
-    if not album_tracks_infos or not tmp_download_dir:
-        # This should not happen if the loop above works correctly, but as a safeguard:
-        print(f"Failed to initialize album download for {album_id}.")
-        return None  # Indicate failure
-
-    # --- Download individual tracks with retries ---
-    downloaded_tracks_details = []
-    tasks = []
-
-    # Prepare download tasks for each track
-    for i, track_infos in enumerate(album_tracks_infos):
-        track_sng_id = track_infos.get("SNG_ID", f"album_{album_id}_track_{i}")
-        file_extension, deezer_format = get_file_format(track_infos)
-        # Define the final path within the album's download directory
-        song_path = tmp_download_dir / f"{track_sng_id}{file_extension}"
-
-        # Create a closure to capture loop variables correctly for async task
-        # This inner function now includes the retry logic for a single track
-        async def download_single_with_retry(ti, fe, df, sp, track_retries=MAX_RETRIES):
-            track_id = ti.get("SNG_ID", "N/A")
-            for attempt in range(track_retries):
-                try:
-                    # Ensure download_song doesn't create its own conflicting temp dirs if possible
-                    download_song(ti, df, str(sp))  # download_song expects string path
-
-                    if not sp.exists() or sp.stat().st_size == 0:
-                        # Clean up potentially empty file before retrying
-                        if sp.exists():
-                            try:
-                                sp.unlink()
-                            except OSError:
-                                pass
-                        raise IOError(f"Downloaded file {sp} is missing or empty.")
-
-                    # Add details after successful download
-                    ti_copy = ti.copy()  # Work on a copy
-                    ti_copy["song_path"] = str(sp)
-                    ti_copy["song_name"] = ti_copy.get("SNG_TITLE", f"Track {track_id}")
-                    ti_copy["artist_name"] = (
-                        get_artists(ti_copy) or "Unknown Artist"
-                    )
-                    ti_copy["file_extension"] = fe
-                    # Keep track number if available
-                    if "TRACK_NUMBER" in ti:
-                        ti_copy["TRACK_NUMBER"] = ti["TRACK_NUMBER"]
-
-                    print(
-                        f"Successfully downloaded track {track_id} to {sp} (attempt {attempt + 1})"
-                    )
-                    return ti_copy  # Success for this track
+                raise
 
-                except Exception as track_e:
-                    print(
-                        f"Error downloading track {track_id} (attempt {attempt + 1}/{track_retries}): {track_e}"
-                    )
-                    # Clean up potentially failed/partial file for this attempt
-                    if sp.exists():
-                        try:
-                            sp.unlink()
-                        except OSError:
-                            pass
-
-                    if attempt < track_retries - 1:
-                        await maybe_refresh_deezer_session(
-                            attempt + 1,
-                            track_retries,
-                            f"album track {track_id}",
-                            track_e,
-                        )
-                        sleep_time = 1 * (
-                            attempt + 1
-                        )  # Exponential backoff might be better
-                        print(f"Retrying track {track_id} in {sleep_time} seconds...")
-                        await asyncio.sleep(sleep_time)
-                    else:
-                        print(
-                            f"Failed to download track {track_id} after {track_retries} attempts."
-                        )
-                        return None  # Indicate failure for this specific track after all retries
-
-            return None  # Should not be reached, but indicates failure
-
-        tasks.append(
-            download_single_with_retry(
-                track_infos, file_extension, deezer_format, song_path
-            )
-        )  # Pass original dict and path
 
-    # Run downloads concurrently
-    results = await asyncio.gather(*tasks)
+async def download_track(
+    track: Track, download_dir: Path, quality=None, retries=MAX_RETRIES
+):
+    """
+    Downloads a track into download_dir, with retries, and sets its path.
+    Raises the last error if every attempt failed.
+    """
+    file_extension, deezer_format = get_file_format(track.data, quality)
+    track.file_extension = file_extension
+    # Named as sent to the user, a local Bot API server uploads it as is
+    song_path = download_dir / track.id / track.filename
+    song_path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Filter out failed downloads (None results)
-    downloaded_tracks_details = [res for res in results if res is not None]
+    for attempt in range(retries):
+        try:
+            # The first attempt may use a prefetched or batch resolved URL
+            song_url = (
+                SONG_URL_CACHE.get((track.data.get("TRACK_TOKEN"), deezer_format))
+                if attempt == 0
+                else None
+            )
+            # A cancelled download returns once its thread stopped writing
+            await run_in_thread(
+                download_song,
+                track.data,
+                deezer_format,
+                str(song_path),
+                url=song_url,
+                cancel_event=current_cancel_event(),
+            )  # download_song expects string path
 
-    # Check if *any* tracks were successfully downloaded
-    if not downloaded_tracks_details:
-        print(f"Failed to download any tracks for album {album_id}.")
-        # Clean up the main album directory as the entire process failed
-        if tmp_download_dir and tmp_download_dir.exists():
-            await aioshutil.rmtree(tmp_download_dir, ignore_errors=True)
-        # Raising an exception here will be caught by the handler's main try/except
-        raise Exception(
-            f"Failed to download any tracks for album {album_id} after retries."
-        )
+            # Check if download was successful (e.g., file exists and has size)
+            if not song_path.exists() or song_path.stat().st_size == 0:
+                raise IOError(f"Downloaded file {song_path} is missing or empty.")
 
-    # Add the download directory to all *successful* track dicts
-    # This is needed for zipping later
-    for track_detail in downloaded_tracks_details:
-        track_detail["download_dir"] = str(tmp_download_dir)
+            track.path = str(song_path)
+            print(
+                f"Successfully downloaded track {track.id} to {song_path} (attempt {attempt + 1})"
+            )
+            return track
 
-    print(
-        f"Successfully downloaded {len(downloaded_tracks_details)} out of {len(album_tracks_infos)} tracks for album {album_id} to {tmp_download_dir}"
-    )
-    # Return list of successfully downloaded track details
-    # The calling handler will manage cleanup of the tmp_download_dir
-    return downloaded_tracks_details
+        except Exception as e:
+            print(
+                f"Error downloading track {track.id} (attempt {attempt + 1}/{retries}): {e}"
+            )
+            # Clean up potentially failed/partial file for this attempt
+            song_path.unlink(missing_ok=True)
 
+            if attempt < retries - 1:
+                await maybe_refresh_deezer_session(
+                    attempt + 1, retries, f"track {track.id}", e
+                )
+                sleep_time = 1 * (attempt + 1)
+                print(f"Retrying track {track.id} in {sleep_time} seconds...")
+                await asyncio.sleep(sleep_time)
+            else:
+                print(f"Failed to download track {track.id} after {retries} attempts.")
+                raise
 
-def get_track_metadata_from_api(track_id):
-    """Gets track metadata from the official Deezer API."""
-    try:
-        response = requests.get(API_TRACK % quote(str(track_id)))
-        response.raise_for_status()  # Raise an exception for bad status codes
-        track_json = response.json()
-
-        if "error" in track_json:
-            raise ValueError(f"API Error for track {track_id}: {track_json['error']}")
-
-        # Extract cover URL, preferring larger sizes
-        cover_url = (
-            track_json.get("album", {}).get("cover_xl")
-            or track_json.get("album", {}).get("cover_big")
-            or track_json.get("album", {}).get("cover_medium")
-            or f"https://e-cdns-images.dzcdn.net/images/cover/{track_json.get('album', {}).get('md5_image', '')}/1200x0-000000-100-0-0.jpg"
-        )
 
-        # Fetch cover image data
-        cover_response = requests.get(cover_url, stream=True)
-        cover_response.raise_for_status()
-        cover_data = cover_response.content  # Read content directly
+async def gather_in_order(coros, on_result, window: int):
+    """
+    Run `coros` concurrently and pass their results, in order, to the
+    `on_result` coroutine function as soon as they and the previous ones are
+    done. At most `window` coroutines run or wait to be delivered at once,
+    which bounds the finished results buffered out of order.
+    """
+    slots = asyncio.Semaphore(window)
 
-        # Extract other metadata
-        artists = [c["name"] for c in track_json.get("contributors", [])]
-        release_date_str = track_json.get("release_date", "0000-00-00")
+    async def run_in_window(coro):
         try:
-            year = release_date_str.split("-")[0]
-            # Format date as DD/MM/YYYY
-            release_date_formatted = "/".join(reversed(release_date_str.split("-")))
-        except:
-            year = "0000"
-            release_date_formatted = "00/00/0000"
-
-        title = track_json.get("title", f"Track {track_id}")
-        artist_name = track_json.get("artist", {}).get("name", "Unknown Artist")
-        album_title = track_json.get("album", {}).get("title", "Unknown Album")
-        album_link = track_json.get("album", {}).get("link", "")
-        track_link = track_json.get("link", "")
-
-        # Clean names for file system use
-        clean_title = clean_filename(title)
-        clean_artist = clean_filename(artist_name)
-        clean_album_title = clean_filename(album_title)
-
-        # Prepare metadata dictionary
-        metadata = {
-            "id": track_id,
-            "title": title,
-            "artist": artist_name,
-            "album_title": album_title,
-            "artists_list": artists,
-            "release_date": release_date_formatted,
-            "year": year,
-            "album_link": album_link,
-            "track_link": track_link,
-            "cover_data": cover_data,
-            "api_json": track_json,  # Keep original json if needed
-            # For zip naming/structure
-            "clean_artist": clean_artist,
-            "clean_album_title": clean_album_title,
-            "clean_title": clean_title,
-        }
-        print(f"Fetched metadata for track {track_id}: {artist_name} - {title}")
-        return metadata
-
-    except requests.exceptions.RequestException as e:
-        print(f"Network error fetching metadata for track {track_id}: {e}")
-        raise
-    except Exception as e:
-        print(f"Error processing metadata for track {track_id}: {e}")
-        raise
-
-
-def get_album_metadata_from_api(album_id):
-    """Gets album and its tracks' metadata from the official Deezer API."""
+            await slots.acquire()  # Waiters are served in order
+        except asyncio.CancelledError:
+            coro.close()
+            raise
+        return await coro
+
+    tasks = [asyncio.create_task(run_in_window(coro)) for coro in coros]
+    results = []
     try:
-        # Fetch main album info
-        album_response = requests.get(API_ALBUM % quote(str(album_id)))
-        album_response.raise_for_status()
-        album_json = album_response.json()
-        if "error" in album_json:
-            raise ValueError(f"API Error for album {album_id}: {album_json['error']}")
-
-        # Fetch track list (handle pagination if necessary, though 1000 limit is high)
-        tracks_response = requests.get(
-            API_ALBUM % quote(str(album_id)) + "/tracks?limit=1000"
-        )
-        tracks_response.raise_for_status()
-        tracks_json = tracks_response.json()
-        if "error" in tracks_json:
-            # Might happen if album is empty or restricted
-            print(
-                f"API Error fetching tracks for album {album_id}: {tracks_json['error']}"
-            )
-            tracks_data = []
-        else:
-            tracks_data = tracks_json.get("data", [])
-
-        # Extract cover URL
-        cover_url = (
-            album_json.get("cover_xl")
-            or album_json.get("cover_big")
-            or album_json.get("cover_medium")
-            or f"https://e-cdns-images.dzcdn.net/images/cover/{album_json.get('md5_image', '')}/1200x0-000000-100-0-0.jpg"
-        )
+        for task in tasks:
+            result = await task
+            results.append(result)
+            try:
+                if result is not None:
+                    await on_result(result)
+            finally:
+                slots.release()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Cancelled downloads stop writing before the caller cleans up
+        for task in tasks:
+            await wait_through_cancel(task)
+    return results
 
-        # Fetch cover image data
-        cover_response = requests.get(cover_url, stream=True)
-        cover_response.raise_for_status()
-        cover_data = cover_response.content
 
-        # Extract album metadata
-        release_date_str = album_json.get("release_date", "0000-00-00")
-        try:
-            year = release_date_str.split("-")[0]
-            release_date_formatted = "/".join(reversed(release_date_str.split("-")))
-        except:
-            year = "0000"
-            release_date_formatted = "00/00/0000"
-
-        album_title = album_json.get("title", f"Album {album_id}")
-        artist_name = album_json.get("artist", {}).get("name", "Unknown Artist")
-        album_link = album_json.get("link", "")
-
-        # Clean names for file system use
-        clean_artist = clean_filename(artist_name)
-        clean_album_title = clean_filename(album_title)
-
-        # Prepare metadata dictionary
-        metadata = {
-            "id": album_id,
-            "title": album_title,  # Album title
-            "artist": artist_name,  # Main album artist
-            "release_date": release_date_formatted,
-            "year": year,
-            "album_link": album_link,
-            "track_link": None,  # No single track link for album
-            "cover_data": cover_data,
-            "api_json": album_json,
-            "tracks_api_data": tracks_data,  # List of track dicts from API
-            # For zip naming/structure
-            "clean_artist": clean_artist,
-            "clean_album_title": clean_album_title,
-            "clean_title": clean_album_title,  # Use album title for clean_title contextually
-        }
-        print(f"Fetched metadata for album {album_id}: {artist_name} - {album_title}")
-        return metadata
-
-    except requests.exceptions.RequestException as e:
-        print(f"Network error fetching metadata for album {album_id}: {e}")
-        raise
-    except Exception as e:
-        print(f"Error processing metadata for album {album_id}: {e}")
-        raise
+async def download_album(album: Album, download_dir: Path, on_track=None):
+    """
+    Downloads all tracks of an album into download_dir, with per-track retries.
+    Returns the downloaded tracks, in album order.
+    `on_track` (a coroutine function) receives each downloaded track in album order as soon
+    as the previous ones are done, the downloads staying at most ALBUM_REORDER_BUFFER ahead.
+    """
+    quality = await reserve_download_space(
+        [track.data for track in album.tracks], f"album {album.id}"
+    )
+    await resolve_song_urls([track.data for track in album.tracks], quality)
 
+    async def download_or_skip(track):
+        try:
+            return await download_track(track, download_dir, quality)
+        except Exception:
+            return None  # Already reported, send the other tracks anyway
+
+    # Each track is its own scheduler unit, so big albums interleave with
+    # other users' requests instead of holding the workers
+    units = [
+        run_unit(functools.partial(download_or_skip, track)) for track in album.tracks
+    ]
+    if on_track is None:
+        results = await asyncio.gather(*units)
+    else:
+        results = await gather_in_order(units, on_track, ALBUM_REORDER_BUFFER)
 
-def make_audio_thumbnail(cover_data: bytes) -> bytes | None:
-    """Build a Telegram-compliant audio thumbnail from cover bytes.
+    downloaded_tracks = [track for track in results if track is not None]
+    if not downloaded_tracks:
+        # Raising an exception here will be caught by the handler's main try/except
+        raise Exception(
+            f"Failed to download any tracks for album {album.id} after retries."
+        )
 
-    Telegram's server-side extraction of embedded album art is unreliable
-    (it intermittently shows no cover for some tracks), so we pass an explicit
-    thumbnail. Telegram requires it to be JPEG, <= 320x320 and < 200 kB."""
-    if not cover_data:
-        return None
-    try:
-        img = Image.open(BytesIO(cover_data))
-        img.thumbnail((320, 320))
-        buf = BytesIO()
-        img.convert("RGB").save(buf, format="JPEG", quality=85)
-        return buf.getvalue()
-    except Exception as e:
-        print(f"Warning: could not build audio thumbnail: {e}")
-        return None
+    print(
+        f"Successfully downloaded {len(downloaded_tracks)} out of {len(album.tracks)} tracks for album {album.id} to {download_dir}"
+    )
+    return downloaded_tracks
 
 
-def get_track_caption(metadata):
+def get_track_caption(album: Album):
     """Generates caption for a single track using imported __ function."""
+    track = album.tracks[0]
     return (
         "<b>Track: {title}</b>\n"
         "{artist} - {release_date}\n"
         '<a href="{album_link}">' + __("album_link") + "</a>\n"
         '<a href="{track_link}">' + __("track_link") + "</a>"
-    ).format(**metadata)
+    ).format(
+        title=track.title,
+        artist=track.artist,
+        release_date=album.release_date_text,
+        album_link=album.link,
+        track_link=track.link,
+    )
 
 
-def get_album_caption(metadata):
+def get_album_caption(album: Album):
     """Generates caption for an album using imported __ function."""
     return (
         "<b>Album: {title}</b>\n"
         "{artist} - {release_date}\n"
         '<a href="{album_link}">' + __("album_link") + "</a>"
-    ).format(**metadata)
+    ).format(
+        title=album.title,
+        artist=album.artist,
+        release_date=album.release_date_text,
+        album_link=album.link,
+    )
+
+
+def get_caption(album: Album):
+    return get_album_caption(album) if album.is_album else get_track_caption(album)
 
 
 def get_user_infos(event: types.Message):
@@ -626,36 +558,62 @@ def get_user_infos(event: types.Message):
     return user_id, username, first_name
 
 
-async def send_track_audio(event: types.Message, metadata, dl_track_info):
+async def load_cover(album: Album) -> bytes | None:
+    """Downloads the album cover once, the file tags reuse it from the cache."""
+    if album.cover is None and album.picture_id:
+        try:
+            album.cover = await asyncio.to_thread(downloadpicture, album.picture_id)
+        except Exception as e:
+            print(f"Warning: could not download cover of album {album.id}: {e}")
+    return album.cover
+
+
+async def send_cover(event: types.Message, album: Album):
+    """Sends the cover photo with the caption (the caption alone without cover)."""
+    cover = await load_cover(album)
+    if cover:
+        await event.answer_photo(
+            BufferedInputFile(cover, filename="cover.jpg"),
+            caption=get_caption(album),
+            parse_mode="HTML",
+        )
+    else:
+        await event.answer(
+            get_caption(album), parse_mode="HTML", disable_web_page_preview=True
+        )
+
+
+def cancel_tasks(*tasks):
+    """Cancels the helper tasks of a handler that no longer waits for them."""
+    for task in tasks:
+        if task is None:
+            continue
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()  # Already handled through the main error
+
+
+async def send_track_audio(event: types.Message, album: Album, cover_sent=False):
     """Sends a single track as an audio file."""
     user_id, username, first_name = get_user_infos(event)
     print(
         f"USER_DEBUG: Sending track audio to user_id={user_id} username={username} first_name={first_name}"
     )
 
-    title = metadata.get("title", dl_track_info["song_name"])
-    caption = get_track_caption(metadata)
-    song_path = dl_track_info["song_path"]
-    duration = get_audio_duration(song_path)
-    performer = ", ".join(metadata.get("artists_list", [metadata["artist"]]))
-    thumb_data = make_audio_thumbnail(metadata.get("cover_data"))
+    track = album.tracks[0]
+    duration = await track.resolve_duration()
+    thumb_data = await audio_thumbnail(await load_cover(album))
 
-    if SEND_ALBUM_COVER:
+    if SEND_ALBUM_COVER and not cover_sent:
         # Send cover photo first
-        await event.answer_photo(
-            BufferedInputFile(metadata["cover_data"], filename="cover.jpg"),
-            caption=caption,
-            parse_mode="HTML",
-        )
+        await send_cover(event, album)
 
     # Send audio file
     await event.answer_audio(
-        FSInputFile(
-            song_path,
-            filename=f"{clean_filename(performer)} - {clean_filename(title)}{dl_track_info['file_extension']}",
-        ),
-        title=metadata["title"],
-        performer=performer,
+        input_file(track.path, filename=track.filename),
+        title=track.title,
+        performer=track.artist,
         duration=duration,
         thumbnail=BufferedInputFile(thumb_data, filename="thumb.jpg")
         if thumb_data
@@ -664,175 +622,275 @@ async def send_track_audio(event: types.Message, metadata, dl_track_info):
     )
 
 
-async def send_album_audio(event: types.Message, metadata, dl_tracks_info):
+async def send_album_audio(
+    event: types.Message, album: Album, tracks, cover_sent=False
+):
     """Sends album tracks as audio files (individually or as media group)."""
     user_id, username, first_name = get_user_infos(event)
     print(
         f"USER_DEBUG: Sending album audio to user_id={user_id} username={username} first_name={first_name}"
     )
 
-    caption = get_album_caption(metadata)
-
     # All tracks of an album share the same cover, so build the thumbnail once.
-    thumb_data = make_audio_thumbnail(metadata.get("cover_data"))
+    thumb_data = await audio_thumbnail(await load_cover(album))
 
-    if SEND_ALBUM_COVER:
+    if SEND_ALBUM_COVER and not cover_sent:
         # Send cover photo first
-        await event.answer_photo(
-            BufferedInputFile(metadata["cover_data"], filename="cover.jpg"),
-            caption=caption,
-            parse_mode="HTML",
-        )
+        await send_cover(event, album)
 
-    # Map API track data to downloaded files (using SNG_ID if available)
-    api_tracks_by_id = {
-        str(t.get("id", "")): t for t in metadata.get("tracks_api_data", [])
-    }
     media_group = []
-    processed_files = []
-
-    # Sort downloaded tracks based on track number if available
-    try:
-        dl_tracks_info.sort(
-            key=lambda t: int(t.get("TRACK_NUMBER", "999"))
-            if str(t.get("TRACK_NUMBER", "999")).isdigit()
-            else 999
-        )
-    except Exception as sort_e:
-        print(
-            f"Warning: Could not sort tracks by track number for sending. Error: {sort_e}"
-        )
-
-    for dl_info in dl_tracks_info:
-        song_path = dl_info["song_path"]
-        # Try to find matching API data for better titles/artists
-        # Extract potential ID from filename if SNG_ID wasn't stored reliably
-        potential_id = Path(song_path).stem  # e.g., '12345' from '12345.flac'
-        api_track = api_tracks_by_id.get(dl_info.get("SNG_ID")) or api_tracks_by_id.get(
-            potential_id
-        )
-
-        # The album API endpoints don't expose per-track contributors, so the
-        # artist string built during download (from the website ARTISTS array,
-        # incl. featured artists) is authoritative. Only the title benefits
-        # from the API data.
-        title = api_track.get("title", dl_info["song_name"]) if api_track else dl_info["song_name"]
-        performer = dl_info["artist_name"]
-
-        duration = get_audio_duration(song_path)
-        file_input = FSInputFile(song_path)  # Use FSInputFile for media group
+    durations = []
 
+    # Tracks are in album order
+    for track in tracks:
+        duration = await track.resolve_duration()
+        durations.append(duration)
         media_item = InputMediaAudio(
-            media=file_input,
-            filename=f"{clean_filename(performer)} - {clean_filename(title)}{dl_info['file_extension']}",
-            title=title,
-            performer=performer,
+            media=input_file(track.path, filename=track.filename),
+            filename=track.filename,
+            title=track.title,
+            performer=track.artist,
             duration=duration,
             thumbnail=BufferedInputFile(thumb_data, filename="thumb.jpg")
             if thumb_data
             else None,
         )
         media_group.append(media_item)
-        processed_files.append(
-            {
-                "path": song_path,
-                "title": title,
-                "performer": performer,
-                "duration": duration,
-                "extension": dl_info["file_extension"],
-            }
-        )
 
-    # Try sending as media group (2-10 items)
-    if 2 <= len(media_group) <= 10:
-        try:
-            print(
-                f"Attempting to send album {metadata['id']} as media group ({len(media_group)} items)"
-            )
-            await event.answer_media_group(media_group, disable_notification=True)
-            print("Media group sent successfully.")
-            return  # Done if media group works
-        except Exception as e:
-            print(f"Failed to send as media group, sending individually: {e}")
-            # Fallback to individual sending below if media group fails
+    # Consecutive media groups of 2-10 items, in order
+    for start, end in split_media_groups(len(media_group)):
+        if end - start >= 2:
+            try:
+                print(
+                    f"Attempting to send album {album.id} tracks {start + 1}-{end} as media group"
+                )
+                await event.answer_media_group(
+                    media_group[start:end], disable_notification=True
+                )
+                print("Media group sent successfully.")
+                continue  # Next group if media group works
+            except Exception as e:
+                print(f"Failed to send as media group, sending individually: {e}")
+                # Fallback to individual sending of this group below
+
+        # Send individually if media group failed or not applicable
+        for i in range(start, end):
+            track = tracks[i]
+            try:
+                print(
+                    f"USER_DEBUG: Sending individual track {i + 1}/{len(tracks)} to user_id={user_id} username={username} first_name={first_name}"
+                )
+                await event.answer_audio(
+                    input_file(track.path, filename=track.filename),
+                    title=track.title,
+                    performer=track.artist,
+                    duration=durations[i],
+                    thumbnail=BufferedInputFile(thumb_data, filename="thumb.jpg")
+                    if thumb_data
+                    else None,
+                    disable_notification=True,
+                )
+            except Exception as e:
+                print(f"Error sending individual track {track.title}: {e}")
+                await event.answer(f"⚠️ Error sending track: {track.title}")
+
 
-    # Send individually if media group failed or not applicable
+def split_media_groups(count: int):
+    """
+    Splits `count` items into consecutive (start, end) ranges of at most
+    MEDIA_GROUP_MAX_SIZE items, as even as possible so that no group is
+    left with a single item (which can't be sent as a media group).
+    """
+    if count == 0:
+        return []
+    num_groups = -(-count // MEDIA_GROUP_MAX_SIZE)  # Ceiling division
+    size, extra = divmod(count, num_groups)
+    ranges = []
+    start = 0
+    for i in range(num_groups):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+async def stream_album_audio(
+    event: types.Message, album: Album, download_dir: Path, cover_task=None
+):
+    """
+    Downloads an album and sends each track as soon as it and the previous
+    ones are downloaded, instead of waiting for the whole album. The first
+    track waits for the cover, fetched meanwhile.
+    """
+    user_id, username, first_name = get_user_infos(event)
     print(
-        f"Sending album {metadata['id']} tracks individually ({len(processed_files)} items)"
+        f"USER_DEBUG: Streaming album audio to user_id={user_id} username={username} first_name={first_name}"
     )
-    for i, item in enumerate(processed_files):
+    sending = {}
+
+    async def send_track(track):
+        if not sending:
+            if cover_task is not None:
+                await cover_task
+            sending["thumb_data"] = await audio_thumbnail(await load_cover(album))
+        thumb_data = sending["thumb_data"]
         try:
-            print(
-                f"USER_DEBUG: Sending individual track {i + 1}/{len(processed_files)} to user_id={user_id} username={username} first_name={first_name}"
-            )
-            # Use BufferedInputFile for individual sending to avoid potential issues with FSInputFile reuse
-            with open(item["path"], "rb") as f:
-                audio_data = f.read()
             await event.answer_audio(
-                BufferedInputFile(
-                    audio_data,
-                    filename=f"{clean_filename(item['performer'])} - {clean_filename(item['title'])}{item['extension']}",
-                ),
-                title=item["title"],
-                performer=item["performer"],
-                duration=item["duration"],
+                input_file(track.path, filename=track.filename),
+                title=track.title,
+                performer=track.artist,
+                duration=await track.resolve_duration(),
                 thumbnail=BufferedInputFile(thumb_data, filename="thumb.jpg")
                 if thumb_data
                 else None,
                 disable_notification=True,
             )
-            await asyncio.sleep(0.2)  # Small delay between messages
         except Exception as e:
-            print(f"Error sending individual track {item['title']}: {e}")
-            await event.answer(f"⚠️ Error sending track: {item['title']}")
+            print(f"Error sending streamed track {track.title}: {e}")
+            await event.answer(f"⚠️ Error sending track: {track.title}")
+        # Sent tracks no longer need their disk space
+        Path(track.path).unlink(missing_ok=True)
 
+    return await download_album(album, download_dir, on_track=send_track)
 
-async def create_and_send_zip(
-    event: types.Message, metadata, dl_tracks_info, is_album: bool
-):
+
+class ZipProgress:
+    """
+    Status message showing how much of the files are zipped, sent once
+    zipping takes a while and edited as it goes.
+    """
+
+    def __init__(self, event: types.Message, files_to_zip):
+        self.event = event
+        self.total = sum(
+            Path(src).stat().st_size for src in files_to_zip if Path(src).exists()
+        )
+        self.zipped = 0  # In the parts already written
+        self.message = None
+        self.text = None
+
+    def part_done(self, part_files):
+        self.zipped += sum(
+            Path(src).stat().st_size for src, _ in part_files if Path(src).exists()
+        )
+
+    async def report(self, done, _total):
+        percent = min(99, (self.zipped + done) * 100 // max(1, self.total))
+        text = __("zipping").format(percent)
+        if text == self.text:
+            return
+        self.text = text
+        if self.message is None:
+            self.message = await self.event.answer(text)
+        else:
+            await self.message.edit_text(text)
+
+    async def close(self):
+        if self.message is not None:
+            try:
+                await self.message.delete()
+            except Exception as e:
+                print(f"Could not delete zip progress message: {e}")
+            self.message = None
+
+
+def copy_zip_name(album: Album) -> str:
+    """
+    File name of the zip of a release in copy mode, the same for every
+    request of the release so a published zip can be handed out again.
+    """
+    # Named after the album, or after the track for a single track
+    if album.is_album:
+        name_artist, name_title = album.artist, album.title
+    else:
+        name_artist, name_title = album.tracks[0].artist, album.tracks[0].title
+    md5_hash = hashlib.md5(
+        f"{name_artist} - {name_title} [{album.year}]".encode()
+    ).hexdigest()[:8]
+    # Use clean names for the zip filename itself
+    base_zip_name = (
+        f"{unidecode(clean_filename(name_artist))} - "
+        f"{unidecode(clean_filename(name_title))} ({md5_hash})"
+    )
+    return re.sub(r"[^.a-zA-Z0-9()_-]", "_", base_zip_name) + ".zip"
+
+
+async def send_zip_cover(event: types.Message, album: Album):
+    """Cover and caption sent before a zip or its link."""
+    try:
+        await send_cover(event, album)
+    except Exception as photo_e:
+        print(f"Error sending cover photo: {photo_e}")
+        # Send caption anyway if photo fails
+        await event.answer(
+            f"⚠️ Could not send cover image.\n{get_caption(album)}", parse_mode="HTML"
+        )
+
+
+async def send_zip_link(event: types.Message, storage, zip_name: str):
+    file_link = await storage.link(zip_name)
+    await event.answer(f"Download link: {file_link}")
+    print(f"Sent download link: {file_link}")
+
+
+async def send_cached_zip(event: types.Message, album: Album) -> bool:
+    """
+    In copy mode, send the link to the zip of this release if a complete one
+    is already published, instead of downloading it again.
+    """
+    storage = get_zip_storage()
+    if storage is None or os.environ.get("FORMAT") != "zip":
+        return False
+    zip_name = copy_zip_name(album)
+    try:
+        found = await storage.lookup(zip_name)
+    except Exception as e:
+        print(f"Zip cache lookup failed for {zip_name}: {e}")
+        return False
+    if not found:
+        return False
+    user_id, username, first_name = get_user_infos(event)
+    print(
+        f"USER_DEBUG: Sending cached zip link to user_id={user_id} username={username} first_name={first_name}"
+    )
+    await send_zip_cover(event, album)
+    await send_zip_link(event, storage, zip_name)
+    return True
+
+
+async def create_and_send_zip(event: types.Message, album: Album, tracks):
     """
     Creates a zip archive (single or multipart) and sends it.
     Handles both copying to a path and sending directly to Telegram.
     Places files inside 'Artist - Album [Year]' directory within the zip.
     """
+    is_album = album.is_album
     user_id, username, first_name = get_user_infos(event)
     print(
         f"USER_DEBUG: Creating and sending zip to user_id={user_id} username={username} first_name={first_name} is_album={is_album}"
     )
-    # Determine source directory (assuming all tracks are in the same dir)
-    if not dl_tracks_info:
+    if not tracks:
         raise ValueError("No downloaded tracks provided for zipping.")
-
-    # Ensure all track dicts have 'download_dir' before accessing it
-    source_dir_str = None
-    for track in dl_tracks_info:
-        if "download_dir" in track:
-            source_dir_str = track["download_dir"]
-            break
-    if not source_dir_str:
-        raise ValueError(
-            "Could not determine source directory from downloaded tracks info."
-        )
-    source_dir = Path(source_dir_str)
+    # Tracks are downloaded to their own directory in the download directory
+    source_dir = Path(tracks[0].path).parent.parent
 
     cover_path = source_dir / "cover.jpg"  # Standardized cover name
 
     # Write cover data to the source directory
-    try:
-        with open(cover_path, "wb") as f:
-            f.write(metadata["cover_data"])
-    except IOError as e:
-        print(f"Error writing cover file {cover_path}: {e}")
-        cover_path = None  # Proceed without cover
-    except TypeError as e:
-        print(
-            f"Error with cover data type: {e}. Cover data: {metadata.get('cover_data')}"
-        )
-        cover_path = None  # Proceed without cover
+    cover = await load_cover(album)
+    if cover:
+        try:
+            with open(cover_path, "wb") as f:
+                f.write(cover)
+        except IOError as e:
+            print(f"Error writing cover file {cover_path}: {e}")
+            cover_path = None  # Proceed without cover
+    else:
+        cover_path = None
 
     # --- Prepare Zip Contents ---
     internal_dir_name = clean_filename(
-        f"{metadata['clean_artist']} - {metadata['clean_album_title']} [{metadata['year']}]"
+        f"{clean_filename(album.artist)} - {clean_filename(album.title)} [{album.year}]"
     )
     files_to_zip = {}  # {source_path: destination_in_zip}
 
@@ -841,280 +899,109 @@ async def create_and_send_zip(
     else:
         print("Cover file not available or not written, skipping inclusion in zip.")
 
-    # Sort tracks by track number before adding to zip
-    try:
-        dl_tracks_info.sort(
-            key=lambda t: int(t.get("TRACK_NUMBER", "999"))
-            if str(t.get("TRACK_NUMBER", "999")).isdigit()
-            else 999
-        )
-    except Exception as sort_e:
-        print(
-            f"Warning: Could not sort tracks by track number for zipping. Proceeding in potentially unsorted order. Error: {sort_e}"
-        )
+    # Tracks are in album order
+    for i, track in enumerate(tracks):
+        # Fallback to index if track number missing/invalid
+        track_num_str = str(track.track_number or i + 1).zfill(2)
 
-    for i, track in enumerate(dl_tracks_info):
-        track_num_val = track.get("TRACK_NUMBER")
-        track_num_str = (
-            str(track_num_val).zfill(2)
-            if track_num_val and str(track_num_val).isdigit()
-            else str(i + 1).zfill(
-                2
-            )  # Fallback to index if track number missing/invalid
-        )
-        # Try to get artist/title from API metadata if available, fallback to download info
-        api_track = None
-        if "tracks_api_data" in metadata:
-            api_tracks_by_id = {
-                str(t.get("id", "")): t for t in metadata.get("tracks_api_data", [])
-            }
-            potential_id = Path(track.get("song_path", "")).stem
-            api_track = api_tracks_by_id.get(
-                track.get("SNG_ID")
-            ) or api_tracks_by_id.get(potential_id)
-
-        if api_track:
-            title = api_track.get(
-                "title", track.get("song_name", f"Track {track_num_str}")
-            )
-            artists = [c["name"] for c in api_track.get("contributors", [])]
-            if not artists:
-                artists = [metadata.get("artist", "Unknown Artist")]
-            artist_name = ", ".join(artists)
-        else:  # Fallback to info from download step
-            title = track.get("song_name", f"Track {track_num_str}")
-            artist_name = track.get("artist_name", "Unknown Artist")
-
-        file_extension = track.get("file_extension")
-        song_path = track.get("song_path")
-
-        if not song_path or not Path(song_path).exists():
+        if not track.path or not Path(track.path).exists():
             print(
-                f"Warning: Missing or non-existent 'song_path' for track {i} ('{title}'), skipping zip inclusion."
+                f"Warning: Missing or non-existent 'song_path' for track {i} ('{track.title}'), skipping zip inclusion."
             )
             continue
 
         # Use cleaned names for the file inside the zip
         file_name_inside_zip = clean_filename(
-            f"{track_num_str} - {artist_name} - {title}{file_extension}"
+            f"{track_num_str} - {track.artist} - {track.title}{track.file_extension}"
         )
         destination_path = f"{internal_dir_name}/{file_name_inside_zip}"
-        files_to_zip[song_path] = destination_path
-        print(f"[Zip Prep] Mapping {song_path} -> {destination_path}")
+        files_to_zip[track.path] = destination_path
+        print(f"[Zip Prep] Mapping {track.path} -> {destination_path}")
 
     # --- Handle Copy Mode vs Direct Send Mode ---
-    # Use album title for hash/naming if it's an album, otherwise track title
-    base_name_title = (
-        metadata["title"] if is_album else metadata["title"]
-    )  # Already correct contextually
-    final_title_for_hash = (
-        f"{metadata['artist']} - {base_name_title} [{metadata['year']}]"
+    # Named after the album, or after the track for a single track
+    name_artist, name_title = (
+        (album.artist, album.title) if is_album else (tracks[0].artist, tracks[0].title)
     )
-    caption = get_album_caption(metadata) if is_album else get_track_caption(metadata)
+    clean_artist, clean_title = clean_filename(name_artist), clean_filename(name_title)
 
-    try:
-        # Send cover photo before zip/link
-        await event.answer_photo(
-            BufferedInputFile(metadata["cover_data"], filename="cover.jpg"),
-            caption=caption,
-            parse_mode="HTML",
-        )
-    except Exception as photo_e:
-        print(f"Error sending cover photo: {photo_e}")
-        # Send caption anyway if photo fails
-        await event.answer(
-            f"⚠️ Could not send cover image.\n{caption}", parse_mode="HTML"
-        )
+    await send_zip_cover(event, album)
 
-    if COPY_FILES_PATH and FILE_LINK_TEMPLATE:
+    storage = get_zip_storage()
+    if storage is not None:
         # --- Copy Mode ---
         print("Using Copy Mode for Zip")
-        md5_hash = hashlib.md5(final_title_for_hash.encode()).hexdigest()[:8]
-        # Use clean names for the zip filename itself
-        base_zip_name = f"{unidecode(metadata['clean_artist'])} - {unidecode(metadata['clean_title'])} ({md5_hash})"
-        safe_base_name = re.sub(r"[^.a-zA-Z0-9()_-]", "_", base_zip_name)
-        final_zip_path = Path(COPY_FILES_PATH) / f"{safe_base_name}.zip"
-        final_zip_path.parent.mkdir(parents=True, exist_ok=True)
-
-        print(f"Creating zip file at: {final_zip_path}")
+        zip_name = copy_zip_name(album)
+        # Only a zip of the whole release is handed out to the next requests
+        complete = len(tracks) == len(album.tracks) and all(
+            track.path in files_to_zip for track in tracks
+        )
+        progress = ZipProgress(event, files_to_zip)
         try:
-            with ZipFile(final_zip_path, "w", ZIP_DEFLATED) as zipf:
-                for src, dest in files_to_zip.items():
-                    if Path(src).exists():
-                        zipf.write(src, dest)
-                        print(f"  Adding {src} as {dest}")
-                    else:
-                        print(f"  Warning: Source file not found, skipping: {src}")
-
-            file_link = FILE_LINK_TEMPLATE.format(quote(final_zip_path.name))
+            await storage.publish(
+                zip_name,
+                list(files_to_zip.items()),
+                complete,
+                progress.report,
+                current_cancel_event(),
+            )
+            await progress.close()
+
             print(
                 f"USER_DEBUG: Sending download link to user_id={user_id} username={username} first_name={first_name}"
             )
-            await event.answer(f"Download link: {file_link}")
-            print(f"Sent download link: {file_link}")
+            await send_zip_link(event, storage, zip_name)
 
-        except Exception as e:
-            print(f"Error creating zip in copy mode: {e}")
+        except BaseException as e:
+            print(f"Error creating zip in copy mode: {e!r}")
+            await progress.close()
+            if not isinstance(e, Exception):
+                raise
             await event.answer(f"❌ Error creating zip file: {e}")
-            if final_zip_path.exists():
-                try:
-                    final_zip_path.unlink()
-                except OSError:
-                    pass
 
     else:
         # --- Direct Send Mode ---
         print("Using Direct Send Mode for Zip")
-        max_size_bytes = (
-            48 * 1024 * 1024
-        )  # Telegram's limit is 50MB, use 48MB as buffer
+        # Keep a 2MB buffer below the upload limit (50MB, 2000MB with a local Bot API server)
+        max_size_bytes = (MAX_UPLOAD_MB - 2) * 1024 * 1024
         total_size = sum(
             Path(f).stat().st_size for f in files_to_zip if Path(f).exists()
         )
-        # Use clean names for the temporary zip file base name
-        output_base_path = Path(TMP_DIR) / clean_filename(
-            f"{metadata['clean_artist']} - {metadata['clean_title']} [{metadata['year']}]"
-        )
-        zip_files_created = []
+        # Use clean names for the zip file names
+        zip_base_name = clean_filename(f"{clean_artist} - {clean_title} [{album.year}]")
 
         if not files_to_zip:
             print("No valid files found to add to the zip archive.")
             await event.answer("❌ No files could be added to the zip archive.")
             return  # Exit if nothing to zip
 
-        if total_size <= max_size_bytes:
-            # --- Single Zip File ---
-            zip_path = Path(f"{output_base_path}.zip")
-            print(
-                f"Creating single zip: {zip_path} (Total size: {total_size / (1024 * 1024):.2f} MB)"
-            )
-            try:
-                with ZipFile(zip_path, "w", ZIP_DEFLATED) as zipf:
-                    for src, dest in files_to_zip.items():
-                        if Path(src).exists():
-                            zipf.write(src, dest)
-                        else:
-                            print(f"  Warning: Source file not found, skipping: {src}")
-                zip_files_created.append(zip_path)
-            except Exception as e:
-                print(f"Error creating single zip: {e}")
-                await event.answer(f"❌ Error creating zip file: {e}")
-
-        else:
-            # --- Multi-part Zip ---
-            num_parts = math.ceil(total_size / max_size_bytes)
-            print(
-                f"Creating multi-part zip ({num_parts} parts estimate, Total size: {total_size / (1024 * 1024):.2f} MB)"
+        # Laid out before writing anything, in as few parts as possible
+        parts, left_out = plan_zip_parts(list(files_to_zip.items()), max_size_bytes)
+        if left_out:
+            print(f"Warning: {len(left_out)} files could not be added to any zip part.")
+            await event.answer(
+                "⚠️ Too big to be sent: "
+                + ", ".join(Path(dest).name for _, dest in left_out)
             )
-            # Use the sorted list of (src, dest) items from files_to_zip dictionary
-            files_remaining = list(files_to_zip.items())
-            current_part = 1
-
-            while files_remaining:
-                zip_path = Path(f"{output_base_path}_part{current_part}.zip")
-                current_zip_size = 0
-                files_in_this_part = []
-                indices_processed_in_part = set()  # Track indices added to this part
-
-                try:
-                    with ZipFile(zip_path, "w", ZIP_DEFLATED) as zipf:
-                        # Iterate through remaining files to fill the current part
-                        for idx, (src, dest) in enumerate(files_remaining):
-                            if not Path(src).exists():
-                                print(f"  Skipping non-existent file: {src}")
-                                indices_processed_in_part.add(
-                                    idx
-                                )  # Mark as processed (skipped)
-                                continue
-
-                            file_size = Path(src).stat().st_size
-                            # Check if file itself is too large (should ideally not happen with audio)
-                            if file_size > max_size_bytes:
-                                print(
-                                    f"Error: File {src} ({file_size / (1024 * 1024):.2f} MB) exceeds max part size {max_size_bytes / (1024 * 1024):.2f} MB. Skipping."
-                                )
-                                indices_processed_in_part.add(
-                                    idx
-                                )  # Mark as processed (skipped)
-                                continue
-
-                            # Check if adding this file exceeds the limit for *this* part
-                            if current_zip_size + file_size <= max_size_bytes:
-                                zipf.write(src, dest)
-                                current_zip_size += file_size
-                                files_in_this_part.append((src, dest))
-                                indices_processed_in_part.add(
-                                    idx
-                                )  # Mark as added to this part
-                            else:
-                                # Cannot add this file to the current part, leave for the next
-                                continue
-
-                    # After iterating through all remaining files for the current part:
-                    if files_in_this_part:  # Only save the zip if files were added
-                        zip_files_created.append(zip_path)
-                        print(
-                            f"  Created part {current_part}: {zip_path.name} (Size: {current_zip_size / (1024 * 1024):.2f} MB, {len(files_in_this_part)} files)"
-                        )
-                    else:
-                        # If no files could be added (e.g., next file is too large), delete empty zip
-                        print(
-                            f"  Warning: Part {current_part} was not created (no files added)."
-                        )
-                        if zip_path.exists():
-                            zip_path.unlink()
-                        # Safety break: if no files were added and there are still files remaining, something is wrong
-                        if files_remaining and not indices_processed_in_part:
-                            print("Error: Stuck in multi-part zip creation. Aborting.")
-                            break
-
-                    # Remove the processed files from files_remaining *after* the loop
-                    # Iterate backwards to avoid index issues
-                    new_files_remaining = []
-                    for idx, item in enumerate(files_remaining):
-                        if idx not in indices_processed_in_part:
-                            new_files_remaining.append(item)
-                    files_remaining = new_files_remaining
-
-                    if not files_remaining:
-                        break  # All files processed
-
-                    current_part += 1
-                    # Safety break: prevent infinite loops if something goes wrong
-                    if current_part > num_parts * 1.5 + 1:  # Allow some leeway
-                        print(
-                            f"Error: Exceeded expected number of parts ({num_parts}). Aborting multi-part zip."
-                        )
-                        break
+        if not parts:
+            print("No zip files were created or finalized to send.")
+            await event.answer("❌ Failed to create any zip files.")
+            return
 
-                except Exception as e:
-                    print(f"Error creating zip part {current_part}: {e}")
-                    await event.answer(
-                        f"❌ Error creating zip part {current_part}: {e}"
-                    )
-                    if zip_path.exists():
-                        try:
-                            zip_path.unlink()
-                        except OSError:
-                            pass
-                    # Stop creating further parts if one fails critically
-                    break
-
-            # After loop, check if any files were left unprocessed
-            if files_remaining:
-                print(
-                    f"Warning: {len(files_remaining)} files could not be added to any zip part."
+        # --- Send Zip Files ---
+        # Each zip is written while it is uploaded, it never touches the disk
+        print(
+            f"Sending {len(parts)} zip file(s) (Total size: {total_size / (1024 * 1024):.2f} MB)..."
+        )
+        progress = ZipProgress(event, files_to_zip)
+        try:
+            num_sent = len(parts)
+            for idx, part_files in enumerate(parts):
+                zip_name = (
+                    f"{zip_base_name}_part{idx + 1}.zip"
+                    if num_sent > 1
+                    else f"{zip_base_name}.zip"
                 )
-                for src, dest in files_remaining:
-                    print(
-                        f"  - Unadded: {src} (Size: {Path(src).stat().st_size if Path(src).exists() else 'N/A'})"
-                    )
-
-        # --- Send Created Zip Files ---
-        if zip_files_created:
-            print(f"Sending {len(zip_files_created)} zip file(s)...")
-            num_sent = len(zip_files_created)
-            for idx, zip_file in enumerate(zip_files_created):
                 try:
                     part_caption = (
                         f"Zip Archive (Part {idx + 1}/{num_sent})"
@@ -1124,31 +1011,21 @@ async def create_and_send_zip(
                     print(
                         f"USER_DEBUG: Sending zip file {idx + 1}/{num_sent} to user_id={user_id} username={username} first_name={first_name}"
                     )
+                    zip_stream = functools.partial(
+                        stream_zip, part_files, progress.report, current_cancel_event()
+                    )
                     await event.answer_document(
-                        FSInputFile(zip_file),
+                        StreamInputFile(zip_stream, filename=zip_name),
                         caption=part_caption,
                         disable_notification=True,
                     )
-                    print(f"Sent {zip_file.name}")
-                    await asyncio.sleep(0.5)  # Small delay between uploads
+                    progress.part_done(part_files)
+                    print(f"Sent {zip_name}")
                 except Exception as e:
-                    print(f"Error sending zip file {zip_file.name}: {e}")
-                    await event.answer(f"❌ Error sending file: {zip_file.name}")
-        else:
-            print("No zip files were created or finalized to send.")
-            # Avoid sending error if copy mode was used (link was sent instead)
-            if not (COPY_FILES_PATH and FILE_LINK_TEMPLATE):
-                await event.answer("❌ Failed to create any zip files.")
-
-        # --- Cleanup Temporary Zip Files ---
-        print("Cleaning up temporary zip files...")
-        for zip_file in zip_files_created:
-            if zip_file.exists():
-                try:
-                    zip_file.unlink()
-                    print(f"  Removed {zip_file.name}")
-                except OSError as e:
-                    print(f"  Error removing {zip_file.name}: {e}")
+                    print(f"Error sending zip file {zip_name}: {e}")
+                    await event.answer(f"❌ Error sending file: {zip_name}")
+        finally:
+            await progress.close()
 
 
 # --- Message Handlers ---
@@ -1172,38 +1049,48 @@ async def handle_track_link(event: types.Message, real_link=None):
         return
     track_id = track_match.group(2)
 
-    if is_downloading(user_id):
-        print(
-            f"USER_DEBUG: Rejected download request from user_id={user_id} username={username} first_name={first_name} - already downloading"
-        )
-        await event.answer(
-            __("running_download"), reply_markup=types.ReplyKeyboardRemove()
-        )
-        return
+    await enqueue_download(
+        event, "deezer_track", track_id, description=f"deezer track {track_id}"
+    )
 
-    add_downloading(user_id)
-    tmp_msg = await event.answer(__("downloading"))
 
-    download_dir_to_clean = None  # Store the path to clean up
+@job_kind("deezer_track")
+async def process_track_download(event: types.Message, track_id):
+    """Downloads and sends a Deezer track, run by the download scheduler."""
+    user_id, username, first_name = get_user_infos(event)
+    tmp_msg = await event.answer(__("downloading"), reply_markup=cancel_keyboard())
 
-    try:
-        # Download the track
-        dl_track_info = await download_track(track_id)
-        if not dl_track_info or "song_path" not in dl_track_info:
-            raise ValueError("Track download failed or did not return path.")
+    # Known upfront, so a cancelled download is cleaned up too
+    download_dir_to_clean = job_tmp_dir(
+        Path(TMP_DIR) / "deezer" / "track", str(track_id)
+    )
 
-        # Store the directory path for cleanup *after* successful download
-        if "download_dir" in dl_track_info:
-            download_dir_to_clean = Path(dl_track_info["download_dir"])
+    cover_task = None
 
-        # Fetch metadata (can happen after download)
-        metadata = get_track_metadata_from_api(track_id)
+    try:
+        album = await fetch_deezer_item(TYPE_TRACK, track_id)
+        track = album.tracks[0]
+
+        # A complete zip of this track may be published already (copy mode)
+        if not await send_cached_zip(event, album):
+            # The cover doesn't depend on the audio, send it meanwhile
+            if SEND_ALBUM_COVER and os.environ.get("FORMAT") != "zip":
+                cover_task = asyncio.create_task(send_cover(event, album))
+
+            quality = await reserve_download_space([track.data], f"track {track_id}")
+            download_dir_to_clean.mkdir(parents=True, exist_ok=True)
+            await run_unit(
+                functools.partial(download_track, track, download_dir_to_clean, quality)
+            )
 
-        # Send based on format preference
-        if os.environ.get("FORMAT") == "zip":
-            await create_and_send_zip(event, metadata, [dl_track_info], is_album=False)
-        else:
-            await send_track_audio(event, metadata, dl_track_info)
+            if cover_task is not None:
+                await cover_task
+
+            # Send based on format preference
+            if os.environ.get("FORMAT") == "zip":
+                await create_and_send_zip(event, album, album.tracks)
+            else:
+                await send_track_audio(event, album, cover_sent=cover_task is not None)
 
         await tmp_msg.delete()
         # Delete the original user message after successful processing
@@ -1216,6 +1103,15 @@ async def handle_track_link(event: types.Message, real_link=None):
         except Exception as delete_e:
             print(f"Could not delete original message: {delete_e}")
 
+    except asyncio.CancelledError:
+        print(f"USER_DEBUG: Track download cancelled by user_id={user_id}")
+        await tmp_msg.delete()
+        await event.answer(__("cancelled"))
+        raise
+    except AdmissionRejected as e:
+        print(f"USER_DEBUG: Rejected track download for user_id={user_id}: {e}")
+        await tmp_msg.delete()
+        await event.answer(__("server_busy"))
     except Exception as e:
         print(
             f"USER_DEBUG: Error processing track download for user_id={user_id} username={username} first_name={first_name}: {e}"
@@ -1226,7 +1122,7 @@ async def handle_track_link(event: types.Message, real_link=None):
         error_message = str(e) if str(e) else "An unknown error occurred."
         await event.answer(f"{__('download_error')} {error_message}")
     finally:
-        remove_downloading(user_id)
+        cancel_tasks(cover_task)
         # Cleanup the download directory if it was set
         if download_dir_to_clean and download_dir_to_clean.exists():
             try:
@@ -1256,44 +1152,55 @@ async def handle_album_link(event: types.Message, real_link=None):
         return
     album_id = album_match.group(2)
 
-    if is_downloading(user_id):
-        print(
-            f"USER_DEBUG: Rejected album download request from user_id={user_id} username={username} first_name={first_name} - already downloading"
-        )
-        await event.answer(
-            __("running_download"), reply_markup=types.ReplyKeyboardRemove()
-        )
-        return
+    await enqueue_download(
+        event,
+        "deezer_album",
+        album_id,
+        description=f"deezer album {album_id}",
+        priority=PRIORITY_BULK,
+    )
+
 
-    add_downloading(user_id)
-    tmp_msg = await event.answer(__("downloading"))
-    download_dir_to_clean = None  # Store the path to clean up
+@job_kind("deezer_album")
+async def process_album_download(event: types.Message, album_id):
+    """Downloads and sends a Deezer album, run by the download scheduler."""
+    user_id, username, first_name = get_user_infos(event)
+    tmp_msg = await event.answer(__("downloading"), reply_markup=cancel_keyboard())
+    # Known upfront, so a cancelled download is cleaned up too
+    download_dir_to_clean = job_tmp_dir(
+        Path(TMP_DIR) / "deezer" / "album", str(album_id)
+    )
+
+    cover_task = None
 
     try:
-        # Download the album tracks (with internal retries per track)
-        dl_tracks_info = await download_album(album_id)
-        if not dl_tracks_info:  # Check if *any* tracks were successfully downloaded
-            raise ValueError("Album download failed or returned no successful tracks.")
-
-        # Determine the download directory from the first successful track for cleanup
-        # All successful tracks should share the same base directory
-        if dl_tracks_info and "download_dir" in dl_tracks_info[0]:
-            download_dir_to_clean = Path(dl_tracks_info[0]["download_dir"])
+        album = await fetch_deezer_item(TYPE_ALBUM, album_id)
+        download_dir_to_clean.mkdir(parents=True, exist_ok=True)
+
+        # The cover doesn't depend on the audio, send it meanwhile
+        if SEND_ALBUM_COVER and os.environ.get("FORMAT") != "zip":
+            cover_task = asyncio.create_task(send_cover(event, album))
+
+        if await send_cached_zip(event, album):
+            # A complete zip of this album is published already (copy mode)
+            pass
+        elif STREAM_ALBUMS and os.environ.get("FORMAT") != "zip":
+            # Tracks are sent while the next ones download
+            await stream_album_audio(event, album, download_dir_to_clean, cover_task)
         else:
-            print(
-                "Warning: Could not determine download directory for cleanup from track info."
-            )
-            # Attempt to construct the expected path as a fallback
-            download_dir_to_clean = Path(TMP_DIR) / "deezer" / "album" / str(album_id)
+            # Download the album tracks (with internal retries per track)
+            tracks = await download_album(album, download_dir_to_clean)
 
-        # Fetch album metadata (can happen after download)
-        metadata = get_album_metadata_from_api(album_id)
+            if cover_task is not None:
+                await cover_task
 
-        # Send based on format preference
-        if os.environ.get("FORMAT") == "zip":
-            await create_and_send_zip(event, metadata, dl_tracks_info, is_album=True)
-        else:
-            await send_album_audio(event, metadata, dl_tracks_info)
+            # Send based on format preference
+            if os.environ.get("FORMAT") == "zip":
+                await create_and_send_zip(event, album, tracks)
+            else:
+                await send_album_audio(
+                    event, album, tracks, cover_sent=cover_task is not None
+                )
 
         await tmp_msg.delete()
         # Delete the original user message after successful processing
@@ -1306,6 +1213,15 @@ async def handle_album_link(event: types.Message, real_link=None):
         except Exception as delete_e:
             print(f"Could not delete original message: {delete_e}")
 
+    except asyncio.CancelledError:
+        print(f"USER_DEBUG: Album download cancelled by user_id={user_id}")
+        await tmp_msg.delete()
+        await event.answer(__("cancelled"))
+        raise
+    except AdmissionRejected as e:
+        print(f"USER_DEBUG: Rejected album download for user_id={user_id}: {e}")
+        await tmp_msg.delete()
+        await event.answer(__("server_busy"))
     except Exception as e:
         print(
             f"USER_DEBUG: Error processing album download for user_id={user_id} username={username} first_name={first_name}: {e}"
@@ -1316,7 +1232,7 @@ async def handle_album_link(event: types.Message, real_link=None):
         error_message = str(e) if str(e) else "An unknown error occurred."
         await event.answer(f"{__('download_error')} {error_message}")
     finally:
-        remove_downloading(user_id)
+        cancel_tasks(cover_task)
         # Cleanup the download directory if it was set or constructed
         if download_dir_to_clean and download_dir_to_clean.exists():
             try:
@@ -1410,6 +1326,8 @@ async def inline_search_handler(inline_query: InlineQuery):
     print(
         f"USER_DEBUG: Inline search from user_id={user_id} username={username} first_name={first_name} query='{query}'"
     )
+    # The user typed on, the results of their previous query are stale
+    cancel_user_prefetch(user_id)
 
     items = []
     search_type = TYPE_TRACK  # Default search type
@@ -1532,6 +1450,8 @@ async def inline_search_handler(inline_query: InlineQuery):
 
     try:
         await bot.answer_inline_query(inline_query.id, results=items, cache_time=10)
+        if PREFETCH_TOP_N > 0 and search_results:
+            schedule_prefetch(user_id, search_results)
     except Exception as e:
         # Catch potential Telegram API errors during sending results
         print(f"Error sending inline query results to Telegram: {e}")
@@ -1,21 +1,36 @@
 import asyncio
+import functools
 import io
 import os
 import traceback
 from pathlib import Path
 
+import aioshutil
 import requests
 import yt_dlp
-from PIL import Image
 from aiogram import F, types
-from aiogram.types import BufferedInputFile, FSInputFile
+from aiogram.types import BufferedInputFile
 from mutagen.id3 import ID3, error, APIC
 from mutagen.mp3 import MP3
-from yt_dlp import YoutubeDL
+from mutagen.mp4 import MP4, MP4Cover
 from aiogram import Router
 
 # Assuming utils provides these functions and constants
-from utils import __, is_downloading, add_downloading, remove_downloading, TMP_DIR
+from bot import input_file
+from dl_utils.audio_convert import AUDIO_CODECS, TranscodeScheduler
+from dl_utils.thumbnails import cropped_thumbnail
+from dl_utils.ytdlp_pool import YoutubeDLPool
+from job_queue import RUN_MODE, WORKER_PROCESSES
+from jobs import (
+    MAX_CONCURRENT_DOWNLOADS,
+    cancel_keyboard,
+    current_cancel_event,
+    enqueue_download,
+    job_kind,
+    job_tmp_dir,
+    run_unit,
+)
+from utils import __, TMP_DIR
 
 print("yt-dlp version: ", yt_dlp.version.__version__)
 
@@ -30,6 +45,38 @@ YT_PLAYER_CLIENT = [
     ).split(",")
     if c.strip()
 ]
+# Threads running yt-dlp, cancelled downloads included until they stop
+YTDLP_WORKERS = int(os.environ.get("YTDLP_WORKERS", MAX_CONCURRENT_DOWNLOADS))
+# Audio formats sent as downloaded (Telegram plays both), in order of preference.
+# Empty to always convert to YTDLP_AUDIO_CODEC.
+YTDLP_PASSTHROUGH_FORMATS = [
+    f.strip().lower()
+    for f in os.environ.get("YTDLP_PASSTHROUGH_FORMATS", "m4a,mp3").split(",")
+    if f.strip()
+]
+# What other audio formats (opus, vorbis...) are converted to
+YTDLP_AUDIO_CODEC = os.environ.get("YTDLP_AUDIO_CODEC", "mp3").lower()
+YTDLP_AUDIO_BITRATE = int(os.environ.get("YTDLP_AUDIO_BITRATE", 320))
+for audio_format in (YTDLP_AUDIO_CODEC, *YTDLP_PASSTHROUGH_FORMATS):
+    if audio_format not in AUDIO_CODECS:
+        raise ValueError(f"Telegram can't play '{audio_format}' audio (mp3 or m4a)")
+# ffmpeg processes converting audio at once, a core each, and their priority.
+# The worker processes share half the cores of the host by default.
+_ffmpeg_share = WORKER_PROCESSES if RUN_MODE == "worker" else 1
+FFMPEG_MAX_PROCESSES = int(
+    os.environ.get(
+        "FFMPEG_MAX_PROCESSES", max(1, (os.cpu_count() or 2) // 2 // _ffmpeg_share)
+    )
+)
+FFMPEG_NICE = int(os.environ.get("FFMPEG_NICE", 10))
+FFMPEG_IDLE_IO = os.environ.get("FFMPEG_IDLE_IO", "1") == "1"
+# Seconds between two log lines of the ffmpeg queue stats (0 = never)
+FFMPEG_STATS_INTERVAL = int(os.environ.get("FFMPEG_STATS_INTERVAL", 600))
+print(
+    f"yt-dlp audio: {'/'.join(YTDLP_PASSTHROUGH_FORMATS) or 'nothing'} as is, "
+    f"else {YTDLP_AUDIO_CODEC} {YTDLP_AUDIO_BITRATE}k "
+    f"({FFMPEG_MAX_PROCESSES} ffmpeg at once)"
+)
 
 # Define separate temp directories
 YT_TMP_DIR = Path(TMP_DIR, "yt")
@@ -39,17 +86,303 @@ SC_TMP_DIR = Path(TMP_DIR, "sc")
 YT_TMP_DIR.mkdir(parents=True, exist_ok=True)
 SC_TMP_DIR.mkdir(parents=True, exist_ok=True)
 
+# Shared by every site, the download directory is set per request.
+# Audio Telegram plays is picked first, so most downloads need no conversion.
+YDL_OPTIONS = {
+    "outtmpl": "%(id)s.%(ext)s",
+    "format": "/".join(
+        [f"bestaudio[ext={ext}]" for ext in YTDLP_PASSTHROUGH_FORMATS]
+        + ["bestaudio", "best"]
+    ),
+    "quiet": True,  # Suppress yt-dlp console output
+    "no_warnings": True,
+}
+
+
+class MediaSite:
+    """A site whose audio is downloaded with yt-dlp, and how its metadata reads."""
+
+    def __init__(
+        self,
+        name: str,
+        label: str,
+        tmp_dir: Path,
+        options: dict = None,
+        use_cookies: bool = False,
+        title_keys=("title",),
+        artist_keys=("uploader",),
+        show_upload_date: bool = False,
+    ):
+        self.name = name
+        self.label = label
+        self.tmp_dir = tmp_dir
+        self.options = {**YDL_OPTIONS, **(options or {})}
+        self.use_cookies = use_cookies
+        self.title_keys = title_keys
+        self.artist_keys = artist_keys
+        self.show_upload_date = show_upload_date
+
+    def title(self, dict_info) -> str:
+        return next(
+            (dict_info[k] for k in self.title_keys if dict_info.get(k)),
+            "Unknown Title",
+        )
+
+    def artist(self, dict_info) -> str:
+        return next(
+            (dict_info[k] for k in self.artist_keys if dict_info.get(k)),
+            "Unknown Artist",
+        )
+
+    def caption(self, dict_info, webpage_url) -> str:
+        if self.show_upload_date:
+            upload_date_str = "Unknown date"
+            upload_date = dict_info.get("upload_date")  # YYYYMMDD
+            if upload_date and len(upload_date) == 8:
+                upload_date_str = (
+                    f"{upload_date[6:8]}/{upload_date[4:6]}/{upload_date[0:4]}"
+                )
+            details = f"{self.artist(dict_info)} - {upload_date_str}"
+        else:
+            details = f"Artist: {self.artist(dict_info)}"
+        return (
+            '<b>Track: {}</b>\n{}\n\n<a href="{}">' + __("track_link") + "</a>"
+        ).format(self.title(dict_info), details, webpage_url)
+
+
+YOUTUBE = MediaSite(
+    "youtube",
+    "YouTube",
+    YT_TMP_DIR,
+    {"extractor_args": {"youtube": {"player_client": YT_PLAYER_CLIENT}}},
+    use_cookies=True,
+    show_upload_date=True,
+)
+# Cookies generally aren't needed for public SoundCloud tracks, and
+# SoundCloud often has 'track' and 'artist' instead of 'title' and 'uploader'
+SOUNDCLOUD = MediaSite(
+    "soundcloud",
+    "SoundCloud",
+    SC_TMP_DIR,
+    title_keys=("track", "title"),
+    artist_keys=("artist", "uploader"),
+)
+MEDIA_SITES = (YOUTUBE, SOUNDCLOUD)
+
+ydl_pool = YoutubeDLPool(YTDLP_WORKERS, COOKIES_PATH)
+transcoder = TranscodeScheduler(FFMPEG_MAX_PROCESSES, FFMPEG_NICE, FFMPEG_IDLE_IO)
+_stats_task = None
+
 
-def crop_center(pil_img, crop_width, crop_height):
-    img_width, img_height = pil_img.size
-    return pil_img.crop(
-        (
-            (img_width - crop_width) // 2,
-            (img_height - crop_height) // 2,
-            (img_width + crop_width) // 2,
-            (img_height + crop_height) // 2,
+async def warm_up_ytdlp():
+    """Build the yt-dlp instance of every site before the first request."""
+    try:
+        await ydl_pool.warm_up(
+            [(site.name, site.options, site.use_cookies) for site in MEDIA_SITES]
         )
+    except Exception as e:
+        print(f"Could not warm up yt-dlp: {e}")
+
+
+async def _log_transcode_stats():
+    logged = transcoder.metrics()
+    while True:
+        await asyncio.sleep(FFMPEG_STATS_INTERVAL)
+        metrics = transcoder.metrics()
+        # Nothing new while no conversion ran or waited
+        if metrics != logged:
+            logged = metrics
+            print(
+                f"ffmpeg stats: {metrics['running']} running, {metrics['waiting']} waiting, "
+                f"{metrics['started']} started, queue time "
+                f"avg {metrics['queue_time_avg']:.1f}s max {metrics['queue_time_max']:.1f}s"
+            )
+
+
+def start_transcode_stats():
+    """Log the ffmpeg queue stats every FFMPEG_STATS_INTERVAL seconds."""
+    global _stats_task
+    if FFMPEG_STATS_INTERVAL > 0 and _stats_task is None:
+        _stats_task = asyncio.create_task(_log_transcode_stats())
+
+
+def _fetch_thumbnail(url) -> bytes:
+    return requests.get(url).content
+
+
+async def download_audio(site: MediaSite, url: str, download_dir: Path, cancel_event):
+    """Download the audio of `url`. Returns the info dict and the audio file."""
+    dict_info = await ydl_pool.extract_info(
+        site.name,
+        site.options,
+        url,
+        download_dir,
+        cancel_event,
+        use_cookies=site.use_cookies,
+    )
+    if not dict_info:
+        return None, None
+    requested = (dict_info.get("requested_downloads") or [{}])[0]
+    location = Path(
+        requested.get("filepath")
+        or download_dir / f"{dict_info.get('id')}.{dict_info.get('ext')}"
     )
+    return dict_info, location
+
+
+async def deliverable_audio(location: Path) -> Path:
+    """The audio file to send: as is when Telegram plays it, else converted."""
+    if location.suffix.lstrip(".").lower() in YTDLP_PASSTHROUGH_FORMATS:
+        return location
+    print(f"Converting {location.name} to {YTDLP_AUDIO_CODEC}")
+    return await transcoder.transcode(location, YTDLP_AUDIO_CODEC, YTDLP_AUDIO_BITRATE)
+
+
+def tag_cover(location: Path, cover: bytes):
+    """Embed the cover in an MP3 (ID3) or M4A (MP4 atoms) file."""
+    if location.suffix.lower() == ".m4a":
+        audio = MP4(location)
+        audio["covr"] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
+        audio.save()
+        return
+    audio = MP3(location, ID3=ID3)
+    try:
+        audio.add_tags()
+    except error:
+        pass  # Ignore if tags already exist
+    if audio.tags:
+        audio.tags.add(
+            APIC(
+                mime="image/jpeg",
+                type=3,
+                desc="Cover",
+                data=cover,
+            )
+        )
+    # Add other tags if needed (e.g., title, artist)
+    # audio.tags.add(mutagen.id3.TIT2(encoding=3, text=track_title))
+    # audio.tags.add(mutagen.id3.TPE1(encoding=3, text=uploader))
+    audio.save()
+
+
+async def process_media_audio(event: types.Message, site: MediaSite):
+    """Downloads and sends the audio of a media site link."""
+    tmp_msg = await event.answer(__("downloading"), reply_markup=cancel_keyboard())
+    download_dir = None
+    try:
+        # Private to the job, so a cancelled download leaves nothing behind
+        download_dir = job_tmp_dir(site.tmp_dir, "job")
+
+        # Download file, on a pooled yt-dlp instance
+        dict_info, location = await run_unit(
+            functools.partial(
+                download_audio, site, event.text, download_dir, current_cancel_event()
+            )
+        )
+
+        if not dict_info:
+            print("No information found")
+            return
+
+        # Outside of the download unit, ffmpeg has its own queue
+        location = await deliverable_audio(location)
+
+        thumb_url = dict_info.get("thumbnail")
+        track_title = site.title(dict_info)
+        uploader = site.artist(dict_info)
+        webpage_url = dict_info.get(
+            "webpage_url", event.text
+        )  # Use original link if webpage_url is missing
+        caption = site.caption(dict_info, webpage_url)
+
+        # Get thumb
+        image_bytes = None
+        if thumb_url:
+            try:
+                content = await asyncio.to_thread(_fetch_thumbnail, thumb_url)
+                image_bytes = io.BytesIO(content)
+            except Exception as img_err:
+                print(f"Error downloading/processing {site.label} thumbnail: {img_err}")
+
+        # Send cover
+        if image_bytes:
+            try:
+                await event.answer_photo(
+                    BufferedInputFile(image_bytes.getvalue(), filename="cover.jpg"),
+                    caption=caption,
+                    parse_mode="HTML",
+                )
+                image_bytes.seek(0)  # Reset stream position for tagging
+            except Exception as photo_err:
+                print(f"Error sending {site.label} photo: {photo_err}")
+        else:
+            # Send caption as text if no thumbnail
+            await event.answer(
+                caption,
+                parse_mode="HTML",
+                disable_web_page_preview=True,
+            )
+
+        # Delete user message
+        await event.delete()
+
+        # Check if file exists
+        if not location.exists():
+            raise FileNotFoundError(f"Expected audio file not found at {location}")
+
+        # TAG audio
+        thumb_for_tagging = None
+        thumb_for_sending = None
+        if image_bytes:
+            try:
+                # Prepare thumbnail for tagging
+                thumb_for_tagging = image_bytes.getvalue()
+
+                # Create smaller thumb for sending with audio message
+                thumb_data = await cropped_thumbnail(thumb_for_tagging, 80, 80)
+                if thumb_data:
+                    thumb_for_sending = BufferedInputFile(
+                        thumb_data, filename="thumb.jpg"
+                    )
+            except Exception as thumb_proc_err:
+                print(
+                    f"Error processing {site.label} thumbnail for tagging/sending: {thumb_proc_err}"
+                )
+                thumb_for_tagging = None
+                thumb_for_sending = None
+
+        try:
+            if thumb_for_tagging:
+                tag_cover(location, thumb_for_tagging)
+        except Exception as tag_err:
+            print(f"Error tagging {site.label} audio file: {tag_err}")
+
+        # Send audio
+        await event.answer_audio(
+            input_file(location),
+            title=track_title,
+            performer=uploader,
+            # From the info dict, the file is never parsed for it
+            duration=int(dict_info.get("duration") or 0) or None,
+            thumbnail=thumb_for_sending,  # Use the prepared thumb or None
+            disable_notification=True,
+        )
+    except asyncio.CancelledError:
+        print(f"USER_DEBUG: Download cancelled by user_id={event.from_user.id}")
+        await event.answer(__("cancelled"))
+        raise
+    except yt_dlp.utils.DownloadError as dl_err:
+        print(f"yt-dlp download error ({site.label}): {dl_err}")
+        await event.answer(__("download_error_specific").format(str(dl_err)))
+    except Exception as e:
+        traceback.print_exc()
+        await event.answer(
+            __("download_error") + f"\n<code>{e}</code>", parse_mode="HTML"
+        )
+    finally:
+        await tmp_msg.delete()
+        if download_dir is not None:
+            await aioshutil.rmtree(download_dir, ignore_errors=True)
 
 
 @youtube_router.message(
@@ -64,195 +397,13 @@ async def get_youtube_audio(event: types.Message):
         return
 
     print(f"Processing YouTube link from user {event.from_user.id}")
-    if is_downloading(event.from_user.id) is False:
-        add_downloading(event.from_user.id)
-        tmp_msg = await event.answer(__("downloading"))
-        try:
-            ydl_opts = {
-                "outtmpl": str(YT_TMP_DIR / "%(id)s.%(ext)s"),  # Use YT_TMP_DIR
-                "format": "bestaudio/best",
-                "postprocessors": [
-                    {
-                        "key": "FFmpegExtractAudio",
-                        "preferredcodec": "mp3",
-                        "preferredquality": "320",
-                    }
-                ],
-                "quiet": True,  # Suppress yt-dlp console output
-                "no_warnings": True,
-                "extractor_args": {"youtube": {"player_client": YT_PLAYER_CLIENT}},
-            }
-
-            # if cookies.txt exists, use it
-            if (
-                COOKIES_PATH is not None
-                and os.path.exists(COOKIES_PATH)
-                and os.path.isfile(COOKIES_PATH)
-                and os.path.getsize(COOKIES_PATH) > 0
-            ):
-                print("Using cookies for YouTube")
-                ydl_opts["cookiefile"] = COOKIES_PATH
-
-            # Download file
-            ydl = YoutubeDL(ydl_opts)
-            # Run in executor to avoid blocking asyncio loop
-            dict_info = await asyncio.to_thread(
-                ydl.extract_info, event.text, download=True
-            )
+    await enqueue_download(event, "youtube", description="youtube audio")
 
-            if not dict_info:
-                print("No information found")
-                return
-
-            thumb_url = dict_info.get("thumbnail")
-            track_title = dict_info.get("title", "Unknown Title")
-            uploader = dict_info.get("uploader", "Unknown Artist")
-            track_id = dict_info.get("id", "unknown_id")
-            webpage_url = dict_info.get(
-                "webpage_url", event.text
-            )  # Use original link if webpage_url is missing
-
-            # Get thumb
-            image_bytes = None
-            if thumb_url:
-                try:
-                    content = requests.get(thumb_url).content
-                    image_bytes = io.BytesIO(content)
-                except Exception as img_err:
-                    print(f"Error downloading/processing thumbnail: {img_err}")
 
-            upload_date_str = "Unknown date"
-            upload_date = dict_info.get("upload_date")  # YYYYMMDD
-            if upload_date and len(upload_date) == 8:
-                try:
-                    upload_date_str = (
-                        f"{upload_date[6:8]}/{upload_date[4:6]}/{upload_date[0:4]}"
-                    )
-                except Exception:
-                    pass  # Keep default if formatting fails
-
-            # Send cover
-            if image_bytes:
-                try:
-                    await event.answer_photo(
-                        BufferedInputFile(image_bytes.getvalue(), filename="cover.jpg"),
-                        caption=(
-                            "<b>Track: {}</b>"
-                            '\n{} - {}\n\n<a href="{}">' + __("track_link") + "</a>"
-                        ).format(
-                            track_title,
-                            uploader,
-                            upload_date_str,
-                            webpage_url,
-                        ),
-                        parse_mode="HTML",
-                    )
-                    image_bytes.seek(0)  # Reset stream position for tagging
-                except Exception as photo_err:
-                    print(f"Error sending photo: {photo_err}")
-            else:
-                # Send caption as text if no thumbnail
-                await event.answer(
-                    (
-                        "<b>Track: {}</b>"
-                        '\n{} - {}\n\n<a href="{}">' + __("track_link") + "</a>"
-                    ).format(
-                        track_title,
-                        uploader,
-                        upload_date_str,
-                        webpage_url,
-                    ),
-                    parse_mode="HTML",
-                    disable_web_page_preview=True,
-                )
-
-            # Delete user message
-            await event.delete()
-
-            location = YT_TMP_DIR / f"{track_id}.mp3"
-
-            # Check if file exists
-            if not location.exists():
-                raise FileNotFoundError(f"Expected audio file not found at {location}")
-
-            # TAG audio
-            thumb_for_tagging = None
-            thumb_for_sending = None
-            if image_bytes:
-                try:
-                    # Prepare thumbnail for tagging
-                    thumb_for_tagging = image_bytes.getvalue()
-
-                    # Create smaller thumb for sending with audio message
-                    image_bytes.seek(0)  # Reset again
-                    roi_img = crop_center(Image.open(image_bytes), 80, 80)
-                    img_byte_arr = io.BytesIO()
-                    if roi_img.mode in ("RGBA", "P"):
-                        roi_img = roi_img.convert("RGB")
-                    roi_img.save(img_byte_arr, format="jpeg")
-                    thumb_for_sending = BufferedInputFile(
-                        img_byte_arr.getvalue(), filename="thumb.jpg"
-                    )
-                except Exception as thumb_proc_err:
-                    print(
-                        f"Error processing thumbnail for tagging/sending: {thumb_proc_err}"
-                    )
-                    thumb_for_tagging = None
-                    thumb_for_sending = None
-
-            try:
-                audio = MP3(location, ID3=ID3)
-                try:
-                    audio.add_tags()
-                except error:
-                    pass  # Ignore if tags already exist
-                if thumb_for_tagging and audio.tags:
-                    audio.tags.add(
-                        APIC(
-                            mime="image/jpeg",
-                            type=3,
-                            desc="Cover",
-                            data=thumb_for_tagging,
-                        )
-                    )
-                # Add other tags if needed (e.g., title, artist)
-                # audio.tags.add(mutagen.id3.TIT2(encoding=3, text=track_title))
-                # audio.tags.add(mutagen.id3.TPE1(encoding=3, text=uploader))
-                audio.save()
-            except Exception as tag_err:
-                print(f"Error tagging audio file: {tag_err}")
-
-            # Send audio
-            await event.answer_audio(
-                FSInputFile(location),
-                title=track_title,
-                performer=uploader,
-                thumbnail=thumb_for_sending,  # Use the prepared thumb or None
-                disable_notification=True,
-            )
-            try:
-                os.remove(location)
-            except FileNotFoundError:
-                pass
-        except yt_dlp.utils.DownloadError as dl_err:
-            print(f"yt-dlp download error: {dl_err}")
-            await event.answer(__("download_error_specific").format(str(dl_err)))
-        except Exception as e:
-            traceback.print_exc()
-            await event.answer(
-                __("download_error") + f"\n<code>{e}</code>", parse_mode="HTML"
-            )
-        finally:
-            await tmp_msg.delete()
-            try:
-                remove_downloading(event.from_user.id)
-            except ValueError:
-                pass
-    else:
-        tmp_err_msg = await event.answer(__("running_download"))
-        await event.delete()
-        await asyncio.sleep(2)
-        await tmp_err_msg.delete()
+@job_kind("youtube")
+async def process_youtube_audio(event: types.Message):
+    """Downloads and sends a YouTube audio, run by the download scheduler."""
+    await process_media_audio(event, YOUTUBE)
 
 
 @soundcloud_router.message(
@@ -265,179 +416,10 @@ async def get_soundcloud_audio(event: types.Message):
         return
 
     print(f"Processing SoundCloud link from user {event.from_user.id}")
-    if is_downloading(event.from_user.id) is False:
-        add_downloading(event.from_user.id)
-        tmp_msg = await event.answer(__("downloading"))
-        try:
-            ydl_opts = {
-                "outtmpl": str(SC_TMP_DIR / "%(id)s.%(ext)s"),  # Use SC_TMP_DIR
-                "format": "bestaudio/best",
-                "postprocessors": [
-                    {
-                        "key": "FFmpegExtractAudio",
-                        "preferredcodec": "mp3",
-                        "preferredquality": "320",
-                    }
-                ],
-                "quiet": True,  # Suppress yt-dlp console output
-                "no_warnings": True,
-            }
-
-            # Cookies generally aren't needed for public SoundCloud tracks,
-            # but you could add the logic here if required for private tracks/sets
-            # if COOKIES_PATH ... etc.
-
-            # Download file
-            ydl = YoutubeDL(ydl_opts)
-            # Run in executor to avoid blocking asyncio loop
-            dict_info = await asyncio.to_thread(
-                ydl.extract_info, event.text, download=True
-            )
-
-            if not dict_info:
-                print("No information found")
-                return
+    await enqueue_download(event, "soundcloud", description="soundcloud audio")
 
-            # Extract metadata (keys might differ slightly from YouTube)
-            thumb_url = dict_info.get("thumbnail")
-            # SoundCloud often has 'track' and 'artist' instead of 'title' and 'uploader'
-            track_title = dict_info.get("track") or dict_info.get(
-                "title", "Unknown Title"
-            )
-            uploader = dict_info.get("artist") or dict_info.get(
-                "uploader", "Unknown Artist"
-            )
-            track_id = dict_info.get("id", "unknown_sc_id")
-            webpage_url = dict_info.get("webpage_url", event.text)
-
-            # Get thumb
-            image_bytes = None
-            if thumb_url:
-                try:
-                    content = requests.get(thumb_url).content
-                    image_bytes = io.BytesIO(content)
-                except Exception as img_err:
-                    print(
-                        f"Error downloading/processing SoundCloud thumbnail: {img_err}"
-                    )
-
-            # Send cover
-            if image_bytes:
-                try:
-                    await event.answer_photo(
-                        BufferedInputFile(image_bytes.getvalue(), filename="cover.jpg"),
-                        caption=(
-                            "<b>Track: {}</b>"
-                            '\nArtist: {}\n\n<a href="{}">' + __("track_link") + "</a>"
-                        ).format(
-                            track_title,
-                            uploader,
-                            webpage_url,
-                        ),
-                        parse_mode="HTML",
-                    )
-                    image_bytes.seek(0)  # Reset stream position for tagging
-                except Exception as photo_err:
-                    print(f"Error sending SoundCloud photo: {photo_err}")
-            else:
-                # Send caption as text if no thumbnail
-                await event.answer(
-                    (
-                        "<b>Track: {}</b>"
-                        '\nArtist: {}\n\n<a href="{}">' + __("track_link") + "</a>"
-                    ).format(
-                        track_title,
-                        uploader,
-                        webpage_url,
-                    ),
-                    parse_mode="HTML",
-                    disable_web_page_preview=True,
-                )
 
-            # Delete user message
-            await event.delete()
-
-            location = SC_TMP_DIR / f"{track_id}.mp3"
-
-            # Check if file exists
-            if not location.exists():
-                raise FileNotFoundError(f"Expected audio file not found at {location}")
-
-            # TAG audio
-            thumb_for_tagging = None
-            thumb_for_sending = None
-            if image_bytes:
-                try:
-                    # Prepare thumbnail for tagging
-                    thumb_for_tagging = image_bytes.getvalue()
-
-                    # Create smaller thumb for sending with audio message
-                    image_bytes.seek(0)  # Reset again
-                    roi_img = crop_center(Image.open(image_bytes), 80, 80)
-                    img_byte_arr = io.BytesIO()
-                    if roi_img.mode in ("RGBA", "P"):
-                        roi_img = roi_img.convert("RGB")
-                    roi_img.save(img_byte_arr, format="jpeg")
-                    thumb_for_sending = BufferedInputFile(
-                        img_byte_arr.getvalue(), filename="thumb.jpg"
-                    )
-                except Exception as thumb_proc_err:
-                    print(
-                        f"Error processing SoundCloud thumbnail for tagging/sending: {thumb_proc_err}"
-                    )
-                    thumb_for_tagging = None
-                    thumb_for_sending = None
-
-            try:
-                audio = MP3(location, ID3=ID3)
-                try:
-                    audio.add_tags()
-                except error:
-                    pass  # Ignore if tags already exist
-                if thumb_for_tagging and audio.tags:
-                    audio.tags.add(
-                        APIC(
-                            mime="image/jpeg",
-                            type=3,
-                            desc="Cover",
-                            data=thumb_for_tagging,
-                        )
-                    )
-                # Add other tags if needed
-                # audio.tags.add(mutagen.id3.TIT2(encoding=3, text=track_title))
-                # audio.tags.add(mutagen.id3.TPE1(encoding=3, text=uploader))
-                audio.save()
-            except Exception as tag_err:
-                print(f"Error tagging SoundCloud audio file: {tag_err}")
-
-            # Send audio
-            await event.answer_audio(
-                FSInputFile(location),
-                title=track_title,
-                performer=uploader,
-                thumbnail=thumb_for_sending,  # Use the prepared thumb or None
-                disable_notification=True,
-            )
-            try:
-                os.remove(location)
-            except FileNotFoundError:
-                pass
-        except yt_dlp.utils.DownloadError as dl_err:
-            print(f"yt-dlp download error (SoundCloud): {dl_err}")
-            await event.answer(__("download_error_specific").format(str(dl_err)))
-        except Exception as e:
-            traceback.print_exc()
-            await event.answer(
-                __("download_error") + f"\n<code>{e}</code>", parse_mode="HTML"
-            )
-        finally:
-            await tmp_msg.delete()
-            try:
-                remove_downloading(event.from_user.id)
-            except ValueError:
-                pass
-    else:
-        tmp_err_msg = await event.answer(__("running_download"))
-        await event.delete()
-        await asyncio.sleep(2)
-        await tmp_err_msg.delete()
+@job_kind("soundcloud")
+async def process_soundcloud_audio(event: types.Message):
+    """Downloads and sends a SoundCloud audio, run by the download scheduler."""
+    await process_media_audio(event, SOUNDCLOUD)
@@ -0,0 +1,204 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from utils import TMP_DIR
+
+# standalone: poll and download in this process (default)
+# front: poll and push jobs to the shared job queue
+# worker: run jobs from the shared job queue, no polling
+RUN_MODE = os.environ.get("RUN_MODE", "standalone").lower()
+if RUN_MODE not in ("standalone", "front", "worker"):
+    raise ValueError(f"Unknown RUN_MODE '{RUN_MODE}' (standalone, front or worker)")
+print("Run mode: " + RUN_MODE)
+# Worker processes sharing the queue, all on the host of the front process.
+# They share its cores and, with the front process, Telegram's rate limits.
+WORKER_PROCESSES = max(1, int(os.environ.get("WORKER_PROCESSES", 1)))
+if RUN_MODE != "standalone":
+    print(f"Worker processes: {WORKER_PROCESSES}")
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", str(Path(TMP_DIR, "jobs.sqlite3")))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 300))
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class QueuedJob:
+    def __init__(self, row):
+        (
+            self.id,
+            self.kind,
+            self.user_id,
+            self.priority,
+            self.description,
+            self.payload,
+        ) = row
+
+
+class SQLiteJobQueue:
+    """
+    Durable job queue shared by the front process and the worker processes,
+    which must run on the same host: WAL mode needs shared memory, and the
+    locking of SQLite isn't reliable over network filesystems.
+
+    Jobs are claimed with a lease that the owning worker keeps renewing, so
+    the jobs of a worker that died go back to the queue once it expires.
+    A user has at most one running job across all workers. Every call is a
+    short transaction; run them with asyncio.to_thread from the event loop.
+    """
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout=10000")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                priority INTEGER NOT NULL,
+                description TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                cancelled INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        try:
+            # Queue files created before cancellation existed
+            self._db.execute(
+                "ALTER TABLE jobs ADD COLUMN cancelled INTEGER NOT NULL DEFAULT 0"
+            )
+        except sqlite3.OperationalError:
+            pass
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id)"
+        )
+
+    def push(
+        self, kind: str, user_id: int, priority: int, description: str, payload: str
+    ) -> tuple[int, int]:
+        """Queue a job, return its id and its position among the waiting jobs."""
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (kind, user_id, priority, description, payload, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, user_id, priority, description, payload, time.time()),
+            )
+            job_id = cursor.lastrowid
+            (position,) = self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'queued'"
+                " AND (priority < ? OR (priority = ? AND id <= ?))",
+                (priority, priority, job_id),
+            ).fetchone()
+        return job_id, position
+
+    def count_for_user(self, user_id: int) -> tuple[int, int]:
+        """Return the number of (queued, running) jobs of a user."""
+        with self._lock:
+            rows = dict(
+                self._db.execute(
+                    "SELECT state, COUNT(*) FROM jobs WHERE user_id = ? GROUP BY state",
+                    (user_id,),
+                ).fetchall()
+            )
+        return rows.get("queued", 0), rows.get("running", 0)
+
+    def claim(self, worker_id: str, lease_seconds: float) -> QueuedJob | None:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "DELETE FROM jobs WHERE state = 'running' AND cancelled = 1"
+                    " AND lease_until < ?",
+                    (now,),
+                )
+                expired = self._db.execute(
+                    "UPDATE jobs SET state = 'queued', worker = NULL, lease_until = NULL"
+                    " WHERE state = 'running' AND lease_until < ?",
+                    (now,),
+                ).rowcount
+                if expired:
+                    print(f"Requeued {expired} job(s) whose worker stopped responding")
+                row = self._db.execute(
+                    "SELECT id, kind, user_id, priority, description, payload FROM jobs"
+                    " WHERE state = 'queued' AND user_id NOT IN"
+                    " (SELECT user_id FROM jobs WHERE state = 'running')"
+                    " ORDER BY priority, id LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?"
+                        " WHERE id = ?",
+                        (worker_id, now + lease_seconds, row[0]),
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return QueuedJob(row) if row is not None else None
+
+    def renew(self, job_ids, worker_id: str, lease_seconds: float) -> None:
+        if not job_ids:
+            return
+        with self._lock:
+            self._db.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ?",
+                [
+                    (time.time() + lease_seconds, job_id, worker_id)
+                    for job_id in job_ids
+                ],
+            )
+
+    def cancel_user(self, user_id: int, include_queued: bool = True) -> int:
+        """
+        Drop the waiting jobs of a user (if asked) and flag their running one
+        for its worker to cancel. Return the number of jobs cancelled.
+        """
+        with self._lock:
+            cancelled = 0
+            if include_queued:
+                cancelled += self._db.execute(
+                    "DELETE FROM jobs WHERE user_id = ? AND state = 'queued'",
+                    (user_id,),
+                ).rowcount
+            cancelled += self._db.execute(
+                "UPDATE jobs SET cancelled = 1"
+                " WHERE user_id = ? AND state = 'running' AND cancelled = 0",
+                (user_id,),
+            ).rowcount
+        return cancelled
+
+    def cancelled_ids(self, job_ids) -> list[int]:
+        """Return which of the given running jobs were cancelled."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return []
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE cancelled = 1 AND id IN (%s)"
+                % ",".join("?" * len(job_ids)),
+                job_ids,
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def ack(self, job_id: int) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+_job_queue = None
+
+
+def get_job_queue() -> SQLiteJobQueue:
+    global _job_queue
+    if _job_queue is None:
+        print(f"Using job queue at {JOB_QUEUE_PATH}")
+        _job_queue = SQLiteJobQueue(JOB_QUEUE_PATH)
+    return _job_queue
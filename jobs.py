@@ -0,0 +1,614 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+
+from aiogram import F, Router, types
+from aiogram.filters import Command
+
+from bot import bot
+from dl_utils.threads import wait_through_cancel
+from job_queue import JOB_LEASE_SECONDS, RUN_MODE, WORKER_ID, get_job_queue
+from utils import __
+
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 4))
+MAX_ACTIVE_JOBS = int(
+    os.environ.get("MAX_ACTIVE_JOBS", 2 * max(1, MAX_CONCURRENT_DOWNLOADS))
+)
+MAX_QUEUED_PER_USER = int(os.environ.get("MAX_QUEUED_PER_USER", 3))
+# Bulk work waiting longer than this is served like short work, so albums
+# can't be starved by a steady stream of single tracks
+PRIORITY_AGING_SECONDS = float(os.environ.get("PRIORITY_AGING_SECONDS", 30))
+print("Max concurrent downloads: " + str(MAX_CONCURRENT_DOWNLOADS))
+print("Max active jobs: " + str(MAX_ACTIVE_JOBS))
+print("Max queued downloads per user: " + str(MAX_QUEUED_PER_USER))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+
+
+def _parse_user_weights(value: str) -> dict:
+    """Parse USER_WEIGHTS, e.g. "123456:2,789:0.5" (unlisted users weigh 1)."""
+    weights = {}
+    for item in value.split(","):
+        user_id, _, weight = item.strip().partition(":")
+        try:
+            weights[int(user_id)] = max(0.01, float(weight))
+        except ValueError:
+            if item.strip():
+                print(f"Warning: ignoring invalid USER_WEIGHTS entry '{item}'")
+    return weights
+
+
+USER_WEIGHTS = _parse_user_weights(os.environ.get("USER_WEIGHTS", ""))
+
+# Short work (a single track, a YouTube/SoundCloud clip) goes before bulk work
+PRIORITY_SHORT = 0
+PRIORITY_BULK = 1
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    """A queued download: `run` is a coroutine function taking no argument."""
+
+    def __init__(self, job_id: int, user_id: int, run, description: str, priority: int):
+        self.id = job_id
+        self.user_id = user_id
+        self.run = run
+        self.description = description
+        self.priority = priority
+        self.queued_at = time.monotonic()
+        self.queue_message = None  # "Queued" message, deleted when the job starts
+        self.message = None  # Request of the user, told if the job is dropped
+        # Callbacks run once the job is over, e.g. to release reserved disk space
+        self.finalizers = []
+        self.task = None  # Set once the job runs
+        # Set when the job is cancelled, for the code it runs in threads
+        self.cancel_event = threading.Event()
+
+
+class Unit:
+    """A piece of work of a job (e.g. one track of an album) run by a worker."""
+
+    def __init__(self, seq: int, job: Job | None, func, cost: float):
+        self.seq = seq
+        self.job = job
+        self.func = func
+        self.cost = cost
+        self.queued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None  # Set once a worker runs the unit
+        # Units run in the context of the caller, so they see its current job
+        self.context = contextvars.copy_context()
+
+
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def current_job() -> Job | None:
+    """Return the job the calling code is running for, if any."""
+    return _current_job.get()
+
+
+def current_cancel_event() -> threading.Event | None:
+    """Event set when the current job is cancelled, to pass to blocking code."""
+    job = _current_job.get()
+    return job.cancel_event if job else None
+
+
+def job_tmp_dir(base, name: str) -> Path:
+    """
+    Temporary directory `base/name` private to the current job, so that two
+    users downloading the same item don't share (and clean up) files.
+    """
+    job = _current_job.get()
+    if job is not None:
+        name = f"{name}-{os.getpid()}-{job.id}"
+    return Path(base) / name
+
+
+async def _delete_message(message):
+    try:
+        await message.delete()
+    except Exception:
+        pass
+
+
+class JobScheduler:
+    """
+    Fair and priority-aware download scheduler.
+
+    Jobs (one user request) are admitted up to `max_active_jobs` at once and
+    one per user at a time; a user can have up to `max_queued_per_user` jobs
+    waiting. The heavy work of a job is split into units (one per track)
+    which `max_workers` workers execute with weighted fair queuing across
+    users: short work first, then the user who received the least service
+    relative to their weight. Albums therefore interleave with other users'
+    requests instead of monopolizing the workers.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_active_jobs: int,
+        max_queued_per_user: int,
+        user_weights: dict | None = None,
+    ):
+        self.max_workers = max(1, max_workers)
+        self.max_active_jobs = max(1, max_active_jobs)
+        self.max_queued_per_user = max(0, max_queued_per_user)
+        self.user_weights = user_weights or {}
+        self._pending_jobs = []
+        self._active_jobs = {}  # user_id -> running Job
+        self._units = {}  # user_id -> deque of Unit
+        self._vtime = {}  # user_id -> virtual service time
+        self._clock = 0.0
+        self._seq = itertools.count(1)
+        self._units_changed = None  # Lazily initialized asyncio.Event
+        self._workers = []
+        self._job_tasks = set()
+
+    def _ensure_workers(self):
+        if self._units_changed is None:
+            self._units_changed = asyncio.Event()
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker(i)) for i in range(self.max_workers)
+            ]
+
+    def _weight(self, user_id) -> float:
+        return self.user_weights.get(user_id, 1.0)
+
+    def _effective_priority(self, item: Job | Unit) -> int:
+        if isinstance(item, Unit):
+            priority = item.job.priority if item.job else PRIORITY_SHORT
+        else:
+            priority = item.priority
+        if time.monotonic() - item.queued_at >= PRIORITY_AGING_SECONDS:
+            priority = PRIORITY_SHORT
+        return priority
+
+    def _job_order(self):
+        return sorted(
+            self._pending_jobs,
+            key=lambda job: (
+                self._effective_priority(job),
+                self._vtime.get(job.user_id, 0.0),
+                job.id,
+            ),
+        )
+
+    # --- Jobs ---
+
+    def queued_count(self, user_id) -> int:
+        return sum(1 for job in self._pending_jobs if job.user_id == user_id)
+
+    def submit(
+        self, user_id, run, description: str = "", priority: int = PRIORITY_SHORT
+    ) -> tuple[Job, int]:
+        """
+        Queue a job and return it with its position in the queue
+        (0 when it starts right away).
+
+        Raises QueueFullError if the user already has too many waiting jobs.
+        """
+        self._ensure_workers()
+        if (
+            user_id in self._active_jobs
+            or len(self._active_jobs) >= self.max_active_jobs
+        ) and self.queued_count(user_id) >= self.max_queued_per_user:
+            raise QueueFullError(
+                f"User {user_id} already has {self.queued_count(user_id)} queued jobs"
+            )
+
+        job = Job(next(self._seq), user_id, run, description, priority)
+        self._pending_jobs.append(job)
+        self._start_jobs()
+        position = self.position(job)
+        print(
+            f"Queued job {job.id} ({description}) for user {user_id}, position {position}"
+        )
+        return job, position
+
+    def position(self, job: Job) -> int:
+        try:
+            return self._job_order().index(job) + 1
+        except ValueError:
+            return 0
+
+    def _start_jobs(self):
+        for job in self._job_order():
+            if len(self._active_jobs) >= self.max_active_jobs:
+                break
+            if job.user_id in self._active_jobs:
+                continue
+            self._pending_jobs.remove(job)
+            self._active_jobs[job.user_id] = job
+            job.task = self._create_task(self._run_job(job))
+            # In a callback, which also runs for a task cancelled before
+            # its first step, where the coroutine never starts
+            job.task.add_done_callback(lambda task, job=job: self._job_done(job, task))
+
+    def _create_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._job_tasks.add(task)
+        task.add_done_callback(self._job_tasks.discard)
+        return task
+
+    def _finalize(self, job: Job):
+        for finalizer in job.finalizers:
+            try:
+                finalizer()
+            except Exception as e:
+                print(f"Error finalizing job {job.id}: {e}")
+
+    async def _run_job(self, job: Job):
+        _current_job.set(job)
+        print(f"Starting job {job.id} ({job.description})")
+        try:
+            if job.queue_message is not None:
+                await _delete_message(job.queue_message)
+            await job.run()
+        except asyncio.CancelledError:
+            print(f"Job {job.id} cancelled")
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            print(traceback.format_exc())
+
+    def _job_done(self, job: Job, task: asyncio.Task):
+        # Only a job cancelled before it started ends as a cancelled task
+        if task.cancelled():
+            print(f"Job {job.id} cancelled before starting")
+            if job.queue_message is not None:
+                self._create_task(_delete_message(job.queue_message))
+        self._finalize(job)
+        del self._active_jobs[job.user_id]
+        print(f"Finished job {job.id}")
+        self._start_jobs()
+
+    def cancel_job(self, job: Job) -> bool:
+        """
+        Cancel a waiting or running job. A running job is cancelled with
+        its units, and code it runs in threads sees `job.cancel_event` set.
+        Return False when the job was already over.
+        """
+        job.cancel_event.set()
+        if job in self._pending_jobs:
+            self._pending_jobs.remove(job)
+            if job.queue_message is not None:
+                self._create_task(_delete_message(job.queue_message))
+            self._finalize(job)
+            print(f"Cancelled queued job {job.id} ({job.description})")
+            return True
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+            return True
+        return False
+
+    async def shutdown(self, timeout: float):
+        """
+        Give the running and waiting jobs up to `timeout` seconds to finish,
+        then cancel the others and tell their users to send them again.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._active_jobs and loop.time() < deadline:
+            await asyncio.wait(
+                [job.task for job in self._active_jobs.values()],
+                timeout=deadline - loop.time(),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        dropped = list(self._pending_jobs) + list(self._active_jobs.values())
+        if not dropped:
+            return
+        print(f"Cancelling {len(dropped)} unfinished job(s)")
+        tasks = [job.task for job in dropped if job.task is not None]
+        for job in dropped:
+            self.cancel_job(job)
+        # Let them clean up, and the handlers tell their users
+        if tasks:
+            await asyncio.wait(tasks, timeout=10)
+        for job in dropped:
+            if job.message is not None:
+                try:
+                    await job.message.answer(__("shutdown_cancelled"))
+                except Exception as e:
+                    print(f"Could not tell user {job.user_id} about job {job.id}: {e}")
+
+    def cancel_user_jobs(self, user_id, include_queued: bool = True) -> int:
+        """Cancel the running job of a user, and their waiting ones if asked."""
+        jobs = []
+        if include_queued:
+            jobs = [job for job in self._pending_jobs if job.user_id == user_id]
+        if user_id in self._active_jobs:
+            jobs.append(self._active_jobs[user_id])
+        return sum(self.cancel_job(job) for job in jobs)
+
+    # --- Units ---
+
+    async def run_unit(self, func, cost: float = 1.0):
+        """
+        Run `func` (a coroutine function taking no argument) on a worker and
+        return its result. Units are accounted to the job of the caller.
+        """
+        self._ensure_workers()
+        job = _current_job.get()
+        unit = Unit(next(self._seq), job, func, cost)
+        user_id = job.user_id if job else None
+        if user_id not in self._units:
+            self._units[user_id] = deque()
+            # An idle user doesn't keep credit for the time it was away
+            self._vtime[user_id] = max(self._vtime.get(user_id, 0.0), self._clock)
+        self._units[user_id].append(unit)
+        self._units_changed.set()
+        try:
+            return await unit.future
+        finally:
+            if not unit.future.done():
+                # The caller was cancelled before the unit ran
+                unit.future.cancel()
+            if unit.task is not None and not unit.task.done():
+                # ... or while it runs, free the worker right away, and
+                # let the unit stop before the job cleans up after it
+                unit.task.cancel()
+                await wait_through_cancel(unit.task)
+
+    def _pop_unit(self):
+        best = None
+        for user_id, units in self._units.items():
+            head = units[0]
+            key = (self._effective_priority(head), self._vtime[user_id], head.seq)
+            if best is None or key < best[0]:
+                best = (key, user_id)
+        if best is None:
+            return None
+        user_id = best[1]
+        unit = self._units[user_id].popleft()
+        if not self._units[user_id]:
+            del self._units[user_id]
+        self._clock = self._vtime[user_id]
+        self._vtime[user_id] += unit.cost / self._weight(user_id)
+        return unit
+
+    async def _worker(self, worker_id: int):
+        while True:
+            unit = self._pop_unit()
+            if unit is None:
+                self._units_changed.clear()
+                await self._units_changed.wait()
+                continue
+            if unit.future.done():
+                continue  # Cancelled while waiting
+
+            unit.task = asyncio.create_task(unit.func(), context=unit.context)
+            # Waiting (rather than awaiting) tells a cancelled unit apart
+            # from a cancelled worker
+            await asyncio.wait([unit.task])
+            if unit.future.done():
+                continue
+            if unit.task.cancelled():
+                unit.future.cancel()
+            elif unit.task.exception() is not None:
+                unit.future.set_exception(unit.task.exception())
+            else:
+                unit.future.set_result(unit.task.result())
+
+
+scheduler = JobScheduler(
+    MAX_CONCURRENT_DOWNLOADS, MAX_ACTIVE_JOBS, MAX_QUEUED_PER_USER, USER_WEIGHTS
+)
+
+
+async def run_unit(func, cost: float = 1.0):
+    """Run a unit of the current job on the shared download workers."""
+    return await scheduler.run_unit(func, cost)
+
+
+# Job kinds, so a job can be described by name and run by another process
+JOB_KINDS = {}
+
+
+def job_kind(name: str):
+    """Register a coroutine function `func(event, *args)` as a job kind."""
+
+    def decorator(func):
+        JOB_KINDS[name] = func
+        return func
+
+    return decorator
+
+
+async def enqueue_download(
+    event: types.Message,
+    kind: str,
+    *args,
+    description: str = "",
+    priority: int = PRIORITY_SHORT,
+):
+    """
+    Queue a download for the message author and tell them where it stands.
+    `args` must be JSON serializable when running with separate workers.
+    """
+    if not event.from_user:
+        return
+    user_id = event.from_user.id
+    if RUN_MODE == "front":
+        await _push_to_job_queue(event, kind, args, description, priority)
+        return
+
+    run = functools.partial(JOB_KINDS[kind], event, *args)
+    try:
+        job, position = scheduler.submit(user_id, run, description, priority)
+    except QueueFullError as e:
+        print(f"USER_DEBUG: Rejected download request from user_id={user_id}: {e}")
+        await event.answer(__("queue_full"), reply_markup=types.ReplyKeyboardRemove())
+        return
+    job.message = event
+    if position > 0:
+        queue_message = await event.answer(__("queued").format(position))
+        # The job may have started while the message was being sent
+        if scheduler.position(job) > 0:
+            job.queue_message = queue_message
+        else:
+            try:
+                await queue_message.delete()
+            except Exception:
+                pass
+
+
+async def _push_to_job_queue(event: types.Message, kind, args, description, priority):
+    user_id = event.from_user.id
+    queue = get_job_queue()
+    queued, running = await asyncio.to_thread(queue.count_for_user, user_id)
+    if (queued or running) and queued >= MAX_QUEUED_PER_USER:
+        print(
+            f"USER_DEBUG: Rejected download request from user_id={user_id}: {queued} queued jobs"
+        )
+        await event.answer(__("queue_full"), reply_markup=types.ReplyKeyboardRemove())
+        return
+
+    queue_message = None
+    if queued or running:
+        # Rough position, the exact one depends on the workers' progress
+        queue_message = await event.answer(__("queued").format(queued + 1))
+    payload = json.dumps(
+        {
+            "message": event.model_dump_json(exclude_none=True),
+            "args": list(args),
+            "queue_message_id": queue_message.message_id if queue_message else None,
+        }
+    )
+    job_id, _ = await asyncio.to_thread(
+        queue.push, kind, user_id, priority, description, payload
+    )
+    print(f"Pushed job {job_id} ({description}) for user {user_id} to the job queue")
+
+
+async def _renew_leases(queue, claimed: dict):
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await asyncio.to_thread(
+                queue.renew, list(claimed), WORKER_ID, JOB_LEASE_SECONDS
+            )
+        except Exception as e:
+            print(f"Error renewing job leases: {e}")
+
+
+async def _watch_cancellations(queue, claimed: dict):
+    """Cancel the claimed jobs that users cancelled from the front process."""
+    while True:
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        if not claimed:
+            continue
+        try:
+            cancelled = await asyncio.to_thread(queue.cancelled_ids, list(claimed))
+        except Exception as e:
+            print(f"Error checking for cancelled jobs: {e}")
+            continue
+        for job_id in cancelled:
+            if job_id in claimed:
+                scheduler.cancel_job(claimed[job_id])
+
+
+async def run_queue_worker():
+    """Pull jobs from the shared job queue and run them on the local scheduler."""
+    queue = get_job_queue()
+    claimed = {}  # queue job id -> local Job
+    acks = set()
+    renew_task = asyncio.create_task(_renew_leases(queue, claimed))
+    cancel_task = asyncio.create_task(_watch_cancellations(queue, claimed))
+    print(f"Worker {WORKER_ID} waiting for jobs")
+    try:
+        while True:
+            if len(claimed) >= scheduler.max_active_jobs:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            queued_job = await asyncio.to_thread(
+                queue.claim, WORKER_ID, JOB_LEASE_SECONDS
+            )
+            if queued_job is None:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            try:
+                payload = json.loads(queued_job.payload)
+                event = types.Message.model_validate_json(
+                    payload["message"], context={"bot": bot}
+                )
+                func = JOB_KINDS[queued_job.kind]
+            except Exception as e:
+                print(f"Dropping invalid job {queued_job.id}: {e}")
+                await asyncio.to_thread(queue.ack, queued_job.id)
+                continue
+
+            def done(job_id=queued_job.id):
+                # Also runs for a job cancelled before it started
+                claimed.pop(job_id, None)
+                task = asyncio.create_task(asyncio.to_thread(queue.ack, job_id))
+                acks.add(task)
+                task.add_done_callback(acks.discard)
+
+            run = functools.partial(func, event, *payload["args"])
+            job, _ = scheduler.submit(
+                queued_job.user_id, run, queued_job.description, queued_job.priority
+            )
+            job.finalizers.append(done)
+            if payload.get("queue_message_id"):
+                job.queue_message = event.model_copy(
+                    update={"message_id": payload["queue_message_id"]}
+                )
+            claimed[queued_job.id] = job
+    finally:
+        renew_task.cancel()
+        cancel_task.cancel()
+
+
+def cancel_keyboard() -> types.InlineKeyboardMarkup:
+    """Inline keyboard cancelling the running download of the user pressing it."""
+    return types.InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                types.InlineKeyboardButton(
+                    text=__("cancel_button"), callback_data="cancel"
+                )
+            ]
+        ]
+    )
+
+
+async def cancel_downloads(user_id: int, include_queued: bool = True) -> int:
+    """Cancel the downloads of a user, wherever they run. Return how many."""
+    if RUN_MODE == "front":
+        queue = get_job_queue()
+        return await asyncio.to_thread(queue.cancel_user, user_id, include_queued)
+    return scheduler.cancel_user_jobs(user_id, include_queued)
+
+
+jobs_router = Router()
+
+
+@jobs_router.message(Command("cancel"))
+async def cancel_command(event: types.Message):
+    if not event.from_user:
+        return
+    cancelled = await cancel_downloads(event.from_user.id)
+    print(f"USER_DEBUG: user_id={event.from_user.id} cancelled {cancelled} download(s)")
+    await event.answer(__("cancelled") if cancelled else __("nothing_to_cancel"))
+
+
+@jobs_router.callback_query(F.data == "cancel")
+async def cancel_button(callback: types.CallbackQuery):
+    cancelled = await cancel_downloads(callback.from_user.id, include_queued=False)
+    print(
+        f"USER_DEBUG: user_id={callback.from_user.id} cancelled {cancelled} download(s)"
+    )
+    await callback.answer(__("cancelled") if cancelled else __("nothing_to_cancel"))
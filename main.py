@@ -3,27 +3,47 @@ import locale
 import logging
 import os
 import re
+import signal
 import sys
 from pathlib import Path
 
 from aiogram import types, __version__ as aiogram_version
 from aiogram.filters import Command, CommandObject
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 from bot import bot, dp
 from dl_utils.deezer_download import TYPE_ALBUM, TYPE_TRACK
+from file_server import start_file_server
 from handlers.deezer import (
     DEEZER_URL,
     deezer_router,
     handle_album_link,
     handle_track_link,
 )
-from handlers.yt_dlp import youtube_router, soundcloud_router
+from handlers.yt_dlp import (
+    soundcloud_router,
+    start_transcode_stats,
+    warm_up_ytdlp,
+    youtube_router,
+)
+from jobs import RUN_MODE, jobs_router, run_queue_worker, scheduler
 from utils import TMP_DIR
+from zip_cache import start_zip_cache_gc
 
 DEEP_LINK_PAYLOAD_REGEX = re.compile(
     rf"^({TYPE_TRACK}|{TYPE_ALBUM})_(\d+)$"
 )
 
+# Webhook mode is enabled by setting the public URL, long polling is the default
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or None
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", 30))
+
 if sys.version_info < (3, 13):
     print(
         "Python 3.13 is required, but you are using Python {}.{}".format(
@@ -80,13 +100,97 @@ async def help_start(event: types.Message, command: CommandObject):
     msg = "Hey, I'm *{}*\n".format(bot_name)
     msg += "_You can use me in inline mode :_\n"
     msg += "@{} \\(album\\|track\\|artist\\) \\<search\\>\n".format(bot_username)
-    msg += "Or just send an *Deezer* album, track *link* or YouTube *link*"
+    msg += "Or just send an *Deezer* album, track *link* or YouTube *link*\n"
+    msg += "Send /cancel to stop your downloads"
     await event.answer(msg, parse_mode="MarkdownV2")
 
 
+async def run_webhook() -> None:
+    """
+    Receive updates through aiogram's aiohttp webhook handler until SIGINT/SIGTERM.
+
+    On shutdown, new updates are answered with 503 (Telegram delivers them
+    again later, possibly to another instance) while the updates being
+    handled and the downloads they queued get up to WEBHOOK_DRAIN_TIMEOUT
+    seconds to finish. Unfinished downloads are cancelled, and their users
+    told to send them again: Telegram won't deliver those updates again.
+    """
+    in_flight = set()
+    draining = asyncio.Event()
+
+    @web.middleware
+    async def drain_middleware(request, handler):
+        if draining.is_set():
+            return web.Response(status=503)
+        task = asyncio.current_task()
+        in_flight.add(task)
+        try:
+            return await handler(request)
+        finally:
+            in_flight.discard(task)
+
+    app = web.Application(middlewares=[drain_middleware])
+    # Handlers only queue the downloads, so updates are processed before
+    # answering Telegram and in-flight requests are the in-flight updates
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=False,
+        secret_token=WEBHOOK_SECRET,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(
+        runner, WEBHOOK_HOST, WEBHOOK_PORT, shutdown_timeout=WEBHOOK_DRAIN_TIMEOUT
+    )
+    await site.start()
+    print(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        drain_until = loop.time() + WEBHOOK_DRAIN_TIMEOUT
+        print(f"Stopping webhook server, draining {len(in_flight)} update(s)...")
+        draining.set()
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=WEBHOOK_DRAIN_TIMEOUT)
+        # Jobs queued in this process, with RUN_MODE=front they wait in the job queue
+        await scheduler.shutdown(max(0.0, drain_until - loop.time()))
+        await runner.cleanup()
+        print("Webhook server stopped.")
+
+
 async def main() -> None:
-    dp.include_routers(youtube_router, soundcloud_router, deezer_router)
-    await dp.start_polling(bot)
+    dp.include_routers(jobs_router, youtube_router, soundcloud_router, deezer_router)
+    if RUN_MODE != "front":
+        # Zips are published by the processes running the downloads
+        start_zip_cache_gc()
+        start_transcode_stats()
+        await warm_up_ytdlp()
+    if RUN_MODE != "worker":
+        # A single process serves the zips, the one receiving the updates
+        await start_file_server()
+    if RUN_MODE == "worker":
+        # Updates are received by the front process, only run queued jobs
+        await run_queue_worker()
+    elif WEBHOOK_URL:
+        await run_webhook()
+    else:
+        # Telegram refuses getUpdates while a webhook is set
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
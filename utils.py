@@ -1,9 +1,10 @@
 import json
 import os
+import time
+from collections import OrderedDict
 
 LANGS_FILE = json.load(open("langs.json"))
 LANG = os.environ.get("BOT_LANG")
-DOWNLOADING_USERS = []
 
 TMP_DIR = "tmp"
 
@@ -19,13 +20,30 @@ def __(s):
     return LANGS_FILE[s][LANG]
 
 
-def is_downloading(user_id):
-    return user_id in DOWNLOADING_USERS
-
-
-def add_downloading(user_id):
-    DOWNLOADING_USERS.append(user_id)
-
-
-def remove_downloading(user_id):
-    DOWNLOADING_USERS.remove(user_id)
+class TTLCache:
+    """Small in-memory LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, max_size: int = 128):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from pathlib import Path
+
+from utils import TMP_DIR
+
+# Copy mode: zips are published in COPY_FILES_PATH and sent as links
+COPY_FILES_PATH = os.environ.get("COPY_FILES_PATH")
+FILE_LINK_TEMPLATE = os.environ.get("FILE_LINK_TEMPLATE")
+# Public URL of the built-in file server (file_server.py), instead of a template
+FILE_SERVER_URL = os.environ.get("FILE_SERVER_URL", "").rstrip("/")
+COPY_MODE = bool(COPY_FILES_PATH and (FILE_LINK_TEMPLATE or FILE_SERVER_URL))
+
+# Kept out of COPY_FILES_PATH, which is served publicly
+ZIP_CACHE_MANIFEST_PATH = os.environ.get(
+    "ZIP_CACHE_MANIFEST_PATH", str(Path(TMP_DIR, "zip_cache.sqlite3"))
+)
+# Size quota of COPY_FILES_PATH, the least recently used zips go first (0 = none)
+ZIP_CACHE_MAX_MB = int(os.environ.get("ZIP_CACHE_MAX_MB", 0))
+# Zips not downloaded through the bot for this long are removed (0 = never)
+ZIP_CACHE_TTL_HOURS = float(os.environ.get("ZIP_CACHE_TTL_HOURS", 0))
+ZIP_CACHE_GC_INTERVAL = float(os.environ.get("ZIP_CACHE_GC_INTERVAL", 600))
+# Zips being written whose writer died are removed after this long
+STALE_PART_SECONDS = 24 * 3600
+
+if COPY_MODE:
+    print(
+        f"Zip cache: {COPY_FILES_PATH} (max {ZIP_CACHE_MAX_MB or 'unlimited'} MB, "
+        f"TTL {ZIP_CACHE_TTL_HOURS or 'unlimited'} h)"
+    )
+
+
+class ZipCacheManifest:
+    """
+    Zips published in the copy directory, with their size and last access.
+
+    A zip is written under a temporary name and renamed once written, then
+    listed here. Only zips holding the whole release (no track failed to
+    download) are marked complete and handed out again by lookup().
+    Shared by all processes like the job queue; every call is a short
+    transaction, run them with asyncio.to_thread from the event loop.
+    """
+
+    def __init__(self, path: str, directory: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout=10000")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS zips (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                complete INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        # Signed links of the file server, with their downloads
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS links (
+                signature TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                downloads INTEGER NOT NULL DEFAULT 0,
+                last_download_at REAL
+            )"""
+        )
+
+    def lookup(self, name: str) -> bool:
+        """Whether a complete zip is published under this name, marking it as used."""
+        try:
+            size = (self.directory / name).stat().st_size
+        except OSError:
+            size = None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, complete FROM zips WHERE name = ?", (name,)
+            ).fetchone()
+            if row is None or not row[1]:
+                return False
+            if row[0] != size:
+                # Removed or replaced behind our back
+                self._db.execute("DELETE FROM zips WHERE name = ?", (name,))
+                return False
+            self._db.execute(
+                "UPDATE zips SET accessed_at = ? WHERE name = ?", (time.time(), name)
+            )
+        return True
+
+    def temporary_path(self, name: str) -> Path:
+        """Where to write a zip before publishing it with add()."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return self.directory / f".{name}.{uuid.uuid4().hex[:8]}.part"
+
+    def add(self, name: str, temporary_path: Path, complete: bool):
+        """Publish a written zip under its final name."""
+        final_path = self.directory / name
+        os.replace(temporary_path, final_path)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO zips"
+                " (name, size, complete, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (name, final_path.stat().st_size, int(complete), now, now),
+            )
+
+    def record_download(self, signature: str, name: str, expires_at: float) -> int:
+        """Count a download through a signed link. Returns the link's count."""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO links (signature, name, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (signature) DO NOTHING",
+                (signature, name, expires_at),
+            )
+            self._db.execute(
+                "UPDATE links SET downloads = downloads + 1, last_download_at = ?"
+                " WHERE signature = ?",
+                (now, signature),
+            )
+            # A zip still downloaded is kept by the clean-up
+            self._db.execute(
+                "UPDATE zips SET accessed_at = ? WHERE name = ?", (now, name)
+            )
+            return self._db.execute(
+                "SELECT downloads FROM links WHERE signature = ?", (signature,)
+            ).fetchone()[0]
+
+    def _remove(self, name: str):
+        (self.directory / name).unlink(missing_ok=True)
+        self._db.execute("DELETE FROM zips WHERE name = ?", (name,))
+
+    def collect(self, max_bytes: int, ttl: float) -> int:
+        """
+        Remove the zips unused for `ttl` seconds, then the least recently
+        used ones until the directory holds at most `max_bytes` (0: no limit).
+        Valid zips found in the directory but not listed (made before the
+        manifest) are adopted, as not complete since that is unknown.
+        Returns the number of files removed.
+        """
+        if not self.directory.is_dir():
+            return 0
+        now = time.time()
+        removed = 0
+        with self._lock:
+            listed = dict(self._db.execute("SELECT name, size FROM zips").fetchall())
+            for path in self.directory.iterdir():
+                if not path.is_file():
+                    continue
+                stat = path.stat()
+                if path.name.endswith(".part"):
+                    if stat.st_mtime < now - STALE_PART_SECONDS:
+                        path.unlink(missing_ok=True)
+                        removed += 1
+                elif path.suffix == ".zip" and path.name not in listed:
+                    if zipfile.is_zipfile(path):
+                        self._db.execute(
+                            "INSERT OR IGNORE INTO zips"
+                            " (name, size, complete, created_at, accessed_at)"
+                            " VALUES (?, ?, 0, ?, ?)",
+                            (path.name, stat.st_size, stat.st_mtime, stat.st_mtime),
+                        )
+                    else:
+                        print(f"Zip cache: removing invalid zip {path.name}")
+                        path.unlink(missing_ok=True)
+                        removed += 1
+            for name in listed:
+                if not (self.directory / name).exists():
+                    self._db.execute("DELETE FROM zips WHERE name = ?", (name,))
+            self._db.execute("DELETE FROM links WHERE expires_at < ?", (now,))
+
+            if ttl > 0:
+                expired = self._db.execute(
+                    "SELECT name FROM zips WHERE accessed_at < ?", (now - ttl,)
+                ).fetchall()
+                for (name,) in expired:
+                    self._remove(name)
+                    removed += 1
+            if max_bytes > 0:
+                rows = self._db.execute(
+                    "SELECT name, size FROM zips ORDER BY accessed_at DESC"
+                ).fetchall()
+                total = 0
+                for name, size in rows:
+                    total += size
+                    if total > max_bytes:
+                        self._remove(name)
+                        removed += 1
+        return removed
+
+
+_manifest = None
+_gc_task = None
+
+
+def get_zip_cache() -> ZipCacheManifest:
+    global _manifest
+    if _manifest is None:
+        _manifest = ZipCacheManifest(ZIP_CACHE_MANIFEST_PATH, COPY_FILES_PATH)
+    return _manifest
+
+
+async def _run_gc():
+    manifest = get_zip_cache()
+    while True:
+        try:
+            removed = await asyncio.to_thread(
+                manifest.collect,
+                ZIP_CACHE_MAX_MB * 1024 * 1024,
+                ZIP_CACHE_TTL_HOURS * 3600,
+            )
+            if removed:
+                print(f"Zip cache: removed {removed} file(s) from {COPY_FILES_PATH}")
+        except Exception as e:
+            print(f"Zip cache garbage collection failed: {e}")
+        await asyncio.sleep(ZIP_CACHE_GC_INTERVAL)
+
+
+def start_zip_cache_gc():
+    """Clean up COPY_FILES_PATH in the background, in copy mode."""
+    global _gc_task
+    if COPY_MODE and _gc_task is None:
+        _gc_task = asyncio.create_task(_run_gc())
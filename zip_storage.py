@@ -0,0 +1,101 @@
+import asyncio
+import os
+
+from dl_utils.s3_client import S3Client
+from dl_utils.zip_engine import build_zip, stream_zip
+from file_server import FILE_LINK_TTL_HOURS, zip_link
+from zip_cache import COPY_MODE, get_zip_cache
+
+# Copy mode to an S3-compatible bucket instead of COPY_FILES_PATH
+S3_BUCKET = os.environ.get("S3_BUCKET")
+S3_ENDPOINT = os.environ.get("S3_ENDPOINT")
+S3_REGION = os.environ.get("S3_REGION", "us-east-1")
+S3_ACCESS_KEY_ID = os.environ.get("S3_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.environ.get("S3_SECRET_ACCESS_KEY")
+# Key prefix of the zips in the bucket
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+S3_PART_SIZE_MB = int(os.environ.get("S3_PART_SIZE_MB", 16))
+# Parts uploaded at once, each held in memory while being sent
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("S3_UPLOAD_CONCURRENCY", 4))
+if S3_BUCKET:
+    print(
+        f"Zip storage: S3 bucket {S3_BUCKET} at {S3_ENDPOINT or 'AWS'} "
+        f"({S3_UPLOAD_CONCURRENCY} parts of {S3_PART_SIZE_MB} MB at once)"
+    )
+
+_storage = None
+
+
+class LocalZipStorage:
+    """Zips written to COPY_FILES_PATH, served by a web server or file_server.py."""
+
+    async def lookup(self, name: str) -> bool:
+        return await asyncio.to_thread(get_zip_cache().lookup, name)
+
+    async def publish(self, name, files, complete, on_progress, cancel_event):
+        cache = get_zip_cache()
+        # Published under its final name once written, so links never
+        # point to a partial zip
+        temporary_path = cache.temporary_path(name)
+        print(f"Creating zip file at: {temporary_path.with_name(name)}")
+        try:
+            await build_zip(temporary_path, files, on_progress, cancel_event)
+            await asyncio.to_thread(cache.add, name, temporary_path, complete)
+        except BaseException:
+            temporary_path.unlink(missing_ok=True)
+            raise
+
+    async def link(self, name: str) -> str:
+        return zip_link(name)
+
+
+class S3ZipStorage:
+    """
+    Zips streamed to an S3-compatible bucket with parallel multipart uploads,
+    without touching the disk, and sent as presigned links. Expiring them
+    is left to the bucket's lifecycle rules.
+    """
+
+    def __init__(self):
+        self.client = S3Client(
+            S3_ENDPOINT or f"https://s3.{S3_REGION}.amazonaws.com",
+            S3_BUCKET,
+            S3_REGION,
+            S3_ACCESS_KEY_ID,
+            S3_SECRET_ACCESS_KEY,
+        )
+
+    async def lookup(self, name: str) -> bool:
+        headers = await self.client.head_object(S3_PREFIX + name)
+        # Zips missing tracks aren't handed out again
+        return headers is not None and headers.get("x-amz-meta-complete") == "1"
+
+    async def publish(self, name, files, complete, on_progress, cancel_event):
+        print(f"Uploading zip file to: s3://{S3_BUCKET}/{S3_PREFIX}{name}")
+        # Multipart uploads only show up once completed
+        await self.client.upload_stream(
+            S3_PREFIX + name,
+            stream_zip(files, on_progress, cancel_event),
+            S3_PART_SIZE_MB * 1024 * 1024,
+            S3_UPLOAD_CONCURRENCY,
+            content_type="application/zip",
+            metadata={"complete": "1" if complete else "0"},
+        )
+
+    async def link(self, name: str) -> str:
+        return self.client.presign_get(
+            S3_PREFIX + name,
+            int(FILE_LINK_TTL_HOURS * 3600),
+            {"response-content-disposition": f'attachment; filename="{name}"'},
+        )
+
+
+def get_zip_storage():
+    """Where copy mode publishes zips, None when copy mode is off."""
+    global _storage
+    if _storage is None:
+        if S3_BUCKET:
+            _storage = S3ZipStorage()
+        elif COPY_MODE:
+            _storage = LocalZipStorage()
+    return _storage